@@ -0,0 +1,398 @@
+import asyncio
+import os
+import socket
+import time
+from collections import deque
+from typing import Optional
+from utils.events import DISPATCH_INLINE
+from .client import Client, ClientEventEmitter, TAG_MSG, TAG_ERR, TAG_CFG, TAG_CMD, DEFAULT_TCP_NODELAY, DEFAULT_HISTORY_PAGE_SIZE, PONG
+from .compression import CODEC_NONE, SAMPLE_SIZE, is_compressible, create_compressor, create_decompressor
+from .filetransfer import DEFAULT_TRANSFER_CHUNK_SIZE, DOWNLOADS_FOLDER, hash_file, format_throughput
+from .framing import FrameReader, FrameCompressor, encode_frame, get_compression_command
+
+DEFAULT_READ_SIZE = 64 * 1024
+DEFAULT_MAX_PENDING_EVENTS = 1000
+
+
+class AsyncEventEmitter(ClientEventEmitter):
+    # Never started as a thread: the client's reader task feeds it frames and events are handed out on the loop.
+    def __init__(self, client):
+        ClientEventEmitter.__init__(self, client, DISPATCH_INLINE)
+
+        self.queue = None  # only created once somebody iterates over the client's events
+        self.tasks = set()
+
+    def emit(self, event: str, args: list, key: str = None):
+        for fn in self.handlers.get(event) or ():
+            if asyncio.iscoroutinefunction(fn):
+                task = asyncio.get_running_loop().create_task(fn(*args))
+
+                self.tasks.add(task)
+                task.add_done_callback(self._finish_task)
+            else:
+                self._call(fn, args)
+
+        if self.queue is not None:
+            self.queue.put_nowait((event, args))
+
+    def end(self):
+        if self.queue is not None:
+            self.queue.put_nowait(None)
+
+    def _finish_task(self, task):
+        self.tasks.discard(task)
+        self._report_task(task)
+
+
+class AsyncClient:
+    # Coroutine counterpart of Client: no threads of its own, any number of instances can share one event loop.
+    def __init__(self, host: str, chat_port: int, file_transfer_port: int, username: str, **kwargs):
+        self.emitter = AsyncEventEmitter(self)
+
+        self.host = host
+        self.chat_port = chat_port
+        self.file_transfer_port = file_transfer_port
+        self.username = username
+
+        self.read_size = kwargs.get('read_size') or DEFAULT_READ_SIZE
+        self.tcp_nodelay = kwargs.get('tcp_nodelay', DEFAULT_TCP_NODELAY)
+        self.transfer_chunk_size = kwargs.get('transfer_chunk_size') or DEFAULT_TRANSFER_CHUNK_SIZE
+        self.compression = kwargs.get('compression') or CODEC_NONE
+        self.chat_compression = kwargs.get('chat_compression')
+        self.presence = kwargs.get('presence', False)
+        self.downloads_folder = kwargs.get('downloads_folder') or DOWNLOADS_FOLDER
+        self.max_pending_events = kwargs.get('max_pending_events') or DEFAULT_MAX_PENDING_EVENTS
+
+        self.reader = FrameReader(compression_codecs=(self.chat_compression,) if self.chat_compression else ())
+        self.pending_frames = deque()
+        self.compressor = None
+
+        self.stream_reader = None
+        self.stream_writer = None
+        self.read_task = None
+        self.events_drained = asyncio.Event()
+
+        self.emitter.on('ping', self._handle_ping)
+
+    parse_received_message = staticmethod(Client.parse_received_message)
+
+    async def connect(self):
+        self.stream_reader, self.stream_writer = await asyncio.open_connection(self.host, self.chat_port)
+        self.stream_writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay))
+
+        await self.send_to_socket(TAG_CFG, f'set_username {self.username}')
+        tag, response = await self._receive_frame()
+
+        if tag == TAG_ERR:
+            await self.close()
+            raise Exception(f'Could not use the username {self.username}: {response}')
+
+        if self.chat_compression:
+            await self._enable_compression()
+
+        self.read_task = asyncio.get_running_loop().create_task(self._read_frames())
+
+        # Off by default: with thousands of logical users every presence change would reach every one of them.
+        if self.presence:
+            await self.subscribe_to_presence()
+
+    async def close(self):
+        if self.read_task is not None:
+            self.read_task.cancel()
+            self.read_task = None
+
+        if self.stream_writer is not None:
+            self.stream_writer.close()
+
+            try:
+                await self.stream_writer.wait_closed()
+            except OSError:
+                pass
+
+            self.stream_writer = None
+
+        self.emitter.end()
+
+    def on(self, event: str, fn):
+        self.emitter.on(event, fn)
+
+    def events(self):
+        return self.__aiter__()
+
+    def __aiter__(self):
+        if self.emitter.queue is None:
+            self.emitter.queue = asyncio.Queue()
+
+        return self
+
+    async def __anext__(self) -> tuple:
+        event = await self.emitter.queue.get()
+
+        if self.emitter.queue.qsize() <= self.max_pending_events:
+            self.events_drained.set()
+
+        if event is None:
+            self.emitter.queue.put_nowait(None)
+            raise StopAsyncIteration
+
+        return event
+
+    async def connect_to_user(self, username: str):
+        await self.send_to_socket(TAG_CMD, f'connect {username}')
+
+    async def disconnect_from_user(self, username: str):
+        await self.send_to_socket(TAG_CMD, f'disconnect {username}')
+
+    async def join_room(self, room: str):
+        await self.send_to_socket(TAG_CMD, f'join {room}')
+
+    async def leave_room(self, room: str):
+        await self.send_to_socket(TAG_CMD, f'leave {room}')
+
+    async def send_exit(self):
+        await self.send_to_socket(TAG_CMD, 'exit')
+
+    async def send_message_to(self, recipient: str, message: str):
+        await self.send_to_socket(TAG_MSG, f'{recipient};{message}')
+
+    async def request_list(self):
+        await self.send_to_socket(TAG_CMD, 'list')
+
+    async def subscribe_to_presence(self):
+        await self.send_to_socket(TAG_CMD, 'subscribe')
+
+    async def request_history(self, peer_username: str, before: int = 0, count: int = DEFAULT_HISTORY_PAGE_SIZE):
+        await self.send_to_socket(TAG_CMD, f'history {peer_username} {before} {count}')
+
+    async def send_to_socket(self, tag: str, message: str):
+        if self.stream_writer is None:
+            raise Exception('No socket connection is available to this client.')
+
+        # Compressing and writing without awaiting in between keeps the zlib stream in send order.
+        data = encode_frame(tag, message)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+
+        self.stream_writer.write(data)
+        await self.stream_writer.drain()
+
+    async def send_file(self, destination_user: str, filename: str, file_path: str) -> bool:
+        loop = asyncio.get_running_loop()
+
+        file_size = os.path.getsize(file_path)
+        content_hash = await loop.run_in_executor(None, hash_file, file_path, self.transfer_chunk_size)
+        codec = await loop.run_in_executor(None, self._choose_codec, file_path)
+
+        reader, writer = await asyncio.open_connection(self.host, self.file_transfer_port)
+        started_at = time.monotonic()
+
+        try:
+            writer.write(f'UP;{self.username};{destination_user};{filename};{file_size};;;{content_hash};{codec}\n'.encode('ASCII'))
+            response = (await reader.readline()).decode('ASCII').strip()
+
+            if response == 'EXISTS':
+                return False
+
+            if not response.startswith('OK'):
+                raise Exception('The server refused to receive a file.')
+
+            _, _, codec = response.partition(';')
+
+            # Disk reads and compression go to the executor, the loop is shared with every other client.
+            file = await loop.run_in_executor(None, open, file_path, 'rb')
+
+            try:
+                if codec:
+                    uploaded = await self._send_compressed(writer, file, codec)
+                else:
+                    uploaded = await loop.sendfile(writer.transport, file)
+            finally:
+                await loop.run_in_executor(None, file.close)
+
+            await writer.drain()
+        finally:
+            await self._close_stream(writer)
+
+        print(f'[ASYNC CLIENT]: Uploaded {filename}. {format_throughput(uploaded, time.monotonic() - started_at)}')
+        return True
+
+    async def receive_file(self, file_header: str) -> str:
+        _, filename, file_size, file_id = file_header.split(';')[:4]
+
+        return await self.download_file(filename, int(file_size), file_id)
+
+    async def download_file(self, filename: str, file_size: int, file_id: str) -> str:
+        loop = asyncio.get_running_loop()
+        file_path = os.path.abspath(f'{self.downloads_folder}/{filename}')
+        part_path = f'{file_path}.part'
+
+        reader, writer = await asyncio.open_connection(self.host, self.file_transfer_port)
+        started_at = time.monotonic()
+
+        try:
+            writer.write(f'DOWN;;;{file_id};;0;;;{self.compression}\n'.encode('ASCII'))
+            response = (await reader.readline()).decode('ASCII').strip()
+
+            if not response.startswith('OK;'):
+                raise Exception('The server refused to send a file.')
+
+            fields = response.split(';')
+            length = int(fields[1])
+            codec = fields[2] if len(fields) > 2 else CODEC_NONE
+
+            file = await loop.run_in_executor(None, open, part_path, 'wb')
+
+            try:
+                if codec:
+                    await self._receive_compressed(reader, file, length, codec)
+                else:
+                    await self._receive_raw(reader, file, length)
+            finally:
+                await loop.run_in_executor(None, file.close)
+        finally:
+            await self._close_stream(writer)
+
+        await loop.run_in_executor(None, os.replace, part_path, file_path)
+
+        print(f'[ASYNC CLIENT]: Downloaded {filename} to {file_path}. {format_throughput(file_size, time.monotonic() - started_at)}')
+        return file_path
+
+    async def _handle_ping(self):
+        await self.send_to_socket(TAG_CMD, PONG)
+
+    async def _read_frames(self):
+        try:
+            while True:
+                self.emitter.handle_frame(*await self._receive_frame())
+
+                # A consumer that falls behind stops the reads instead of growing the event queue without bound.
+                while self.emitter.queue is not None and self.emitter.queue.qsize() > self.max_pending_events:
+                    self.events_drained.clear()
+                    await self.events_drained.wait()
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as error:
+            self.emitter.emit('closed', [str(error)])
+            self.emitter.end()
+
+    async def _receive_frame(self) -> tuple:
+        while not self.pending_frames:
+            data = await self.stream_reader.read(self.read_size)
+
+            if not data:
+                raise Exception('No data received on socket. Was the connection interrupted?')
+
+            self.pending_frames.extend(self.reader.feed(data))
+
+        return self.pending_frames.popleft()
+
+    async def _enable_compression(self):
+        command = get_compression_command(self.chat_compression)
+        await self.send_to_socket(TAG_CFG, command)
+
+        # Nothing else is sent until the server answers, so both sides switch at the same point of the stream.
+        skipped_frames = []
+        while True:
+            tag, response = await self._receive_frame()
+
+            if tag == TAG_CFG or tag == TAG_ERR:
+                break
+
+            skipped_frames.append((tag, response))
+
+        self.pending_frames.extendleft(reversed(skipped_frames))
+
+        if tag == TAG_CFG and response == command:
+            self.compressor = FrameCompressor(self.chat_compression)
+        else:
+            print(f'[ASYNC CLIENT]: The server refused compression: {response}')
+
+    def _choose_codec(self, file_path: str) -> str:
+        if not self.compression:
+            return CODEC_NONE
+
+        with open(file_path, 'rb') as file:
+            return self.compression if is_compressible(file.read(SAMPLE_SIZE)) else CODEC_NONE
+
+    async def _send_compressed(self, writer: asyncio.StreamWriter, file, codec: str) -> int:
+        loop = asyncio.get_running_loop()
+        compressor = create_compressor(codec)
+        sent = 0
+
+        while True:
+            compressed = await loop.run_in_executor(None, self._compress_chunk, file, compressor)
+
+            if compressed is None:
+                break
+
+            if compressed:
+                writer.write(compressed)
+                sent += len(compressed)
+                await writer.drain()
+
+        compressed = await loop.run_in_executor(None, compressor.flush)
+        writer.write(compressed)
+
+        return sent + len(compressed)
+
+    def _compress_chunk(self, file, compressor) -> Optional[bytes]:
+        part_content = file.read(self.transfer_chunk_size)
+
+        if len(part_content) == 0:
+            return None
+
+        return compressor.compress(part_content)
+
+    async def _receive_raw(self, reader: asyncio.StreamReader, file, file_size: int):
+        loop = asyncio.get_running_loop()
+        received = 0
+
+        while received < file_size:
+            data = await reader.read(min(self.transfer_chunk_size, file_size - received))
+
+            if not data:
+                raise Exception(f'Connection closed after receiving {received} of {file_size} bytes.')
+
+            await loop.run_in_executor(None, file.write, data)
+            received += len(data)
+
+    async def _receive_compressed(self, reader: asyncio.StreamReader, file, file_size: int, codec: str):
+        loop = asyncio.get_running_loop()
+        decompressor = create_decompressor(codec)
+        received = 0
+
+        while not decompressor.eof:
+            data = await reader.read(self.transfer_chunk_size)
+
+            if not data:
+                raise Exception(f'Connection closed after receiving {received} of {file_size} bytes.')
+
+            received += await loop.run_in_executor(None, self._decompress_chunk, file, decompressor, data, file_size - received)
+
+        if received != file_size:
+            raise Exception(f'Compressed stream ended after {received} of {file_size} bytes.')
+
+    @staticmethod
+    def _decompress_chunk(file, decompressor, data: bytes, remaining: int) -> int:
+        # Never inflates more than one byte past the announced size, a small download cannot expand into gigabytes.
+        part_content = decompressor.decompress(data, remaining + 1)
+
+        if len(part_content) > remaining:
+            raise Exception('Decompressed content is larger than the announced size.')
+
+        file.write(part_content)
+        return len(part_content)
+
+        if received != file_size:
+            raise Exception(f'Compressed stream ended after {received} of {file_size} bytes.')
+
+    @staticmethod
+    async def _close_stream(writer: asyncio.StreamWriter):
+        writer.close()
+
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
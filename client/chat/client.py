@@ -1,11 +1,17 @@
 import socket
 import sys
-from utils.events import EventEmitter
+from collections import deque
+from threading import RLock
+from utils.events import EventEmitter, DISPATCH_POOL
 from utils.schedulers import IntervalExecutor
 from .filetransfer import FileTransferUploader, FileTransferDownloader
+from .framing import FrameReader, FrameCompressor, encode_frame, encode_frames, get_compression_command
 
 DEFAULT_BUFFER_SIZE = 1024
-DEFAULT_LIST_INTERVAL = 10
+DEFAULT_LIST_INTERVAL = 0
+DEFAULT_TCP_NODELAY = True
+DEFAULT_HISTORY_PAGE_SIZE = 50
+DEFAULT_DISPATCH = DISPATCH_POOL
 
 TAG_MSG = 'MSG'
 TAG_ERR = 'ERR'
@@ -13,51 +19,91 @@ TAG_CFG = 'CFG'
 TAG_CMD = 'CMD'
 TAG_LIST = 'LIST'
 TAG_FILE = 'FILE'
+TAG_PRESENCE = 'PRES'
+TAG_HISTORY = 'HIST'
+
+ROOM_PREFIX = '#'
+
+PING = 'ping'
+PONG = 'pong'
 
 
 class ClientEventEmitter(EventEmitter):
-    def __init__(self, client):
-        EventEmitter.__init__(self)
+    def __init__(self, client, dispatch: str = DEFAULT_DISPATCH, **kwargs):
+        EventEmitter.__init__(self, dispatch, **kwargs)
 
         self.client = client
+        self.history_pages = dict()  # peer_username -> records received for the page in flight
+
+        self.tag_handlers = {
+            TAG_MSG: self._dispatch_message,
+            TAG_ERR: lambda message: self.emit('error', [message]),
+            TAG_CFG: lambda message: self.emit('config', [message]),
+            TAG_CMD: self._dispatch_command,
+            TAG_PRESENCE: self._dispatch_presence,
+            TAG_HISTORY: self._dispatch_history,
+            TAG_LIST: lambda message: self.emit('list', [message]),
+            TAG_FILE: lambda message: self.emit('file', [message])
+        }
 
     def run(self):
         while True:
-            received_message = self.client.receive_from_socket()
-            tag, received_message = self.client.parse_received_message(received_message)
-
-            if tag == TAG_MSG:
-                author, message = self.client.parse_received_message(received_message, ';')
-
-                self.emit('message', [author, message])
-                continue
-            if tag == TAG_ERR:
-                self.emit('error', [received_message])
-                continue
-            if tag == TAG_CFG:
-                self.emit('config', [received_message])
-                continue
-            if tag == TAG_CMD:
-                if received_message.startswith('connect'):
-                    peer_username = received_message[len('connect '):]
-                    self.emit('connect', [peer_username])
-
-                elif received_message.startswith('disconnect'):
-                    peer_username = received_message[len('disconnect '):]
-                    self.emit('disconnect', [peer_username])
-
-                self.emit('command', [received_message])
-                continue
-            if tag == TAG_LIST:
-                self.emit('list', [received_message])
-            if tag == TAG_FILE:
-                self.emit('file', [received_message])
+            self.handle_frame(*self.client.receive_from_socket())
+
+    def handle_frame(self, tag: str, received_message: str):
+        handler = self.tag_handlers.get(tag)
+
+        if handler is not None:
+            handler(received_message)
+
+    def _dispatch_message(self, received_message: str):
+        # Events about one conversation share its ordering key, so a pool never reorders connect, message and disconnect.
+        author, message = self.client.parse_received_message(received_message, ';')
+
+        if author.startswith(ROOM_PREFIX):
+            room = author
+            author, message = self.client.parse_received_message(message, ';')
+
+            return self.emit('room_message', [room, author, message], room)
+
+        self.emit('message', [author, message], author)
+
+    def _dispatch_command(self, received_message: str):
+        if received_message == PING:
+            return self.emit('ping', [])
+
+        if received_message.startswith('connect'):
+            peer_username = received_message[len('connect '):]
+            self.emit('connect', [peer_username], peer_username)
+
+        elif received_message.startswith('disconnect'):
+            peer_username = received_message[len('disconnect '):]
+            self.emit('disconnect', [peer_username], peer_username)
+
+        self.emit('command', [received_message])
+
+    def _dispatch_presence(self, received_message: str):
+        version, update = self.client.parse_received_message(received_message, ';')
+
+        self.emit('presence', [int(version), update[:1], [user for user in update[1:].split(',') if user]])
+
+    def _dispatch_history(self, received_message: str):
+        peer_username, sequence, record = received_message.split(';', 2)
+        records = self.history_pages.setdefault(peer_username, [])
+
+        if sequence == 'end':
+            del self.history_pages[peer_username]
+            return self.emit('history', [peer_username, records, int(record)], peer_username)
+
+        timestamp, author, message = record.split(';', 2)
+        records.append((int(sequence), int(timestamp) / 1000, author, message))
 
 
 class Client:
     def __init__(self, host: str, chat_port: int, file_transfer_port: int, username: str, **kwargs):
-        self.emitter = ClientEventEmitter(self)
-        self.list_executor = IntervalExecutor(kwargs.get('list_interval') or DEFAULT_LIST_INTERVAL, self.request_list)
+        self.emitter = ClientEventEmitter(self, kwargs.get('dispatch') or DEFAULT_DISPATCH, workers=kwargs.get('dispatch_workers'))
+        self.list_interval = kwargs.get('list_interval') or DEFAULT_LIST_INTERVAL
+        self.list_executor = IntervalExecutor(self.list_interval, self.request_list)
 
         self.host = host
         self.chat_port = chat_port
@@ -66,6 +112,19 @@ class Client:
 
         self.socket = None
         self.buf_size = kwargs.get('buffer_size') or DEFAULT_BUFFER_SIZE
+        self.tcp_nodelay = kwargs.get('tcp_nodelay', DEFAULT_TCP_NODELAY)
+        self.send_buffer_size = kwargs.get('send_buffer_size')
+        self.receive_buffer_size = kwargs.get('receive_buffer_size')
+        self.use_sendfile = kwargs.get('use_sendfile', True)
+        self.transfer_chunk_size = kwargs.get('transfer_chunk_size')
+        self.download_connections = kwargs.get('download_connections')
+        self.compression = kwargs.get('compression')
+        self.chat_compression = kwargs.get('chat_compression')
+        self.reader = FrameReader(compression_codecs=(self.chat_compression,) if self.chat_compression else ())
+        self.pending_frames = deque()
+
+        self.compressor = None
+        self.send_lock = RLock()
 
         self.file_transfer_uploader = None
         self.file_transfer_downloader = None
@@ -74,13 +133,26 @@ class Client:
 
     def connect(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay))
+
+        if self.send_buffer_size:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        if self.receive_buffer_size:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+
         self.socket.connect((self.host, self.chat_port))
 
         self._set_username()
 
+        if self.chat_compression:
+            self._enable_compression()
+
         self._register_events()
         self.emitter.start()
-        self.list_executor.start()
+        self.subscribe_to_presence()
+
+        if self.list_interval > 0:
+            self.list_executor.start()
 
     def connect_to_user(self, username: str):
         return self.send_to_socket(TAG_CMD, f'connect {username}')
@@ -88,6 +160,15 @@ class Client:
     def disconnect_from_user(self, username: str):
         return self.send_to_socket(TAG_CMD, f'disconnect {username}')
 
+    def join_room(self, room: str):
+        return self.send_to_socket(TAG_CMD, f'join {room}')
+
+    def leave_room(self, room: str):
+        return self.send_to_socket(TAG_CMD, f'leave {room}')
+
+    def request_history(self, peer_username: str, before: int = 0, count: int = DEFAULT_HISTORY_PAGE_SIZE):
+        return self.send_to_socket(TAG_CMD, f'history {peer_username} {before} {count}')
+
     def send_exit(self):
         return self.send_to_socket(TAG_CMD, 'exit')
 
@@ -97,8 +178,11 @@ class Client:
     def request_list(self):
         return self.send_to_socket(TAG_CMD, 'list')
 
+    def subscribe_to_presence(self):
+        return self.send_to_socket(TAG_CMD, 'subscribe')
+
     def send_file(self, destination_user: str, filename: str, file_path: str):
-        self.file_transfer_uploader = FileTransferUploader(self.username, destination_user, self.host, self.file_transfer_port, buffer_size=self.buf_size)
+        self.file_transfer_uploader = FileTransferUploader(self.username, destination_user, self.host, self.file_transfer_port, buffer_size=self.buf_size, transfer_chunk_size=self.transfer_chunk_size, use_sendfile=self.use_sendfile, compression=self.compression)
         self.file_transfer_uploader.set_file_data(filename, file_path)
         self.file_transfer_uploader.start()
 
@@ -107,26 +191,57 @@ class Client:
 
     def _set_username(self):
         self.send_to_socket(TAG_CFG, f'set_username {self.username}')
-        username_response = self.receive_from_socket()
-        tag, username_response = self.parse_received_message(username_response)
+        tag, username_response = self.receive_from_socket()
 
         if tag == TAG_ERR:
             print(username_response)
             self.socket.close()
             sys.exit(1)
 
+    def _enable_compression(self):
+        command = get_compression_command(self.chat_compression)
+        self.send_to_socket(TAG_CFG, command)
+
+        # Nothing else is sent until the server answers, so both sides switch at the same point of the stream.
+        skipped_frames = []
+        while True:
+            tag, response = self.receive_from_socket()
+
+            if tag == TAG_CFG or tag == TAG_ERR:
+                break
+
+            skipped_frames.append((tag, response))
+
+        self.pending_frames.extendleft(reversed(skipped_frames))
+
+        if tag == TAG_CFG and response == command:
+            self.compressor = FrameCompressor(self.chat_compression)
+            print(f'[CLIENT]: Compressing chat traffic with {self.chat_compression}.')
+        else:
+            print(f'[CLIENT]: The server refused compression: {response}')
+
     def _register_events(self):
         self.emitter.on('message', self._handle_message)
+        self.emitter.on('room_message', self._handle_room_message)
         self.emitter.on('error', self._handle_error)
         self.emitter.on('config', self._handle_config)
         self.emitter.on('command', self._handle_command)
         self.emitter.on('list', self._handle_list)
+        self.emitter.on('history', self._handle_history)
+        self.emitter.on('ping', self._handle_ping)
         self.emitter.on('file', self._handle_file)
 
+    def _handle_ping(self):
+        self.send_to_socket(TAG_CMD, PONG)
+
     @staticmethod
     def _handle_message(author: str, message: str):
         print(f'[SERVER]: {author} said: {message}')
 
+    @staticmethod
+    def _handle_room_message(room: str, author: str, message: str):
+        print(f'[SERVER]: {author} said in {room}: {message}')
+
     @staticmethod
     def _handle_error(error: str):
         print(f'[SERVER]: Oops! Something happened: {error}')
@@ -143,34 +258,70 @@ class Client:
     def _handle_list(user_list: str):
         print(f'[SERVER]: Users online: {user_list}')
 
+    @staticmethod
+    def _handle_history(peer_username: str, records: list, next_before: int):
+        print(f'[SERVER]: Received {len(records)} history messages with {peer_username}')
+
     def _handle_file(self, file_header: str):
         header_split = file_header.split(';')
 
         source_user = header_split[0]
         filename = header_split[1]
         file_size = int(header_split[2])
+        file_id = header_split[3]
+        relayed = len(header_split) > 4 and header_split[4] == 'relay'
 
         print(f'[SERVER]: User {source_user} has sent the file {filename}')
-        self.file_transfer_downloader = FileTransferDownloader(filename, file_size, self.host, self.file_transfer_port, buffer_size=self.buf_size)
+        self.download_file(filename, file_size, file_id, relayed)
+
+    def download_file(self, filename: str, file_size: int, file_id: str, relayed: bool = False):
+        self.file_transfer_downloader = FileTransferDownloader(
+            filename,
+            file_size,
+            file_id,
+            self.host,
+            self.file_transfer_port,
+            buffer_size=self.buf_size,
+            transfer_chunk_size=self.transfer_chunk_size,
+            connections=self.download_connections,
+            compression=self.compression,
+            relayed=relayed
+        )
         self.file_transfer_downloader.set_on_finished(self.on_file_downloaded)
         self.file_transfer_downloader.start()
 
-    def receive_from_socket(self) -> str:
+    def receive_from_socket(self) -> tuple:
         if self.socket is None:
             raise Exception('No socket connection is available to this client.')
 
-        data = self.socket.recv(self.buf_size)
+        while not self.pending_frames:
+            data = self.socket.recv(self.buf_size)
+
+            if not data:
+                raise Exception('No data received on socket. Was the connection interrupted?')
 
-        if not data:
-            raise Exception('No data received on socket. Was the connection interrupted?')
+            self.pending_frames.extend(self.reader.feed(data))
 
-        return data.decode('ASCII')
+        return self.pending_frames.popleft()
 
     def send_to_socket(self, tag: str, message: str):
         if self.socket is None:
             raise Exception('No socket connection is available to this client.')
 
-        self.socket.sendall(f'{tag}|{message}'.encode('ASCII'))
+        self._send(encode_frame(tag, message))
+
+    def send_many_to_socket(self, frames: list):
+        if self.socket is None:
+            raise Exception('No socket connection is available to this client.')
+
+        self._send(encode_frames(frames))
+
+    def _send(self, data: bytes):
+        with self.send_lock:
+            if self.compressor is not None:
+                data = self.compressor.compress(data)
+
+            self.socket.sendall(data)
 
     @staticmethod
     def parse_received_message(received_message: str, separator='|'):
@@ -0,0 +1,68 @@
+import lzma
+import zlib
+
+CODEC_NONE = ''
+CODEC_ZLIB = 'zlib'
+CODEC_LZMA = 'lzma'
+CODECS = (CODEC_ZLIB, CODEC_LZMA)
+
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1
+
+SAMPLE_SIZE = 64 * 1024
+MIN_SAMPLE_SIZE = 1024
+MAX_COMPRESSED_RATIO = 0.9
+
+
+def negotiate_codec(requested: str) -> str:
+    return requested if requested in CODECS else CODEC_NONE
+
+
+def is_compressible(sample: bytes) -> bool:
+    if len(sample) < MIN_SAMPLE_SIZE:
+        return False
+
+    # A fast zlib pass is enough to spot images and archives, whatever codec ends up being used.
+    return len(zlib.compress(sample, 1)) < len(sample) * MAX_COMPRESSED_RATIO
+
+
+def create_compressor(codec: str):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(ZLIB_LEVEL)
+    if codec == CODEC_LZMA:
+        return lzma.LZMACompressor(preset=LZMA_PRESET)
+
+    raise Exception(f'Unknown compression codec {codec}.')
+
+
+def create_decompressor(codec: str):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+
+    raise Exception(f'Unknown compression codec {codec}.')
+
+
+def send_compressed(file, send, count: int, codec: str, chunk_size: int) -> int:
+    compressor = create_compressor(codec)
+    remaining = count
+    sent = 0
+
+    while remaining > 0:
+        part_content = file.read(min(chunk_size, remaining))
+
+        if len(part_content) == 0:
+            break
+
+        remaining -= len(part_content)
+        compressed = compressor.compress(part_content)
+
+        if compressed:
+            send(compressed)
+            sent += len(compressed)
+
+    compressed = compressor.flush()
+    send(compressed)
+
+    return sent + len(compressed)
@@ -1,13 +1,44 @@
 import socket
 import os
+import time
+import hashlib
 from pathlib import Path
 from threading import Thread
+from .compression import CODEC_NONE, SAMPLE_SIZE, is_compressible, create_decompressor, send_compressed
 
 DEFAULT_BUFFER_SIZE = 1024
+DEFAULT_TRANSFER_CHUNK_SIZE = 64 * 1024
+DEFAULT_DOWNLOAD_CONNECTIONS = 1
+
+PROGRESS_SAVE_INTERVAL = 1
+
+HASH_ALGORITHM = 'sha256'
 
 DOWNLOADS_FOLDER = os.path.abspath(f'{Path.home()}/Downloads')
 
 
+def hash_file(file_path: str, chunk_size: int = DEFAULT_TRANSFER_CHUNK_SIZE) -> str:
+    hasher = hashlib.new(HASH_ALGORITHM)
+
+    with open(file_path, 'rb') as file:
+        while True:
+            part_content = file.read(chunk_size)
+
+            if len(part_content) == 0:
+                break
+
+            hasher.update(part_content)
+
+    return hasher.hexdigest()
+
+
+def format_throughput(byte_count: int, elapsed: float) -> str:
+    megabytes = byte_count / (1024 * 1024)
+    rate = megabytes / elapsed if elapsed > 0 else float('inf')
+
+    return f'Transferred {megabytes:.2f} MiB in {elapsed:.3f}s ({rate:.2f} MiB/s)'
+
+
 class FileTransferUploader(Thread):
     def __init__(self, source_user: str, destination_user: str, host: str, port: int, **kwargs):
         Thread.__init__(self)
@@ -22,30 +53,70 @@ class FileTransferUploader(Thread):
         self.file_path = ''
 
         self.socket = None
+        self.pending = bytearray()
         self.buf_size = kwargs.get('buffer_size') or DEFAULT_BUFFER_SIZE
+        self.transfer_chunk_size = kwargs.get('transfer_chunk_size') or DEFAULT_TRANSFER_CHUNK_SIZE
+        self.use_sendfile = kwargs.get('use_sendfile', True)
+        self.compression = kwargs.get('compression') or CODEC_NONE
+        self.codec = CODEC_NONE
 
     def run(self):
-        self.connect()
         file_size = os.path.getsize(self.file_path)
+        content_hash = self.hash_file()
 
-        self.send_upload_header(file_size)
+        self.connect()
 
-        uploaded = 0
+        if not self.send_upload_header(file_size, content_hash, self.choose_codec()):
+            print(f'[FILETRANSFER UPLOADER]: Server already has this file, skipped the transfer.')
+            self.disconnect()
+            return
+
+        use_sendfile = not self.codec and self.use_sendfile and hasattr(os, 'sendfile')
+        started_at = time.monotonic()
 
         with open(self.file_path, 'rb') as file:
-            while True:
-                part_content = file.read(self.buf_size)
+            if self.codec:
+                uploaded = send_compressed(file, self.send_part, file_size, self.codec, self.transfer_chunk_size)
+            elif use_sendfile:
+                uploaded = self.socket.sendfile(file)
+            else:
+                uploaded = self.send_file_buffered(file, file_size)
+
+        print(f'[FILETRANSFER UPLOADER]: {format_throughput(uploaded, time.monotonic() - started_at)} using {self.codec or ("sendfile" if use_sendfile else "buffered copy")}.')
+        print(f'[FILETRANSFER UPLOADER]: File transfer completed, disconnecting...')
+        self.disconnect()
 
-                if len(part_content) == 0:
-                    break
+    def send_file_buffered(self, file, file_size: int) -> int:
+        uploaded = 0
 
-                self.send_part(part_content)
+        while True:
+            part_content = file.read(self.transfer_chunk_size)
 
-                uploaded += self.buf_size
-                print(f'[FILETRANSFER UPLOADER]: Transferred {int(100 * uploaded / file_size)}%')
+            if len(part_content) == 0:
+                break
 
-        print(f'[FILETRANSFER UPLOADER]: File transfer completed, disconnecting...')
-        self.disconnect()
+            self.send_part(part_content)
+
+            uploaded += len(part_content)
+            print(f'[FILETRANSFER UPLOADER]: Transferred {int(100 * uploaded / file_size)}%')
+
+        return uploaded
+
+    def choose_codec(self) -> str:
+        if not self.compression:
+            return CODEC_NONE
+
+        with open(self.file_path, 'rb') as file:
+            sample = file.read(SAMPLE_SIZE)
+
+        if not is_compressible(sample):
+            print(f'[FILETRANSFER UPLOADER]: File does not compress, uploading it without {self.compression}.')
+            return CODEC_NONE
+
+        return self.compression
+
+    def hash_file(self) -> str:
+        return hash_file(self.file_path, self.transfer_chunk_size)
 
     def set_file_data(self, filename: str, file_path: str):
         self.filename = filename
@@ -63,8 +134,8 @@ class FileTransferUploader(Thread):
 
         print('[FILETRANSFER UPLOADER]: Disconnected from file transfer server.')
 
-    def send_upload_header(self, file_size: int):
-        header = f'UP;{self.source_user};{self.destination_user};{self.filename};{file_size}'
+    def send_upload_header(self, file_size: int, content_hash: str, codec: str = CODEC_NONE) -> bool:
+        header = f'UP;{self.source_user};{self.destination_user};{self.filename};{file_size};;;{content_hash};{codec}'
         self.send_message(header)
         print(f'[FILETRANSFER UPLOADER]: Sent upload header: {header}')
 
@@ -73,7 +144,14 @@ class FileTransferUploader(Thread):
         if response == 'ERROR':
             raise Exception('The server refused to receive a file.')
 
+        if response == 'EXISTS':
+            return False
+
+        # The server answers OK;<codec> when it accepted compression, a bare OK means raw bytes.
+        _, _, self.codec = response.partition(';')
+
         print(f'[FILETRANSFER UPLOADER]: Server accepted upload operation. Uploading...')
+        return True
 
     def send_part(self, part_content: bytes):
         if self.socket is None:
@@ -85,71 +163,178 @@ class FileTransferUploader(Thread):
         if self.socket is None:
             raise Exception('No socket connection is available to this file uploader.')
 
-        self.socket.sendall(message.encode('ASCII'))
+        self.socket.sendall(f'{message}\n'.encode('ASCII'))
 
     def receive_message(self) -> str:
         if self.socket is None:
             raise Exception('No socket connection is available to this file uploader.')
 
-        data = self.socket.recv(self.buf_size)
+        while b'\n' not in self.pending:
+            data = self.socket.recv(self.buf_size)
+
+            if not data:
+                raise Exception('No data received on socket. Was the connection interrupted?')
 
-        if not data:
-            raise Exception('No data received on socket. Was the connection interrupted?')
+            self.pending += data
 
-        return data.decode('ASCII')
+        message, _, self.pending = self.pending.partition(b'\n')
+        return message.decode('ASCII')
 
 
 class FileTransferDownloader(Thread):
-    def __init__(self, filename: str, file_size: int, host: str, port: int, **kwargs):
+    def __init__(self, filename: str, file_size: int, file_id: str, host: str, port: int, **kwargs):
         Thread.__init__(self)
         self.daemon = True
 
         self.filename = filename
         self.file_size = file_size
+        self.file_id = file_id
 
         self.host = host
         self.port = port
 
-        self.socket = None
         self.buf_size = kwargs.get('buffer_size') or DEFAULT_BUFFER_SIZE
+        self.transfer_chunk_size = kwargs.get('transfer_chunk_size') or DEFAULT_TRANSFER_CHUNK_SIZE
+        self.relayed = kwargs.get('relayed', False)
+        self.compression = kwargs.get('compression') or CODEC_NONE
+        self.connections = 1 if self.relayed else kwargs.get('connections') or DEFAULT_DOWNLOAD_CONNECTIONS
+
+        self.file_path = os.path.abspath(f'{DOWNLOADS_FOLDER}/{self.filename}')
+        self.part_path = f'{self.file_path}.part'
+        self.progress_path = f'{self.file_path}.part.progress'
 
+        self.ranges = []
         self.on_finished = None
 
     def run(self):
-        self.connect()
-        self.send_download_header()
+        # A relayed file only exists while it streams through the server, so it cannot be resumed.
+        self.ranges = [] if self.relayed else self.load_progress()
 
-        file_path = os.path.abspath(f'{DOWNLOADS_FOLDER}/{self.filename}')
-        downloaded = 0
+        if not self.ranges:
+            self.ranges = self.split_ranges()
 
-        with open(file_path, 'wb') as file:
-            while True:
-                received_part = self.receive_part()
+            # Without matching progress nothing in a leftover part file can be trusted, not even its length.
+            with open(self.part_path, 'wb') as file:
+                file.truncate(self.file_size)
 
-                if received_part is None or len(received_part) == 0:
-                    break
+            if os.path.exists(self.progress_path):
+                os.remove(self.progress_path)
 
-                file.write(received_part)
+        started_at = time.monotonic()
+        resumed = sum(file_range.done for file_range in self.ranges)
 
-                downloaded += self.buf_size
-                print(f'[FILETRANSFER DOWNLOADER]: Downloaded {int(100 * downloaded / self.file_size)}%')
+        if resumed > 0:
+            print(f'[FILETRANSFER DOWNLOADER]: Resuming {self.filename} from {resumed} of {self.file_size} bytes.')
 
-        print(f'[FILETRANSFER DOWNLOADER]: File available at: {file_path}')
-        print(f'[FILETRANSFER DOWNLOADER]: Download finished. Disconnecting...')
+        workers = [file_range for file_range in self.ranges if file_range.remaining() > 0]
+        for worker in workers:
+            worker.start()
 
-        self.disconnect()
+        alive_workers = workers
+        while alive_workers:
+            alive_workers[0].join(PROGRESS_SAVE_INTERVAL)
+            self.save_progress()
+
+            alive_workers = [worker for worker in alive_workers if worker.is_alive()]
+
+        if any(worker.error is not None for worker in workers):
+            print(f'[FILETRANSFER DOWNLOADER]: Download interrupted, partial file kept at {self.part_path}')
+            return
+
+        os.replace(self.part_path, self.file_path)
+
+        # An empty file starts no workers, so no progress was ever saved for it.
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+        downloaded = self.file_size - resumed
+        print(f'[FILETRANSFER DOWNLOADER]: {format_throughput(downloaded, time.monotonic() - started_at)} over {len(workers)} connection(s).')
+        print(f'[FILETRANSFER DOWNLOADER]: File available at: {self.file_path}')
+        print(f'[FILETRANSFER DOWNLOADER]: Download finished.')
 
         if self.on_finished is not None:
-            self.on_finished(file_path)
+            self.on_finished(self.file_path)
 
     def set_on_finished(self, on_finished):
         self.on_finished = on_finished
 
+    def split_ranges(self) -> list:
+        connections = max(1, min(self.connections, self.file_size // self.transfer_chunk_size))
+        range_size = -(-self.file_size // connections)
+
+        return [
+            FileRangeDownloader(self, start, min(start + range_size, self.file_size), 0)
+            for start in range(0, max(self.file_size, 1), range_size or 1)
+        ]
+
+    def load_progress(self) -> list:
+        if not os.path.exists(self.part_path) or not os.path.exists(self.progress_path):
+            return []
+
+        with open(self.progress_path, 'r') as progress_file:
+            lines = progress_file.read().split('\n')
+
+        if len(lines) < 2 or lines[0] != f'{self.file_size} {self.file_id}':
+            return []
+
+        ranges = []
+        for line in lines[1:]:
+            if not line:
+                continue
+
+            start, end, done = map(int, line.split(' '))
+            ranges.append(FileRangeDownloader(self, start, end, done))
+
+        return ranges
+
+    def save_progress(self):
+        lines = [f'{self.file_size} {self.file_id}']
+        lines.extend(f'{file_range.start_offset} {file_range.end_offset} {file_range.done}' for file_range in self.ranges)
+
+        with open(self.progress_path, 'w') as progress_file:
+            progress_file.write('\n'.join(lines))
+
+
+class FileRangeDownloader(Thread):
+    def __init__(self, downloader: FileTransferDownloader, start: int, end: int, done: int):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.downloader = downloader
+        self.start_offset = start
+        self.end_offset = end
+        self.done = done
+
+        self.socket = None
+        self.pending = bytearray()
+        self.codec = CODEC_NONE
+        self.error = None
+
+    def remaining(self) -> int:
+        return self.end_offset - self.start_offset - self.done
+
+    def run(self):
+        try:
+            self.connect()
+            offset = self.start_offset + self.done
+            length = self.send_download_header(offset, self.remaining())
+
+            with open(self.downloader.part_path, 'r+b', buffering=0) as file:
+                file.seek(offset)
+                self.receive_file(file, length)
+
+        except BaseException as error:
+            self.error = error
+            print(f'[FILETRANSFER DOWNLOADER]: Range {self.start_offset}-{self.end_offset} failed: {error}')
+
+        if self.socket is not None:
+            self.disconnect()
+
     def connect(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
+        self.socket.connect((self.downloader.host, self.downloader.port))
 
-        print(f'[FILETRANSFER DOWNLOADER]: Connected to file transfer server at {self.host}:{self.port}')
+        print(f'[FILETRANSFER DOWNLOADER]: Connected to file transfer server at {self.downloader.host}:{self.downloader.port}')
 
     def disconnect(self):
         self.socket.close()
@@ -157,8 +342,8 @@ class FileTransferDownloader(Thread):
 
         print('[FILETRANSFER DOWNLOADER]: Disconnected from file transfer server.')
 
-    def send_download_header(self):
-        header = f'DOWN;;;{self.filename};'
+    def send_download_header(self, offset: int, length: int) -> int:
+        header = f'DOWN;;;{self.downloader.file_id};;{offset};{length};;{self.downloader.compression}'
         self.send_message(header)
         print(f'[FILETRANSFER DOWNLOADER]: Sent download header: {header}')
 
@@ -167,27 +352,95 @@ class FileTransferDownloader(Thread):
         if response == 'ERROR':
             raise Exception('The server refused to send a file.')
 
+        fields = response.split(';')
+        length = fields[1]
+        self.codec = fields[2] if len(fields) > 2 else CODEC_NONE
+
         print(f'[FILETRANSFER DOWNLOADER]: Server accepted download operation. Downloading...')
+        return int(length)
 
-    def receive_part(self) -> bytes:
+    def receive_file(self, file, file_size: int) -> int:
         if self.socket is None:
             raise Exception('No socket connection is available to this file downloader.')
 
-        return self.socket.recv(self.buf_size)
+        if self.codec:
+            return self.receive_compressed_file(file, file_size)
+
+        chunk_size = self.downloader.transfer_chunk_size
+        buffer = memoryview(bytearray(chunk_size))
+        received = 0
+
+        if self.pending:
+            received = file.write(self.pending[:file_size])
+            self.pending = bytearray()
+            self.done += received
+
+        while received < file_size:
+            count = self.socket.recv_into(buffer, min(chunk_size, file_size - received))
+
+            if count == 0:
+                raise Exception(f'Connection closed after receiving {received} of {file_size} bytes.')
+
+            file.write(buffer[:count])
+
+            received += count
+            self.done += count
+            print(f'[FILETRANSFER DOWNLOADER]: Downloaded {int(100 * received / file_size)}%')
+
+        return received
+
+    def receive_compressed_file(self, file, file_size: int) -> int:
+        decompressor = create_decompressor(self.codec)
+        buffer = memoryview(bytearray(self.downloader.transfer_chunk_size))
+        received = 0
+
+        data = bytes(self.pending)
+        self.pending = bytearray()
+
+        while not decompressor.eof:
+            if not data:
+                count = self.socket.recv_into(buffer)
+
+                if count == 0:
+                    raise Exception(f'Connection closed after receiving {received} of {file_size} bytes.')
+
+                data = buffer[:count]
+
+            # Never inflates more than one byte past the announced size, a small download cannot expand into gigabytes.
+            part_content = decompressor.decompress(data, file_size - received + 1)
+            data = b''
+
+            if received + len(part_content) > file_size:
+                raise Exception(f'Decompressed content is larger than the announced {file_size} bytes.')
+
+            file.write(part_content)
+
+            received += len(part_content)
+            self.done += len(part_content)
+            print(f'[FILETRANSFER DOWNLOADER]: Downloaded {int(100 * received / max(file_size, 1))}% using {self.codec}')
+
+        if received != file_size:
+            raise Exception(f'Compressed stream ended after {received} of {file_size} bytes.')
+
+        return received
 
     def send_message(self, message: str):
         if self.socket is None:
-            raise Exception('No socket connection is available to this file uploader.')
+            raise Exception('No socket connection is available to this file downloader.')
 
-        self.socket.sendall(message.encode('ASCII'))
+        self.socket.sendall(f'{message}\n'.encode('ASCII'))
 
     def receive_message(self) -> str:
         if self.socket is None:
-            raise Exception('No socket connection is available to this file uploader.')
+            raise Exception('No socket connection is available to this file downloader.')
+
+        while b'\n' not in self.pending:
+            data = self.socket.recv(self.downloader.buf_size)
 
-        data = self.socket.recv(self.buf_size)
+            if not data:
+                raise Exception('No data received on socket. Was the connection interrupted?')
 
-        if not data:
-            raise Exception('No data received on socket. Was the connection interrupted?')
+            self.pending += data
 
-        return data.decode('ASCII')
+        message, _, self.pending = self.pending.partition(b'\n')
+        return message.decode('ASCII')
@@ -0,0 +1,138 @@
+import struct
+import zlib
+
+DEFAULT_MAX_FRAME_SIZE = 1024 * 1024
+DEFAULT_MAX_INFLATE_SIZE = 16 * DEFAULT_MAX_FRAME_SIZE  # decompressed bytes allowed out of one received chunk
+
+FRAME_HEADER = struct.Struct('!IB')  # payload length, tag code
+
+TAG_CODES = {
+    'MSG': 1,
+    'ERR': 2,
+    'CFG': 3,
+    'CMD': 4,
+    'LIST': 5,
+    'FILE': 6,
+    'PRES': 7,
+    'STATS': 8,
+    'BUS': 9,
+    'HIST': 10
+}
+CODE_TAGS = {code: tag for tag, code in TAG_CODES.items()}
+
+# A CFG|compress <codec> frame is the last uncompressed frame in its direction, everything after it is a zlib stream.
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_CODECS = (COMPRESSION_ZLIB,)
+COMPRESSION_COMMAND = 'compress '
+COMPRESSION_LEVEL = 6
+
+# zlib favours the end of the dictionary, so the most frequent strings go last.
+PRESET_DICTIONARY = ''.join((
+    'Invalid CMD message sent.', 'Invalid CFG message sent.', 'Message sent with an invalid tag.',
+    'Badly constructed message.', 'Username already in use.', 'Username not found.',
+    'You cannot chat with yourself.', 'You are not in #', 'You are not chatting with ',
+    'set_username ', 'unsubscribe', 'subscribe', 'stats', 'list', 'exit', 'join #', 'leave #',
+    'disconnect ', 'connect ', 'SUCCESS', ';=', ';-', ';+', ';#'
+)).encode('UTF-8')
+
+
+def get_compression_command(codec: str) -> str:
+    return f'{COMPRESSION_COMMAND}{codec}'
+
+
+def encode_frame(tag: str, message: str) -> bytes:
+    code = TAG_CODES.get(tag)
+
+    if code is None:
+        raise Exception(f'Cannot encode a frame with the unknown tag {tag}.')
+
+    payload = message.encode('UTF-8')
+    return FRAME_HEADER.pack(len(payload), code) + payload
+
+
+def encode_frames(frames: list) -> bytes:
+    return b''.join(encode_frame(tag, message) for tag, message in frames)
+
+
+class FrameCompressor:
+    def __init__(self, codec: str):
+        if codec not in COMPRESSION_CODECS:
+            raise Exception(f'Unknown compression codec {codec}.')
+
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=PRESET_DICTIONARY)
+
+    def compress(self, data: bytes) -> bytes:
+        # A sync flush per write keeps the receiver able to decode everything sent so far.
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class FrameReader:
+    def __init__(self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE, compression_codecs: tuple = (), max_inflate_size: int = DEFAULT_MAX_INFLATE_SIZE):
+        self.max_frame_size = max_frame_size
+        self.compression_codecs = compression_codecs
+        self.max_inflate_size = max_inflate_size
+        self.decompressor = None
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        frames = []
+
+        if self.decompressor is None:
+            self.buffer += data
+            data = self._read_frames(frames)
+
+        if self.decompressor is not None:
+            self._inflate(data, frames)
+
+        return frames
+
+    def _inflate(self, data: bytes, frames: list):
+        inflated = 0
+
+        # At most one frame's worth is inflated at a time and parsed before the next, the buffer never holds a whole bomb.
+        while True:
+            part = self.decompressor.decompress(data, self.max_frame_size)
+            data = self.decompressor.unconsumed_tail
+
+            inflated += len(part)
+            if inflated > self.max_inflate_size:
+                raise Exception(f'Compressed data expanded past {self.max_inflate_size} bytes.')
+
+            self.buffer += part
+            self._read_frames(frames)
+
+            if not data and len(part) < self.max_frame_size:
+                break
+
+    def _read_frames(self, frames: list) -> bytes:
+        offset = 0
+        available = len(self.buffer)
+
+        while available - offset >= FRAME_HEADER.size:
+            length, code = FRAME_HEADER.unpack_from(self.buffer, offset)
+
+            if length > self.max_frame_size:
+                raise Exception(f'Received a frame of {length} bytes, larger than the allowed {self.max_frame_size}.')
+
+            start = offset + FRAME_HEADER.size
+            end = start + length
+
+            if end > available:
+                break
+
+            tag, message = CODE_TAGS.get(code), self.buffer[start:end].decode('UTF-8')
+            frames.append((tag, message))
+            offset = end
+
+            if self.decompressor is None and tag == 'CFG' and message.startswith(COMPRESSION_COMMAND):
+                if message[len(COMPRESSION_COMMAND):] in self.compression_codecs:
+                    # Whatever follows is compressed, it is handed back to be inflated.
+                    compressed = bytes(self.buffer[offset:])
+                    self.buffer = bytearray()
+                    self.decompressor = zlib.decompressobj(zdict=PRESET_DICTIONARY)
+                    return compressed
+
+        if offset:
+            del self.buffer[:offset]
+
+        return b''
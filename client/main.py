@@ -1,5 +1,9 @@
+import os
 import sys
-from chat.client import Client
+from chat.client import Client, DEFAULT_TCP_NODELAY
+from chat.compression import CODEC_NONE, CODECS
+from chat.filetransfer import DEFAULT_TRANSFER_CHUNK_SIZE, DEFAULT_DOWNLOAD_CONNECTIONS
+from chat.framing import COMPRESSION_CODECS
 from ui.chat_interface import ChatInterface
 from tkinter import *
 
@@ -29,9 +33,28 @@ def main():
         print('Please include your username: python main.py <host> <chat_port> <file_transfer_port> <username>')
         sys.exit(1)
 
+    options = {
+        'tcp_nodelay': os.getenv('TCP_NODELAY', '1' if DEFAULT_TCP_NODELAY else '0') != '0',
+        'send_buffer_size': int(os.getenv('SOCKET_SEND_BUFFER') or 0),
+        'receive_buffer_size': int(os.getenv('SOCKET_RECEIVE_BUFFER') or 0),
+        'use_sendfile': os.getenv('USE_SENDFILE', '1') != '0',
+        'transfer_chunk_size': int(os.getenv('TRANSFER_CHUNK_SIZE') or DEFAULT_TRANSFER_CHUNK_SIZE),
+        'download_connections': int(os.getenv('DOWNLOAD_CONNECTIONS') or DEFAULT_DOWNLOAD_CONNECTIONS),
+        'compression': os.getenv('COMPRESSION') or CODEC_NONE,
+        'chat_compression': os.getenv('CHAT_COMPRESSION') or None
+    }
+
+    if options.get('compression') and options.get('compression') not in CODECS:
+        print(f'Unknown file compression codec {options.get("compression")}, use one of: {", ".join(CODECS)}')
+        sys.exit(1)
+
+    if options.get('chat_compression') and options.get('chat_compression') not in COMPRESSION_CODECS:
+        print(f'Unknown chat compression codec {options.get("chat_compression")}, use one of: {", ".join(COMPRESSION_CODECS)}')
+        sys.exit(1)
+
     print('Starting client...')
 
-    client = Client(host, int(chat_port), int(file_transfer_port), username)
+    client = Client(host, int(chat_port), int(file_transfer_port), username, **options)
     client.connect()
 
     root = Tk()
@@ -1,14 +1,26 @@
+from bisect import bisect_left
+from collections import deque
 from tkinter import *
 from tkinter import ttk, messagebox
 from .chat_window import ChatWindow
 
+UI_REFRESH_INTERVAL = 16  # ms, about one frame
+MAX_UI_EVENTS_PER_REFRESH = 1000
+
 
 class ChatInterface:
     def __init__(self, root, client):
+        self.root = root
         self.client = client
 
+        # Emitter events arrive on the socket thread, Tk is only touched from the main loop when they are drained.
+        self.ui_events = deque()
+
         self.chat_windows = dict()  # peer_username -> ChatWindow
 
+        self.online_users = []  # sorted, mirrors user_listbox
+        self.presence_version = None
+
         # Window
         root.title(f"Async Chat - {self.client.username}")
 
@@ -24,8 +36,7 @@ class ChatInterface:
         user_greetings_label.text = user_greeting  # prevents garbage collection
 
         # Online User List
-        self.user_list = StringVar()
-        self.user_listbox = Listbox(self.mainframe, height=10, listvariable=self.user_list)
+        self.user_listbox = Listbox(self.mainframe, height=10)
 
         # Start Chat Button
         start_chat_btn = ttk.Button(self.mainframe, text="Start Chat", command=self._on_start_chat)
@@ -40,41 +51,107 @@ class ChatInterface:
         refresh_list_btn.grid(column=1, row=2, padx=(0, 15), pady=(3, 10))
 
         self._register_client_events()
-        self.client.request_list()
+        self.root.after(UI_REFRESH_INTERVAL, self._process_ui_events)
+
+        # The snapshot sent on connect arrived before the handlers above existed.
+        self.client.subscribe_to_presence()
 
     def _register_client_events(self):
-        self.client.emitter.on('list', self._handle_user_list)
-        self.client.emitter.on('message', self._handle_message)
-        self.client.emitter.on('connect', self._handle_connect)
-        self.client.emitter.on('disconnect', self._handle_disconnect)
+        self.client.emitter.on('presence', self._in_ui(self._handle_user_list))
+        self.client.emitter.on('message', self._in_ui(self._handle_message))
+        self.client.emitter.on('connect', self._in_ui(self._handle_connect))
+        self.client.emitter.on('disconnect', self._in_ui(self._handle_disconnect))
+        self.client.emitter.on('history', self._in_ui(self._handle_history))
+
+        self.client.set_on_file_downloaded(self._in_ui(self._on_file_downloaded))
+
+    def _in_ui(self, fn):
+        return lambda *args: self.ui_events.append((fn, args))
+
+    def _process_ui_events(self):
+        for _ in range(min(len(self.ui_events), MAX_UI_EVENTS_PER_REFRESH)):
+            fn, args = self.ui_events.popleft()
+
+            try:
+                fn(*args)
+            except Exception as error:
+                print(f'[CLIENT]: Could not update the interface: {error}')
+
+        # Whatever a burst added to a chatbox is drawn with a single insert.
+        for chat_window in list(self.chat_windows.values()):
+            chat_window.flush()
+
+        self.root.after(UI_REFRESH_INTERVAL, self._process_ui_events)
+
+    def _handle_user_list(self, version: int, operation: str, users: list):
+        if operation == '=':
+            self.presence_version = version
+            self.online_users = [user for user in users if user != self.client.username]
+
+            self.user_listbox.delete(0, END)
+            self.user_listbox.insert(END, *self.online_users)
+
+            # Default to First Item in ListBox
+            self.user_listbox.select_set(0)  # This focus on the first item.
+            self.user_listbox.event_generate("<<ListboxSelect>>")
+            return
 
-        self.client.set_on_file_downloaded(self._on_file_downloaded)
+        if self.presence_version is None or version <= self.presence_version:
+            return
+
+        if version != self.presence_version + 1:
+            # Missed an update, ask the server for a fresh snapshot.
+            self.presence_version = None
+            self.client.subscribe_to_presence()
+            return
+
+        self.presence_version = version
 
-    def _handle_user_list(self, users_online: str):
-        online_list = users_online.split(', ')
-        online_list = filter(lambda u: u != self.client.username, online_list)
-        self.user_list.set(list(online_list))
+        for user in users:
+            if user == self.client.username:
+                continue
 
-        # Default to First Item in ListBox
-        self.user_listbox.select_set(0)  # This focus on the first item.
-        self.user_listbox.event_generate("<<ListboxSelect>>")
+            index = bisect_left(self.online_users, user)
+            is_listed = index < len(self.online_users) and self.online_users[index] == user
+
+            if operation == '+' and not is_listed:
+                self.online_users.insert(index, user)
+                self.user_listbox.insert(index, user)
+            elif operation == '-' and is_listed:
+                del self.online_users[index]
+                self.user_listbox.delete(index)
 
     def _handle_message(self, author: str, message: str):
         chat_window = self.chat_windows.get(author)
 
+        # Messages queued while we were offline come from users nobody opened a window for.
         if chat_window is None:
-            return
+            self.create_chat_window(author)
+            self.client.connect_to_user(author)
+            chat_window = self.chat_windows[author]
 
         chat_window.add_peer_message(message)
 
+    def _handle_history(self, peer_username: str, records: list, next_before: int):
+        chat_window = self.chat_windows.get(peer_username)
+
+        if chat_window is None:
+            return
+
+        chat_window.add_history(records, next_before)
+
     def _handle_connect(self, peer_username: str):
+        if peer_username in self.chat_windows:
+            return
+
         self.create_chat_window(peer_username)
 
     def _handle_disconnect(self, peer_username: str):
         self.destroy_chat_window(peer_username)
 
     def _on_refresh_list(self):
-        self.client.request_list()
+        self.presence_version = None
+        self.client.subscribe_to_presence()
 
     def _on_start_chat(self):
         selection = self.user_listbox.curselection()
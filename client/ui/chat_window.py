@@ -1,4 +1,5 @@
 import os
+from collections import Counter, deque
 from pathlib import Path
 from datetime import datetime
 from tkinter import *
@@ -7,6 +8,9 @@ from PIL import ImageTk, Image
 
 CURRENT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 
+HISTORY_PAGE_SIZE = 50
+MAX_CHATBOX_LINES = 1000
+
 
 class ChatWindow:
     def __init__(self, chat_interface, mainframe, peer_username):
@@ -14,6 +18,13 @@ class ChatWindow:
         self.client = chat_interface.client
         self.peer_username = peer_username
 
+        self.history_before = None  # sequence of the oldest message shown, 0 once the whole history is loaded
+        self.loading_history = False
+        self.history_records = deque()  # (sequence, line count) of the history messages at the top of the chatbox
+
+        self.pending_lines = []
+        self.unpaged_messages = deque(maxlen=HISTORY_PAGE_SIZE)  # peer messages shown before the first history page arrived, it may repeat them
+
         self.window = Toplevel(mainframe)
         self.window.title(f"{self.client.username}: Chatting with {peer_username}")
         self.window.resizable(False, False)
@@ -38,6 +49,7 @@ class ChatWindow:
         self.chatbox = Text(self.window, width=30, height=15, borderwidth=2, relief="groove")
         self.chatbox.insert(END, f"Connected to {peer_username}\n")
         self.chatbox['state'] = 'disabled'
+        self.chatbox['yscrollcommand'] = self._on_chatbox_scroll
 
         # User Entry
         self.user_entry_value = StringVar()
@@ -50,6 +62,7 @@ class ChatWindow:
         send_bt.grid(column=2, row=2, sticky='nsew', padx=(0, 15), pady=(3, 10))
 
         self._register_window_events()
+        self._request_older_history()
 
     def _register_window_events(self):
         self.window.protocol('WM_DELETE_WINDOW', self._close_chat)
@@ -62,13 +75,102 @@ class ChatWindow:
         now = datetime.now()
         now_ts = now.strftime('%H:%M:%S')
 
+        self.pending_lines.append(f'({now_ts}) {message}\n')
+
+    def flush(self):
+        if not self.pending_lines:
+            return
+
+        lines = ''.join(self.pending_lines)
+        self.pending_lines = []
+
         self.chatbox['state'] = 'normal'
-        self.chatbox.insert(END, f'({now_ts}) {message}\n')
+        self.chatbox.insert(END, lines)
+        self._evict_lines()
         self.chatbox['state'] = 'disabled'
 
         self.chatbox.see(END)
 
+    def _evict_lines(self):
+        excess = self._count_lines() - MAX_CHATBOX_LINES
+
+        if excess <= 0:
+            return
+
+        # History messages go whole, and scrolling back up fetches them again from the server.
+        evicted = 0
+        while self.history_records and evicted < excess:
+            sequence, line_count = self.history_records.popleft()
+            evicted += line_count
+            self.history_before = sequence + 1
+
+        self.chatbox.delete('1.0', f'{max(excess, evicted) + 1}.0')
+
+    def _count_lines(self) -> int:
+        return int(self.chatbox.index('end-1c').split('.')[0]) - 1
+
+    def _on_chatbox_scroll(self, first: str, last: str):
+        # Older pages are only fetched once the top of what is already loaded comes into view.
+        if float(first) <= 0:
+            self._request_older_history()
+
+    def _request_older_history(self):
+        if self.loading_history or self.history_before == 0 or self._count_lines() >= MAX_CHATBOX_LINES:
+            return
+
+        self.loading_history = True
+        self.client.request_history(self.peer_username, self.history_before or 0, HISTORY_PAGE_SIZE)
+
+    def add_history(self, records: list, next_before: int):
+        is_first_page = self.history_before is None
+
+        self.history_before = next_before
+        self.loading_history = False
+
+        if is_first_page:
+            records = self._drop_shown_records(records)
+
+        if not records:
+            return
+
+        lines = []
+        for _, timestamp, author, message in records:
+            author = 'Me' if author == self.client.username else author
+            lines.append(f'({datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")}) {author}: {message}\n')
+
+        self.history_records.extendleft((sequence, message.count('\n') + 1) for sequence, _, _, message in reversed(records))
+
+        # The mark sits right after the inserted page, so the lines that were on screen stay there.
+        self.chatbox['state'] = 'normal'
+        self.chatbox.mark_set('history_top', '1.0')
+        self.chatbox.mark_gravity('history_top', RIGHT)
+        self.chatbox.insert('1.0', ''.join(lines))
+        self.chatbox['state'] = 'disabled'
+
+        if is_first_page:
+            self.chatbox.see(END)
+        else:
+            self.chatbox.yview('history_top')
+
+    def _drop_shown_records(self, records: list) -> list:
+        shown = Counter(self.unpaged_messages)
+        self.unpaged_messages.clear()
+
+        kept = []
+        for record in reversed(records):
+            if record[2] == self.peer_username and shown[record[3]] > 0:
+                shown[record[3]] -= 1
+                continue
+
+            kept.append(record)
+
+        kept.reverse()
+        return kept
+
     def add_peer_message(self, message: str):
+        if self.history_before is None:
+            self.unpaged_messages.append(message)
+
         self._append_to_chatbox(f'{self.peer_username}: {message}')
 
     def send_message(self, trigger_event=None):
@@ -1,12 +1,40 @@
-from threading import Thread
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+
+DISPATCH_INLINE = 'inline'
+DISPATCH_POOL = 'pool'
+DISPATCH_ASYNCIO = 'asyncio'
+DISPATCH_MODES = (DISPATCH_INLINE, DISPATCH_POOL, DISPATCH_ASYNCIO)
+
+DEFAULT_DISPATCH_WORKERS = 4
 
 
 class EventEmitter(Thread):
-    def __init__(self):
+    def __init__(self, dispatch: str = DISPATCH_INLINE, **kwargs):
         Thread.__init__(self)
         self.daemon = True
 
+        if dispatch not in DISPATCH_MODES:
+            raise Exception(f'Unknown event dispatch mode {dispatch}.')
+
         self.handlers = dict()
+        self.dispatch = dispatch
+
+        # Pool mode: calls sharing an ordering key run one after another, different keys run in parallel.
+        self.executor = None
+        self.lanes = dict()  # ordering key -> deque of (fn, args)
+        self.lanes_lock = Lock()
+
+        if dispatch == DISPATCH_POOL:
+            self.executor = ThreadPoolExecutor(max_workers=kwargs.get('workers') or DEFAULT_DISPATCH_WORKERS, thread_name_prefix='event')
+
+        self.loop = kwargs.get('loop')
+
+        if dispatch == DISPATCH_ASYNCIO and self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            Thread(target=self.loop.run_forever, daemon=True).start()
 
     def on(self, event: str, fn):
         handlers = self.handlers.get(event)
@@ -19,12 +47,75 @@ class EventEmitter(Thread):
     def off(self, event: str):
         self.handlers[event] = None
 
-    def emit(self, event: str, args: list):
+    def emit(self, event: str, args: list, key: str = None):
         if args is None:
             args = []
 
         handlers = self.handlers.get(event)
 
-        if handlers:
+        if not handlers:
+            return
+
+        if self.dispatch == DISPATCH_INLINE:
             for fn in handlers:
                 fn(*args)
+            return
+
+        if self.dispatch == DISPATCH_ASYNCIO:
+            # call_soon_threadsafe keeps the order events were emitted in.
+            for fn in handlers:
+                self.loop.call_soon_threadsafe(self._call_in_loop, fn, args)
+            return
+
+        self._queue(key or event, [(fn, args) for fn in handlers])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def _queue(self, key: str, calls: list):
+        with self.lanes_lock:
+            lane = self.lanes.get(key)
+
+            if lane is not None:
+                lane.extend(calls)
+                return
+
+            self.lanes[key] = deque(calls)
+
+        self.executor.submit(self._drain, key)
+
+    def _drain(self, key: str):
+        while True:
+            with self.lanes_lock:
+                lane = self.lanes[key]
+
+                if not lane:
+                    del self.lanes[key]
+                    return
+
+                fn, args = lane.popleft()
+
+            self._call(fn, args)
+
+    def _call_in_loop(self, fn, args: list):
+        if asyncio.iscoroutinefunction(fn):
+            task = self.loop.create_task(fn(*args))
+            task.add_done_callback(self._report_task)
+            return
+
+        self._call(fn, args)
+
+    def _report_task(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.report_error(task.exception())
+
+    def _call(self, fn, args: list):
+        try:
+            fn(*args)
+        except Exception as error:
+            self.report_error(error)
+
+    @staticmethod
+    def report_error(error: Exception):
+        print(f'[CLIENT]: An event handler failed: {error}')
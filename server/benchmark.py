@@ -0,0 +1,360 @@
+import os
+import sys
+import time
+import asyncio
+import socket
+import argparse
+import itertools
+import multiprocessing
+from chat.chatserver import ChatServer, TAG_MSG, TAG_CMD, TAG_CFG, TAG_ERR, TAG_FILE, TAG_STATS
+from chat.asyncserver import AsyncChatServer
+from chat.filetransfer import FileTransferServer
+from chat.framing import FrameReader, encode_frame
+from chat.logger import logger
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_CHAT_PORT = 10123
+DEFAULT_FILE_TRANSFER_PORT = 20123
+DEFAULT_CLIENTS = '100,1000'
+DEFAULT_MESSAGES = 20
+DEFAULT_MESSAGE_SIZE = 64
+DEFAULT_TIMEOUT = 60
+DEFAULT_TCP_NODELAY = 'on'
+DEFAULT_COALESCE_DELAYS = '0'
+
+
+def run_server(options: dict):
+    logger.set_level(options.get('log_level'))
+
+    if not options.get('server_log'):
+        logger.stream = open(os.devnull, 'w')
+
+    server_class = AsyncChatServer if options.get('server_mode') == 'async' else ChatServer
+    server = server_class(options.get('chat_port'), max_connections=options.get('max_connections'), **options.get('server_options'))
+    file_transfer_server = FileTransferServer(server, options.get('file_transfer_port'), max_connections=options.get('max_connections'), files_location=options.get('files_location'))
+
+    file_transfer_server.initialize()
+    file_transfer_server.start()
+
+    server.initialize()
+    server.listen_for_connections()
+
+
+def read_rss(pid: int) -> float:
+    try:
+        with open(f'/proc/{pid}/status', 'r') as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return float('nan')
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return float('nan')
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def read_metric(stats: str, name: str) -> float:
+    total = 0
+
+    for line in stats.splitlines():
+        if line.startswith(f'{name} ') or line.startswith(f'{name}{{'):
+            total += float(line.rsplit(' ', 1)[1])
+
+    return total
+
+
+class SimulatedClient:
+    def __init__(self, username: str, results: dict, tcp_nodelay: bool = True):
+        self.username = username
+        self.results = results
+        self.tcp_nodelay = tcp_nodelay
+
+        self.reader = None
+        self.writer = None
+        self.frame_reader = FrameReader()
+
+        self.responses = asyncio.Queue()
+        self.files = asyncio.Queue()
+        self.read_task = None
+
+    async def connect(self, host: str, port: int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay))
+        self.read_task = asyncio.create_task(self.read_loop())
+
+        self.send(TAG_CFG, f'set_username {self.username}')
+        tag, message = await self.responses.get()
+
+        if tag != TAG_CFG:
+            raise Exception(f'Could not set username {self.username}: {message}')
+
+    async def connect_to(self, peer_username: str):
+        self.send(TAG_CMD, f'connect {peer_username}')
+        await self.responses.get()
+
+    async def request_stats(self) -> str:
+        self.send(TAG_CMD, 'stats')
+
+        while True:
+            tag, message = await self.responses.get()
+
+            if tag == TAG_STATS:
+                return message
+
+    async def read_loop(self):
+        while True:
+            data = await self.reader.read(64 * 1024)
+
+            if not data:
+                return
+
+            received_at = time.perf_counter()
+
+            for tag, message in self.frame_reader.feed(data):
+                if tag == TAG_MSG:
+                    sent_at = message.split(';', 2)[1]
+                    self.results['latencies'].append(received_at - float(sent_at))
+                    self.results['received'] += 1
+                    self.results['last_received_at'] = received_at
+
+                    if self.results['received'] >= self.results['expected']:
+                        self.results['done'].set()
+                elif tag == TAG_FILE:
+                    self.files.put_nowait(message)
+                elif tag == TAG_CFG or tag == TAG_ERR or tag == TAG_STATS or message == 'SUCCESS':
+                    self.responses.put_nowait((tag, message))
+
+    def send(self, tag: str, message: str):
+        self.writer.write(encode_frame(tag, message))
+
+    async def close(self):
+        self.writer.close()
+        self.read_task.cancel()
+
+
+async def run_chat_scenario(host: str, port: int, clients: int, messages: int, message_size: int, timeout: float, tcp_nodelay: bool = True) -> dict:
+    results = {
+        'latencies': [],
+        'received': 0,
+        'expected': (clients // 2) * messages,
+        'last_received_at': 0,
+        'done': asyncio.Event()
+    }
+
+    simulated_clients = [SimulatedClient(f'bench{index}', results, tcp_nodelay) for index in range(clients - clients % 2)]
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(client.connect(host, port) for client in simulated_clients))
+    connect_elapsed = time.perf_counter() - started_at
+
+    senders = simulated_clients[0::2]
+    receivers = simulated_clients[1::2]
+
+    await asyncio.gather(*(sender.connect_to(receiver.username) for sender, receiver in zip(senders, receivers)))
+
+    padding = 'x' * message_size
+    started_at = time.perf_counter()
+
+    for _ in range(messages):
+        for sender, receiver in zip(senders, receivers):
+            sender.send(TAG_MSG, f'{receiver.username};{time.perf_counter()};{padding}')
+
+        await asyncio.gather(*(sender.writer.drain() for sender in senders))
+
+    if results['expected'] > 0:
+        try:
+            await asyncio.wait_for(results['done'].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    message_elapsed = (results['last_received_at'] or time.perf_counter()) - started_at
+
+    stats = await simulated_clients[0].request_stats()
+    frames_sent = read_metric(stats, 'chat_messages_sent_total')
+    socket_writes = read_metric(stats, 'chat_socket_writes_total')
+
+    await asyncio.gather(*(client.close() for client in simulated_clients))
+
+    return {
+        'connect_rate': len(simulated_clients) / connect_elapsed if connect_elapsed > 0 else float('inf'),
+        'messages_per_second': results['received'] / message_elapsed if message_elapsed > 0 else float('inf'),
+        'delivered': f'{results["received"]}/{results["expected"]}',
+        'p50_ms': 1000 * percentile(results['latencies'], 0.5),
+        'p99_ms': 1000 * percentile(results['latencies'], 0.99),
+        'server_writes': int(socket_writes),
+        'frames_per_write': frames_sent / socket_writes if socket_writes > 0 else float('nan')
+    }
+
+
+async def send_header(host: str, port: int, header: str) -> tuple:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f'{header}\n'.encode('ASCII'))
+
+    response = (await reader.readline()).decode('ASCII').strip()
+    return reader, writer, response
+
+
+async def run_file_scenario(host: str, chat_port: int, file_transfer_port: int, transfers: int, file_size: int, timeout: float) -> dict:
+    results = {'latencies': [], 'received': 0, 'expected': 0, 'last_received_at': 0, 'done': asyncio.Event()}
+
+    uploaders = [SimulatedClient(f'uploader{index}', results) for index in range(transfers)]
+    downloaders = [SimulatedClient(f'downloader{index}', results) for index in range(transfers)]
+    await asyncio.gather(*(client.connect(host, chat_port) for client in uploaders + downloaders))
+
+    payload = os.urandom(file_size)
+
+    async def upload(uploader: SimulatedClient, downloader: SimulatedClient):
+        reader, writer, response = await send_header(host, file_transfer_port, f'UP;{uploader.username};{downloader.username};bench.bin;{file_size}')
+
+        if response != 'OK':
+            raise Exception(f'Upload refused: {response}')
+
+        writer.write(payload)
+        await writer.drain()
+        writer.close()
+
+    async def download(downloader: SimulatedClient) -> int:
+        notification = await asyncio.wait_for(downloader.files.get(), timeout)
+        file_id = notification.split(';')[3]
+
+        reader, writer, response = await send_header(host, file_transfer_port, f'DOWN;;;{file_id};;0;{file_size}')
+
+        if not response.startswith('OK'):
+            raise Exception(f'Download refused: {response}')
+
+        received = 0
+        while received < file_size:
+            data = await reader.read(256 * 1024)
+
+            if not data:
+                break
+
+            received += len(data)
+
+        writer.close()
+        return received
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(upload(uploader, downloader) for uploader, downloader in zip(uploaders, downloaders)))
+    upload_elapsed = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    received = await asyncio.gather(*(download(downloader) for downloader in downloaders))
+    download_elapsed = time.perf_counter() - started_at
+
+    await asyncio.gather(*(client.close() for client in uploaders + downloaders))
+
+    megabytes = transfers * file_size / (1024 * 1024)
+    return {
+        'upload_mib_per_second': megabytes / upload_elapsed,
+        'download_mib_per_second': sum(received) / (1024 * 1024) / download_elapsed,
+        'transfers': transfers
+    }
+
+
+def raise_file_limit():
+    if resource is None:
+        return
+
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if hard_limit != resource.RLIM_INFINITY and soft_limit < hard_limit:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+
+def start_server(arguments, chat_port: int, file_transfer_port: int, server_options: dict) -> multiprocessing.Process:
+    server_process = multiprocessing.Process(target=run_server, args=({
+        'server_mode': arguments.server_mode,
+        'chat_port': chat_port,
+        'file_transfer_port': file_transfer_port,
+        'max_connections': 4096,
+        'files_location': arguments.files_location,
+        'log_level': arguments.log_level,
+        'server_log': arguments.server_log,
+        'server_options': server_options
+    },), daemon=True)
+
+    server_process.start()
+    time.sleep(arguments.startup_delay)
+
+    return server_process
+
+
+def format_result(result: dict) -> str:
+    return ' '.join(f'{key}={value:.2f}' if isinstance(value, float) else f'{key}={value}' for key, value in result.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless load generator for the chat and file transfer servers.')
+    parser.add_argument('--server-mode', default='threaded', choices=['threaded', 'async'])
+    parser.add_argument('--clients', default=DEFAULT_CLIENTS, help='Comma separated concurrency levels.')
+    parser.add_argument('--messages', type=int, default=DEFAULT_MESSAGES, help='Messages per sender.')
+    parser.add_argument('--message-size', type=int, default=DEFAULT_MESSAGE_SIZE)
+    parser.add_argument('--tcp-nodelay', default=DEFAULT_TCP_NODELAY, help='Comma separated TCP_NODELAY settings to compare, on and/or off.')
+    parser.add_argument('--coalesce-size', type=int, default=0, help='Server write coalescing threshold in bytes, 0 for the server default.')
+    parser.add_argument('--coalesce-delay', default=DEFAULT_COALESCE_DELAYS, help='Comma separated server coalescing delays in seconds to compare.')
+    parser.add_argument('--transfers', type=int, default=0, help='Concurrent file transfers to run, 0 to skip.')
+    parser.add_argument('--file-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--files-location', default=os.path.abspath(f'{os.path.dirname(__file__)}/files'))
+    parser.add_argument('--port', type=int, default=DEFAULT_CHAT_PORT)
+    parser.add_argument('--file-transfer-port', type=int, default=DEFAULT_FILE_TRANSFER_PORT)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--startup-delay', type=float, default=0.5)
+    parser.add_argument('--log-level', default='ERROR')
+    parser.add_argument('--server-log', action='store_true', help='Print the server log instead of discarding it.')
+    arguments = parser.parse_args()
+
+    raise_file_limit()
+
+    levels = [int(level) for level in arguments.clients.split(',')]
+    nodelay_settings = [setting.strip() == 'on' for setting in arguments.tcp_nodelay.split(',')]
+    coalesce_delays = [float(delay) for delay in arguments.coalesce_delay.split(',')]
+
+    for run_index, (clients, tcp_nodelay, coalesce_delay) in enumerate(itertools.product(levels, nodelay_settings, coalesce_delays)):
+        chat_port = arguments.port + 2 * run_index
+        file_transfer_port = arguments.file_transfer_port + 2 * run_index
+        server_process = start_server(arguments, chat_port, file_transfer_port, {
+            'tcp_nodelay': tcp_nodelay,
+            'coalesce_size': arguments.coalesce_size,
+            'coalesce_delay': coalesce_delay
+        })
+
+        try:
+            result = asyncio.run(run_chat_scenario(DEFAULT_HOST, chat_port, clients, arguments.messages, arguments.message_size, arguments.timeout, tcp_nodelay))
+            result['server_rss_mib'] = read_rss(server_process.pid)
+
+            print(f'[BENCHMARK] mode={arguments.server_mode} clients={clients} nodelay={"on" if tcp_nodelay else "off"} coalesce_delay={coalesce_delay} {format_result(result)}')
+            sys.stdout.flush()
+        finally:
+            server_process.terminate()
+            server_process.join()
+
+    if arguments.transfers > 0:
+        chat_port = arguments.port + 1
+        file_transfer_port = arguments.file_transfer_port + 1
+        server_process = start_server(arguments, chat_port, file_transfer_port, {})
+
+        try:
+            result = asyncio.run(run_file_scenario(DEFAULT_HOST, chat_port, file_transfer_port, arguments.transfers, arguments.file_size, arguments.timeout))
+            result['server_rss_mib'] = read_rss(server_process.pid)
+
+            print(f'[BENCHMARK] mode={arguments.server_mode} file_size={arguments.file_size} {format_result(result)}')
+        finally:
+            server_process.terminate()
+            server_process.join()
+
+
+if __name__ == '__main__':
+    main()
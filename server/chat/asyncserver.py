@@ -0,0 +1,222 @@
+import asyncio
+import time
+from .chatserver import BaseConnection, ChatServer
+from .framing import FrameReader, FrameCompressor, encode_frame, get_compression_command
+from .metrics import messages_sent, bytes_received, bytes_sent, socket_writes
+from .outbound import OVERFLOW_DISCONNECT, OVERFLOW_BLOCK
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class AsyncConnection(BaseConnection, asyncio.Protocol):
+    def __init__(self, server):
+        BaseConnection.__init__(self, server, None)
+
+        self.transport = None
+        self.reader = FrameReader(compression_codecs=server.compression_codecs)
+        self.compressor = None
+
+        self.paused = False
+        self.pending_writes = []
+        self.pending_size = 0
+        self.flush_handle = None
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_size = 0
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.server.configure_socket(transport.get_extra_info('socket'))
+        self.transport.set_write_buffer_limits(self.server.outbound_high_watermark, self.server.outbound_low_watermark)
+        self.address = transport.get_extra_info('peername')
+        self.server.add_connection(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+        if self.server.outbound_policy == OVERFLOW_DISCONNECT:
+            self.log('WARN', 'Outbound buffer is full, disconnecting.')
+            self.server.close_connection(self)
+
+    def resume_writing(self):
+        self.paused = False
+
+    def data_received(self, data: bytes):
+        try:
+            bytes_received.inc(len(data))
+
+            for tag, message in self.reader.feed(data):
+                self.log('DEBUG', 'Received message: %s|%s', tag, message)
+                self.handle_received_message(tag, message)
+
+        except Exception as error:
+            self.log('ERROR', str(error))
+            self.server.close_connection(self)
+
+    def connection_lost(self, error):
+        if error is not None:
+            self.log('ERROR', str(error))
+
+        self.server.close_connection(self)
+
+    def send_to_socket(self, tag: str, message: str):
+        if self.transport is None:
+            raise Exception('No socket connection is available to this client.')
+
+        self.log('DEBUG', 'Sending message: %s|%s', tag, message)
+        self.send_frame(tag, encode_frame(tag, message))
+
+    def try_send_to_socket(self, tag: str, message: str) -> bool:
+        # Writes never block the loop, but a paused transport is as full as a throttled queue.
+        if self.transport is None or self.paused:
+            return False
+
+        self.send_to_socket(tag, message)
+        return True
+
+    def send_frame(self, tag: str, frame: bytes):
+        messages_sent.inc(1, tag)
+        return self.server.call_in_loop(self._write, frame) is not False
+
+    def enable_compression(self, codec: str):
+        messages_sent.inc(1, 'CFG')
+        self.server.call_in_loop(self._start_compression, codec)
+
+    def close(self):
+        self.server.call_in_loop(self._close)
+
+    def get_outbound_stats(self) -> dict:
+        return {
+            'depth_frames': None,
+            'depth_bytes': self.transport.get_write_buffer_size() if self.transport is not None else 0,
+            'max_depth_bytes': self.max_size,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped
+        }
+
+    def _write(self, frame: bytes):
+        # Senders share the event loop, so the block policy cannot stall them and keeps buffering instead.
+        if self.paused and self.server.outbound_policy != OVERFLOW_BLOCK:
+            self.dropped += 1
+            self.log('WARN', 'Outbound buffer is full, dropped message.')
+            return False
+
+        return self._buffer_frame(frame)
+
+    def _buffer_frame(self, frame: bytes) -> bool:
+        if self.transport.is_closing():
+            return False
+
+        if self.compressor is not None:
+            frame = self.compressor.compress(frame)
+
+        self.pending_writes.append(frame)
+        self.pending_size += len(frame)
+        self.enqueued += 1
+
+        if self.pending_size >= self.server.coalesce_size:
+            self._flush()
+        elif self.flush_handle is None:
+            if self.server.coalesce_delay > 0:
+                self.flush_handle = self.server.loop.call_later(self.server.coalesce_delay, self._flush)
+            else:
+                self.flush_handle = self.server.loop.call_soon(self._flush)
+
+        return True
+
+    def _start_compression(self, codec: str):
+        # The marker bypasses the overflow policy, dropping it would desynchronize the stream.
+        self._buffer_frame(encode_frame('CFG', get_compression_command(codec)))
+        self.compressor = FrameCompressor(codec)
+        self.log('INFO', f'Compressing traffic with {codec}')
+
+    def _close(self):
+        self._flush()
+        self.transport.close()
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        data = b''.join(self.pending_writes)
+        self.pending_writes = []
+        self.pending_size = 0
+
+        if not data or self.transport.is_closing():
+            return
+
+        self.transport.write(data)
+        bytes_sent.inc(len(data))
+        socket_writes.inc()
+        self.max_size = max(self.max_size, self.transport.get_write_buffer_size())
+
+
+class AsyncChatServer(ChatServer):
+    def __init__(self, port: int, **kwargs):
+        ChatServer.__init__(self, port, **kwargs)
+
+        self.loop = None
+
+    def initialize(self):
+        self._raise_file_limit()
+        ChatServer.initialize(self)
+        self.socket.setblocking(False)
+
+    def listen_for_connections(self):
+        if self.socket is None:
+            raise Exception('No socket connection is available to this server.')
+
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            pass
+
+        self.log('INFO', 'Closing server...')
+        self.close_server()
+
+    def call_in_loop(self, fn, *args):
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self.loop:
+            return fn(*args)
+
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await self.loop.create_server(lambda: AsyncConnection(self), sock=self.socket)
+
+        self.log('INFO', 'Serving connections on a single event loop.')
+
+        if self.heartbeats is not None:
+            self.loop.call_later(self.heartbeats.tick, self._check_heartbeats)
+
+        async with server:
+            await server.serve_forever()
+
+    def _check_heartbeats(self):
+        self.heartbeats.check(time.monotonic())
+        self.loop.call_later(self.heartbeats.tick, self._check_heartbeats)
+
+    def _raise_file_limit(self):
+        if resource is None:
+            return
+
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+        if hard_limit == resource.RLIM_INFINITY or soft_limit >= hard_limit:
+            return
+
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+        self.log('INFO', f'Raised open file limit from {soft_limit} to {hard_limit}')
@@ -1,11 +1,28 @@
+import abc
+import ipaddress
 import socket
+import time
+from collections import deque
 from typing import Optional
-from threading import Thread
+from threading import Thread, RLock
+from .framing import FrameReader, FrameCompressor, encode_frame, get_compression_command, COMPRESSION_COMMAND, COMPRESSION_CODECS
+from .registry import ConnectionRegistry
+from .presence import Presence
+from .rooms import RoomRegistry, is_room_name, normalize_room_name
+from .heartbeat import HeartbeatMonitor, DEFAULT_IDLE_TIMEOUT, DEFAULT_PONG_TIMEOUT, PING, PONG
+from .history import get_conversation
+from .logger import logger
+from .metrics import metrics, connections_accepted, messages_received, messages_sent, bytes_received, routing_latency
+from .outbound import OutboundQueue, OutboundWriter, OVERFLOW_DISCONNECT, DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, DEFAULT_OVERFLOW_POLICY, DEFAULT_COALESCE_SIZE, DEFAULT_COALESCE_DELAY
 
 
 DEFAULT_CHAT_PORT = 10023
 DEFAULT_BUFFER_SIZE = 1024
 DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_TCP_NODELAY = True
+DEFAULT_SOCKET_BUFFER_SIZE = 0  # keep the OS default
+DEFAULT_REPLAY_BATCH_SIZE = 64 * 1024
+DEFAULT_TRY_SEND_TIMEOUT = 1  # seconds to wait for another sender that is not stuck on a full queue
 
 TAG_MSG = 'MSG'
 TAG_ERR = 'ERR'
@@ -13,28 +30,105 @@ TAG_CFG = 'CFG'
 TAG_CMD = 'CMD'
 TAG_LIST = 'LIST'
 TAG_FILE = 'FILE'
+TAG_PRESENCE = 'PRES'
+TAG_STATS = 'STATS'
+TAG_HISTORY = 'HIST'
 
 
-class Connection(Thread):
-    def __init__(self, server, client_socket: socket, client_address: tuple):
-        Thread.__init__(self)
-        self.daemon = True
-
+class BaseConnection(abc.ABC):
+    def __init__(self, server, client_address: tuple):
         self.server = server
-        self.socket = client_socket
         self.address = client_address
         self.username = None
 
         self.peers = dict()
 
+        self.last_activity = time.monotonic()
+        self.ping_sent_at = None
+
+        self.compression_codec = None
+
     def send_to_peer(self, peer_username: str, message: str):
         peer = self.peers.get(peer_username)
 
         if peer is None:
+            if self.server.queue_offline_message(self, peer_username, message):
+                return
+
             return self.send_to_socket(TAG_ERR, f'You are not chatting with {peer_username}.')
 
+        self.server.record_history(get_conversation(self.username, peer_username), self.username, message)
         return peer.send_to_socket(TAG_MSG, f'{self.username};{message}')
 
+    def send_to_room(self, room: str, message: str):
+        if not self.server.rooms.is_member(room, self):
+            return self.send_to_socket(TAG_ERR, f'You are not in {room}.')
+
+        self.server.record_history(room, self.username, message)
+
+        # Serialized once, every member gets the same frame.
+        frame = encode_frame(TAG_MSG, f'{room};{self.username};{message}')
+
+        for member in self.server.rooms.members(room):
+            if member is self:
+                continue
+
+            try:
+                member.send_frame(TAG_MSG, frame)
+            except Exception as error:
+                member.log('ERROR', f'Could not deliver message from {room}: {error}')
+
+    def join_room(self, room: str):
+        if len(room) < 2 or ';' in room:
+            return self.send_to_socket(TAG_ERR, 'Invalid room name.')
+
+        if not self.server.rooms.join(room, self):
+            return self.send_to_socket(TAG_ERR, f'You are already in {room}.')
+
+        self.log('INFO', f'Joined room {room}')
+        return self.send_to_socket(TAG_CMD, 'SUCCESS')
+
+    def leave_room(self, room: str):
+        if not self.server.rooms.leave(room, self):
+            return self.send_to_socket(TAG_ERR, f'You are not in {room}.')
+
+        self.log('INFO', f'Left room {room}')
+        return self.send_to_socket(TAG_CMD, 'SUCCESS')
+
+    def send_history(self, peer_username: str, before: int, count: int):
+        if self.server.history is None:
+            return self.send_to_socket(TAG_ERR, 'History is not available on this server.')
+
+        if is_room_name(peer_username):
+            if not self.server.rooms.is_member(peer_username, self):
+                return self.send_to_socket(TAG_ERR, f'You are not in {peer_username}.')
+
+            conversation = peer_username
+        else:
+            conversation = get_conversation(self.username, peer_username)
+
+        records, next_before = self.server.history.page(conversation, before, count)
+
+        # One HIST frame per message, then an end marker with the sequence to ask for the next older page.
+        frames = [encode_frame(TAG_HISTORY, f'{peer_username};{sequence};{timestamp};{sender};{message}') for sequence, timestamp, sender, message in records]
+        frames.append(encode_frame(TAG_HISTORY, f'{peer_username};end;{next_before}'))
+
+        batch = []
+        batch_size = 0
+
+        for frame in frames:
+            if batch and batch_size + len(frame) > self.server.batch_size:
+                if not self.send_frame(TAG_HISTORY, b''.join(batch)):
+                    return False
+
+                batch = []
+                batch_size = 0
+
+            batch.append(frame)
+            batch_size += len(frame)
+
+        return self.send_frame(TAG_HISTORY, b''.join(batch))
+
     def connect_to(self, peer_connection):
         if peer_connection == self:
             return self.send_to_socket(TAG_ERR, 'You cannot chat with yourself.')
@@ -63,24 +157,17 @@ class Connection(Thread):
 
         return self.send_to_socket(TAG_CMD, 'SUCCESS')
 
-    def run(self):
-        try:
-            while True:
-                self.handle_received_message(self.receive_from_socket())
-
-        except BaseException as error:
-            self.log('ERROR', str(error))
-            self.server.close_connection(self)
+    def handle_received_message(self, tag: str, received_message: str):
+        started_at = time.perf_counter()
+        messages_received.inc(1, tag)
+        self.last_activity = time.monotonic()
 
-    def handle_received_message(self, received_message: str):
         try:
-            separator_index = received_message.index('|')
-        except ValueError:
-            return self.send_to_socket(TAG_ERR, 'Badly constructed message.')
-
-        tag = received_message[:separator_index]
-        received_message = received_message[separator_index + 1:]
+            return self._route_message(tag, received_message)
+        finally:
+            routing_latency.observe(time.perf_counter() - started_at)
 
+    def _route_message(self, tag: str, received_message: str):
         if tag == TAG_MSG:
             return self._handle_message(received_message)
         if tag == TAG_CMD:
@@ -99,12 +186,53 @@ class Connection(Thread):
         peer_username = message[:separator_index]
         message_content = message[separator_index + 1:]
 
+        if is_room_name(peer_username):
+            return self.send_to_room(peer_username, message_content)
+
         return self.send_to_peer(peer_username, message_content)
 
     def _handle_command(self, command: str):
+        if command == PONG:
+            return
+
+        if command == PING:
+            return self.send_to_socket(TAG_CMD, PONG)
+
         if command == 'list':
             return self.send_to_socket(TAG_LIST, self.server.get_online_list())
 
+        if command == 'stats':
+            if not self.is_admin():
+                return self.send_to_socket(TAG_ERR, 'Server statistics are only available to administrators.')
+
+            return self.send_to_socket(TAG_STATS, metrics.render())
+
+        if command == 'subscribe':
+            return self.server.presence.subscribe(self)
+
+        if command == 'unsubscribe':
+            self.server.presence.unsubscribe(self)
+            return self.send_to_socket(TAG_CMD, 'SUCCESS')
+
+        if command.startswith('join '):
+            return self.join_room(normalize_room_name(command[len('join '):]))
+
+        if command.startswith('leave '):
+            return self.leave_room(normalize_room_name(command[len('leave '):]))
+
+        if command.startswith('history '):
+            arguments = command[len('history '):].split(' ')
+
+            if self.username is None or len(arguments) > 3 or len(arguments[0]) < 1:
+                return self.send_to_socket(TAG_ERR, 'Badly constructed history request.')
+
+            try:
+                before, count = (int(argument) for argument in (arguments[1:] + ['0', '0'])[:2])
+            except ValueError:
+                return self.send_to_socket(TAG_ERR, 'Badly constructed history request.')
+
+            return self.send_history(arguments[0], before, count)
+
         if command.startswith('connect'):
             peer_username = command[len('connect '):]
 
@@ -126,7 +254,7 @@ class Connection(Thread):
             return self.disconnect_from_peer(peer_username)
 
         if command == 'exit':
-            for peer_username in self.peers.keys():
+            for peer_username in list(self.peers.keys()):
                 self.disconnect_from_peer(peer_username)
 
             return self.server.close_connection(self)
@@ -137,40 +265,186 @@ class Connection(Thread):
         if config.startswith('set_username'):
             username = config[len('set_username '):]
 
-            if self.server.get_connection_by_username(username) is not None:
+            try:
+                claimed = self.server.claim_username(self, username)
+            except Exception as error:
+                return self.send_to_socket(TAG_ERR, str(error))
+
+            if not claimed:
                 return self.send_to_socket(TAG_ERR, 'Username already in use.')
 
-            self.username = username
             self.log('INFO', f'Saved username for client as {self.username}')
-            return self.send_to_socket(TAG_CFG, 'SUCCESS')
+            self.send_to_socket(TAG_CFG, 'SUCCESS')
+
+            return self.server.replay_offline_messages(self)
+
+        if config.startswith(COMPRESSION_COMMAND):
+            codec = config[len(COMPRESSION_COMMAND):]
+
+            if codec not in self.server.compression_codecs:
+                return self.send_to_socket(TAG_ERR, f'Compression with {codec} is not available.')
+
+            # A second marker would land inside the compressed stream, and a new compressor would break it.
+            if self.compression_codec is not None:
+                return self.send_to_socket(TAG_ERR, f'Compression with {self.compression_codec} is already enabled.')
+
+            self.compression_codec = codec
+            return self.enable_compression(codec)
 
         return self.send_to_socket(TAG_ERR, 'Invalid CFG message sent.')
 
-    def receive_from_socket(self) -> str:
+    def is_admin(self) -> bool:
+        # Operators either connect from the server's own host or log in with one of the configured names.
+        if self.username in self.server.admin_users:
+            return True
+
+        try:
+            return ipaddress.ip_address(self.address[0]).is_loopback
+        except (TypeError, ValueError):
+            return False
+
+    @abc.abstractmethod
+    def send_to_socket(self, tag: str, message: str):
+        pass
+
+    @abc.abstractmethod
+    def send_frame(self, tag: str, frame: bytes):
+        pass
+
+    @abc.abstractmethod
+    def try_send_to_socket(self, tag: str, message: str) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def enable_compression(self, codec: str):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def get_outbound_stats(self) -> dict:
+        pass
+
+    def log(self, label: str, message: str, *args):
+        logger.log(f'({self.address})', label, message, *args)
+
+
+class Connection(BaseConnection, Thread):
+    def __init__(self, server, client_socket: socket, client_address: tuple):
+        BaseConnection.__init__(self, server, client_address)
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.socket = client_socket
+        self.reader = FrameReader(compression_codecs=server.compression_codecs)
+        self.pending_frames = deque()
+
+        self.compressor = None
+        self.send_lock = RLock()
+
+        self.outbound = OutboundQueue(server.outbound_high_watermark, server.outbound_low_watermark, server.outbound_policy)
+        self.writer = OutboundWriter(self)
+
+    def run(self):
+        self.writer.start()
+
+        try:
+            while True:
+                self.handle_received_message(*self.receive_from_socket())
+
+        except BaseException as error:
+            self.log('ERROR', str(error))
+            self.server.close_connection(self)
+
+    def receive_from_socket(self) -> tuple:
         if self.socket is None:
             raise Exception('No socket connection is available to this client.')
 
-        data = self.socket.recv(self.server.buf_size)
+        while not self.pending_frames:
+            data = self.socket.recv(self.server.buf_size)
+
+            if not data:
+                raise Exception('No data received on socket. Was the connection interrupted?')
 
-        if not data:
-            raise Exception('No data received on socket. Was the connection interrupted?')
+            bytes_received.inc(len(data))
+            self.pending_frames.extend(self.reader.feed(data))
 
-        data = data.decode('ASCII')
-        self.log('DEBUG', f'Received message: {data}')
+        tag, message = self.pending_frames.popleft()
+        self.log('DEBUG', 'Received message: %s|%s', tag, message)
 
-        return data
+        return tag, message
 
     def send_to_socket(self, tag: str, message: str):
         if self.socket is None:
             raise Exception('No socket connection is available to this client.')
 
-        to_send = f'{tag}|{message}'
-        self.log('DEBUG', f'Sending message: {to_send}')
+        self.log('DEBUG', 'Sending message: %s|%s', tag, message)
+        self.send_frame(tag, encode_frame(tag, message))
+
+    def send_frame(self, tag: str, frame: bytes):
+        messages_sent.inc(1, tag)
+
+        # Compressing at enqueue time under the lock keeps the zlib stream in the same order as the queue.
+        with self.send_lock:
+            if self.compressor is not None:
+                frame = self.compressor.compress(frame)
+
+            if self.outbound.put(frame):
+                return True
+
+        self.log('WARN', 'Outbound queue is full, dropped %s frame of %d bytes.', tag, len(frame))
+
+        # A dropped block breaks the compressed stream for everything after it.
+        if self.outbound.policy == OVERFLOW_DISCONNECT or self.compressor is not None:
+            self.server.close_connection(self)
+
+        return False
+
+    def try_send_to_socket(self, tag: str, message: str) -> bool:
+        frame = encode_frame(tag, message)
+
+        # Never waits on a full queue: whoever holds the lock while the queue is throttled may be stuck in put.
+        if self.outbound.throttled or not self.send_lock.acquire(timeout=DEFAULT_TRY_SEND_TIMEOUT):
+            return False
+
+        try:
+            if self.compressor is not None:
+                frame = self.compressor.compress(frame)
+
+            queued = self.outbound.put(frame, block=False)
+        finally:
+            self.send_lock.release()
+
+        if queued:
+            messages_sent.inc(1, tag)
 
-        self.socket.sendall(to_send.encode('ASCII'))
+        return queued
 
-    def log(self, label: str, message: str):
-        print(f'({self.address}): [{label}] - {message}')
+    def enable_compression(self, codec: str):
+        with self.send_lock:
+            messages_sent.inc(1, TAG_CFG)
+
+            if not self.outbound.put(encode_frame(TAG_CFG, get_compression_command(codec))):
+                self.log('WARN', 'Could not queue the compression marker, disconnecting.')
+                return self.server.close_connection(self)
+
+            self.compressor = FrameCompressor(codec)
+            self.log('INFO', f'Compressing traffic with {codec}')
+
+    def close(self):
+        self.outbound.close()
+
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.socket.close()
+
+    def get_outbound_stats(self) -> dict:
+        return self.outbound.get_stats()
 
 
 class ChatServer:
@@ -179,28 +453,91 @@ class ChatServer:
         self.buf_size = kwargs.get('buffer_size') or DEFAULT_BUFFER_SIZE
         self.max_connections = kwargs.get('max_connections') or DEFAULT_MAX_CONNECTIONS
 
-        self.connections = dict()
+        self.outbound_high_watermark = kwargs.get('outbound_high_watermark') or DEFAULT_HIGH_WATERMARK
+        self.outbound_low_watermark = kwargs.get('outbound_low_watermark') or DEFAULT_LOW_WATERMARK
+        self.outbound_policy = kwargs.get('outbound_policy') or DEFAULT_OVERFLOW_POLICY
+        # Batches that fit under the low watermark are always accepted once the queue has drained.
+        self.batch_size = min(DEFAULT_REPLAY_BATCH_SIZE, self.outbound_low_watermark, self.outbound_high_watermark)
+        self.reuse_port = kwargs.get('reuse_port', False)
+        self.compression_codecs = COMPRESSION_CODECS if kwargs.get('chat_compression', True) else ()
+        self.admin_users = set(kwargs.get('admin_users') or ())
+
+        self.tcp_nodelay = kwargs.get('tcp_nodelay', DEFAULT_TCP_NODELAY)
+        self.send_buffer_size = kwargs.get('send_buffer_size') or DEFAULT_SOCKET_BUFFER_SIZE
+        self.receive_buffer_size = kwargs.get('receive_buffer_size') or DEFAULT_SOCKET_BUFFER_SIZE
+        self.coalesce_size = kwargs.get('coalesce_size') or DEFAULT_COALESCE_SIZE
+        self.coalesce_delay = kwargs.get('coalesce_delay') or DEFAULT_COALESCE_DELAY
+
+        self.heartbeats = None
+        idle_timeout = kwargs.get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+
+        if idle_timeout > 0:
+            self.heartbeats = HeartbeatMonitor(self, TAG_CMD, idle_timeout, kwargs.get('pong_timeout') or DEFAULT_PONG_TIMEOUT)
+
+        self.cluster = None
+        self.federation = None
+        self.offline_messages = None
+        self.history = None
+
+        self.connections = ConnectionRegistry()
+        self.presence = Presence(TAG_PRESENCE)
+        self.rooms = RoomRegistry()
         self.socket = None
 
+        metrics.gauge('chat_connections_active', 'Chat connections currently open.', lambda: len(self.connections))
+        metrics.gauge('chat_users_online', 'Users with a username set.', lambda: len(self.presence.users))
+        metrics.gauge('chat_rooms_active', 'Rooms with at least one member.', lambda: len(self.rooms))
+        metrics.gauge('chat_outbound_queue_depth_bytes', 'Bytes waiting in outbound queues.', lambda: self.get_outbound_stats().get('depth_bytes'))
+        metrics.gauge('chat_outbound_queue_max_depth_bytes', 'Largest outbound queue depth seen on an open connection.', lambda: self.get_outbound_stats().get('max_depth_bytes'))
+        metrics.gauge('chat_outbound_dropped', 'Frames dropped by outbound queues of open connections.', lambda: self.get_outbound_stats().get('dropped'))
+
     def initialize(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # Buffer sizes have to be set before listen() so accepted sockets inherit them and the window scale matches.
+        if self.send_buffer_size > 0:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        if self.receive_buffer_size > 0:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+
         self.socket.bind(('', self.port))
         self.socket.listen(self.max_connections)
 
-        self.log('INFO', f'Server started on port {self.port}')
+        self.log('INFO', f'Server started on port {self.port} (TCP_NODELAY {"on" if self.tcp_nodelay else "off"}, coalescing up to {self.coalesce_size} bytes for {self.coalesce_delay}s)')
+
+    def configure_socket(self, client_socket):
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.tcp_nodelay))
+
+    def set_cluster(self, cluster):
+        self.cluster = cluster
+
+    def set_federation(self, federation):
+        self.federation = federation
+
+    def set_offline_queue(self, offline_messages):
+        self.offline_messages = offline_messages
+
+    def set_history(self, history):
+        self.history = history
 
     def listen_for_connections(self):
         if self.socket is None:
             raise Exception('No socket connection is available to this server.')
 
+        if self.heartbeats is not None:
+            Thread(target=self.heartbeats.run, daemon=True).start()
+
         while True:
             try:
                 client_socket, client_address = self.socket.accept()
+                self.configure_socket(client_socket)
 
                 connection = Connection(self, client_socket, client_address)
-                self.connections[client_address] = connection
-                connection.log('INFO', 'Received connection.')
+                self.add_connection(connection)
                 connection.start()
 
             except Exception or KeyboardInterrupt:
@@ -210,40 +547,190 @@ class ChatServer:
         self.close_server()
 
     def get_connections(self) -> list:
-        return list(self.connections.values())
+        return self.connections.snapshot()
+
+    def add_connection(self, connection: BaseConnection):
+        self.connections.add(connection)
+        connections_accepted.inc()
+
+        if self.heartbeats is not None:
+            self.heartbeats.watch(connection)
+        connection.log('INFO', 'Received connection.')
+
+    def claim_username(self, connection: BaseConnection, username: str) -> bool:
+        previous_username = connection.username
 
-    def get_connection_by_username(self, username: str) -> Optional[Connection]:
-        for connection in self.connections.values():
-            if connection.username == username:
-                return connection
+        if previous_username == username:
+            return True
 
-        return None
+        if not self.is_valid_username(username):
+            raise Exception('Invalid username.')
+
+        if self.cluster is not None and not self.cluster.claim(username):
+            return False
+
+        if not self.connections.claim_username(connection, username):
+            if self.cluster is not None:
+                self.cluster.release(username)
+            return False
+
+        if previous_username is not None:
+            self.presence.leave(previous_username)
+
+            if self.cluster is not None:
+                self.cluster.release(previous_username)
+
+        self.presence.join(username)
+        return True
+
+    def is_valid_username(self, username: str) -> bool:
+        if self.federation is not None and not self.federation.is_valid_username(username):
+            return False
+
+        # Messages addressed to '#...' go to the room, a user with that name could never be reached.
+        return not is_room_name(username)
+
+    def get_connection_by_username(self, username: str) -> Optional[BaseConnection]:
+        connection = self.connections.get_by_username(username)
+
+        if connection is None and self.cluster is not None:
+            connection = self.cluster.get_remote_connection(username)
+
+        if connection is None and self.federation is not None:
+            connection = self.federation.get_remote_connection(username)
+
+        return connection
+
+    def queue_offline_message(self, sender: BaseConnection, username: str, message: str) -> bool:
+        if self.offline_messages is None or self.get_connection_by_username(username) is not None:
+            return False
+
+        if not self.is_valid_username(username):
+            return False
+
+        # Only users who logged in before, otherwise any name would open a new queue of its own.
+        if not self.offline_messages.is_known_user(username):
+            return False
+
+        if not self.offline_messages.append(username, f'{sender.username};{message}', lambda: sender.send_to_socket(TAG_CMD, f'queued {username}')):
+            sender.send_to_socket(TAG_ERR, f'Too many messages are waiting for {username}.')
+            return True
+
+        self.record_history(get_conversation(sender.username, username), sender.username, message)
+        return True
+
+    def record_history(self, conversation: str, sender: str, message: str):
+        if self.history is None:
+            return
+
+        try:
+            self.history.append(conversation, sender, message)
+        except OSError as error:
+            self.log('ERROR', f'Could not record history: {error}')
+
+    def replay_offline_messages(self, connection: BaseConnection):
+        if self.offline_messages is None:
+            return
+
+        self.offline_messages.add_user(connection.username)
+        messages = self.offline_messages.take(connection.username)
+        delivered_position = None
+        delivered = 0
+
+        batch = []
+        batch_size = 0
+        batch_position = None
+
+        for position, message in messages:
+            frame = encode_frame(TAG_MSG, message)
+
+            if batch and batch_size + len(frame) > self.batch_size:
+                if not connection.send_frame(TAG_MSG, b''.join(batch)):
+                    batch = []
+                    break
+
+                delivered_position = batch_position
+                delivered += len(batch)
+
+                batch = []
+                batch_size = 0
+
+            batch.append(frame)
+            batch_size += len(frame)
+            batch_position = position
+
+        if batch and connection.send_frame(TAG_MSG, b''.join(batch)):
+            delivered_position = batch_position
+            delivered += len(batch)
+
+        if delivered_position is not None:
+            self.offline_messages.acknowledge(connection.username, delivered_position)
+            connection.log('INFO', f'Replayed {delivered} of {len(messages)} offline messages')
 
     def get_online_list(self):
-        user_list = map(lambda c: c.username, self.connections.values())
-        user_list = filter(lambda u: u is not None, user_list)
-        user_list = sorted(user_list)
-        user_list = ', '.join(user_list)
+        return self.presence.get_online_list()
+
+    def get_outbound_stats(self) -> dict:
+        totals = {
+            'connections': 0,
+            'depth_bytes': 0,
+            'max_depth_bytes': 0,
+            'dropped': 0
+        }
 
-        return user_list
+        for connection in self.get_connections():
+            stats = connection.get_outbound_stats()
 
-    def close_connection(self, connection: Connection):
-        if self.connections.get(connection.address) is None:
+            totals['connections'] += 1
+            totals['depth_bytes'] += stats.get('depth_bytes')
+            totals['max_depth_bytes'] = max(totals['max_depth_bytes'], stats.get('max_depth_bytes'))
+            totals['dropped'] += stats.get('dropped')
+
+        return totals
+
+    def close_connection(self, connection: BaseConnection):
+        if not self.connections.remove(connection):
             return
 
-        connection.socket.close()
+        if self.heartbeats is not None:
+            self.heartbeats.forget(connection)
+
+        self.presence.unsubscribe(connection)
+        self.rooms.leave_all(connection)
+        self.release_peers(connection)
+
+        if connection.username is not None:
+            self.presence.leave(connection.username)
+
+            if self.cluster is not None:
+                self.cluster.release(connection.username)
+
+        connection.close()
         connection.log('INFO', 'Closed connection.')
 
-        del self.connections[connection.address]
+    def release_peers(self, connection: BaseConnection):
+        # Peers of a connection that went away without an exit would otherwise keep it in their peers forever.
+        for peer_username, peer in list(connection.peers.items()):
+            try:
+                del peer.peers[connection.username]
+            except KeyError:
+                continue
+
+            try:
+                peer.send_to_socket(TAG_CMD, f'disconnect {connection.username}')
+            except Exception as error:
+                peer.log('ERROR', f'Could not notify the disconnection of {connection.username}: {error}')
+
+        connection.peers.clear()
 
     def close_server(self):
         if self.socket is None:
             raise Exception('No socket connection is available to this server.')
 
         self.socket.close()
-        for connection in self.connections.values():
-            connection.socket.close()
+        for connection in self.get_connections():
+            connection.close()
 
     @staticmethod
-    def log(label: str, message: str):
-        print(f'(SERVER): [{label}] - {message}')
+    def log(label: str, message: str, *args):
+        logger.log('(SERVER)', label, message, *args)
@@ -0,0 +1,325 @@
+import os
+import socket
+import tempfile
+import signal
+import selectors
+import itertools
+from threading import Thread, Lock, Event
+from .framing import FrameReader, encode_frame
+from .logger import logger
+from .remote import RemoteConnection
+
+TAG_BUS = 'BUS'
+
+DEFAULT_WORKERS = 1
+DEFAULT_CLAIM_TIMEOUT = 5
+DEFAULT_HUB_BUFFER_LIMIT = 16 * 1024 * 1024  # bytes waiting for one worker before the hub gives up on it
+
+
+def get_default_cluster_path(port: int) -> str:
+    return os.path.join(tempfile.gettempdir(), f'async-chat-cluster-{port}.sock')
+
+
+class ClusterHub:
+    def __init__(self, path: str):
+        self.path = path
+        self.selector = selectors.DefaultSelector()
+
+        self.socket = None
+        self.readers = dict()  # worker socket -> FrameReader
+        self.pending_writes = dict()  # worker socket -> bytearray not yet taken by the socket
+        self.users = dict()  # username -> worker socket
+
+    def initialize(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        self.socket.listen()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+
+    def serve_forever(self):
+        while True:
+            for key, mask in self.selector.select():
+                if key.fileobj is self.socket:
+                    self._accept_worker()
+                    continue
+
+                if mask & selectors.EVENT_WRITE:
+                    self._flush_worker(key.fileobj)
+                if mask & selectors.EVENT_READ and key.fileobj in self.readers:
+                    self._read_worker(key.fileobj)
+
+    def close(self):
+        self.socket.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _accept_worker(self):
+        worker_socket, _ = self.socket.accept()
+        worker_socket.setblocking(False)
+
+        self.readers[worker_socket] = FrameReader()
+        self.pending_writes[worker_socket] = bytearray()
+        self.selector.register(worker_socket, selectors.EVENT_READ)
+
+        for username in list(self.users.keys()):
+            self._send(worker_socket, f'join;{username}')
+
+    def _read_worker(self, worker_socket: socket.socket):
+        try:
+            data = worker_socket.recv(64 * 1024)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            return self._remove_worker(worker_socket)
+
+        for _, payload in self.readers[worker_socket].feed(data):
+            self._handle(worker_socket, payload)
+
+    def _handle(self, worker_socket: socket.socket, payload: str):
+        operation, _, arguments = payload.partition(';')
+
+        if operation == 'claim':
+            request_id, _, username = arguments.partition(';')
+            claimed = username not in self.users
+
+            if claimed:
+                self.users[username] = worker_socket
+                self._broadcast(f'join;{username}', worker_socket)
+
+            return self._send(worker_socket, f'claimed;{request_id};{int(claimed)}')
+
+        if operation == 'release':
+            if self.users.get(arguments) is worker_socket:
+                del self.users[arguments]
+                self._broadcast(f'leave;{arguments}', worker_socket)
+            return
+
+        if operation in ('deliver', 'link', 'unlink'):
+            username = arguments.split(';', 1)[0]
+            owner = self.users.get(username)
+
+            if owner is not None:
+                self._send(owner, payload)
+
+    def _remove_worker(self, worker_socket: socket.socket):
+        if worker_socket not in self.readers:
+            return
+
+        self.selector.unregister(worker_socket)
+        del self.readers[worker_socket]
+        del self.pending_writes[worker_socket]
+        worker_socket.close()
+
+        for username in [username for username, owner in self.users.items() if owner is worker_socket]:
+            del self.users[username]
+            self._broadcast(f'leave;{username}', None)
+
+    def _broadcast(self, payload: str, origin):
+        for worker_socket in list(self.readers.keys()):
+            if worker_socket is not origin:
+                self._send(worker_socket, payload)
+
+    def _send(self, worker_socket: socket.socket, payload: str):
+        pending_write = self.pending_writes.get(worker_socket)
+
+        if pending_write is None:
+            return
+
+        # Never blocks the selector loop: what the socket does not take now waits for it to become writable.
+        was_empty = not pending_write
+        pending_write += encode_frame(TAG_BUS, payload)
+
+        if len(pending_write) > DEFAULT_HUB_BUFFER_LIMIT:
+            logger.log('(CLUSTER HUB)', 'ERROR', f'Worker is not reading, {len(pending_write)} bytes waiting. Dropping it.')
+            return self._remove_worker(worker_socket)
+
+        if was_empty:
+            self._flush_worker(worker_socket)
+
+    def _flush_worker(self, worker_socket: socket.socket):
+        pending_write = self.pending_writes.get(worker_socket)
+
+        if pending_write is None:
+            return
+
+        try:
+            sent = worker_socket.send(pending_write)
+        except BlockingIOError:
+            sent = 0
+        except OSError as error:
+            logger.log('(CLUSTER HUB)', 'ERROR', f'Could not write to worker: {error}')
+            return self._remove_worker(worker_socket)
+
+        del pending_write[:sent]
+
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if pending_write else selectors.EVENT_READ
+        if self.selector.get_key(worker_socket).events != events:
+            self.selector.modify(worker_socket, events)
+
+
+class ClusterBus(Thread):
+    def __init__(self, chat_server, path: str):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.chat_server = chat_server
+        self.path = path
+
+        self.socket = None
+        self.reader = FrameReader()
+        self.write_lock = Lock()
+
+        self.request_ids = itertools.count()
+        self.claims_lock = Lock()
+        self.pending_claims = dict()  # request_id -> [Event, claimed]
+        self.abandoned_claims = dict()  # request_id -> username, claims that timed out before the hub answered
+        self.remote_users = set()
+
+    def connect(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(self.path)
+
+    def run(self):
+        try:
+            while True:
+                data = self.socket.recv(64 * 1024)
+
+                if not data:
+                    raise Exception('Lost connection to the cluster hub.')
+
+                for _, payload in self.reader.feed(data):
+                    self._handle(payload)
+
+        except BaseException as error:
+            self.log('ERROR', str(error))
+            os._exit(1)
+
+    def claim(self, username: str) -> bool:
+        request_id = str(next(self.request_ids))
+        pending_claim = [Event(), False]
+        self.pending_claims[request_id] = pending_claim
+
+        self.send(f'claim;{request_id};{username}')
+        pending_claim[0].wait(DEFAULT_CLAIM_TIMEOUT)
+
+        with self.claims_lock:
+            del self.pending_claims[request_id]
+
+            # The hub may still grant it, the late answer then releases the name again.
+            if not pending_claim[0].is_set():
+                self.abandoned_claims[request_id] = username
+
+        return pending_claim[1]
+
+    def release(self, username: str):
+        self.send(f'release;{username}')
+
+    def deliver(self, username: str, tag: str, message: str):
+        self.send(f'deliver;{username};{tag};{message}')
+
+    def link(self, username: str, peer_username: str):
+        self.send(f'link;{username};{peer_username}')
+
+    def unlink(self, username: str, peer_username: str):
+        self.send(f'unlink;{username};{peer_username}')
+
+    def get_remote_connection(self, username: str):
+        if username not in self.remote_users:
+            return None
+
+        return RemoteConnection(username, self)
+
+    def send(self, payload: str):
+        with self.write_lock:
+            self.socket.sendall(encode_frame(TAG_BUS, payload))
+
+    def _handle(self, payload: str):
+        operation, _, arguments = payload.partition(';')
+
+        if operation == 'claimed':
+            request_id, _, claimed = arguments.partition(';')
+
+            with self.claims_lock:
+                pending_claim = self.pending_claims.get(request_id)
+
+                if pending_claim is not None:
+                    pending_claim[1] = claimed == '1'
+                    pending_claim[0].set()
+                    return
+
+                username = self.abandoned_claims.pop(request_id, None)
+
+            if username is not None and claimed == '1':
+                self.log('WARN', f'Releasing {username}, the hub granted it after the claim timed out.')
+                self.release(username)
+            return
+
+        if operation == 'join':
+            self.remote_users.add(arguments)
+            return self.chat_server.presence.join(arguments)
+
+        if operation == 'leave':
+            self.remote_users.discard(arguments)
+            return self.chat_server.presence.leave(arguments)
+
+        if operation == 'deliver':
+            username, tag, message = arguments.split(';', 2)
+            connection = self.chat_server.connections.get_by_username(username)
+
+            if connection is not None:
+                connection.send_to_socket(tag, message)
+            return
+
+        if operation == 'link' or operation == 'unlink':
+            username, peer_username = arguments.split(';', 1)
+            connection = self.chat_server.connections.get_by_username(username)
+
+            if connection is None:
+                return
+
+            if operation == 'link':
+                connection.peers[peer_username] = RemoteConnection(peer_username, self)
+            else:
+                connection.peers.pop(peer_username, None)
+
+    def log(self, label: str, message: str, *args):
+        logger.log(f'(CLUSTER WORKER {os.getpid()})', label, message, *args)
+
+
+def run_cluster(workers: int, path: str, start_worker):
+    hub = ClusterHub(path)
+    hub.initialize()
+
+    worker_pids = []
+
+    for worker_index in range(workers):
+        pid = os.fork()
+
+        if pid == 0:
+            hub.socket.close()
+            start_worker(path, worker_index)
+            os._exit(0)
+
+        worker_pids.append(pid)
+
+    logger.log('(CLUSTER HUB)', 'INFO', f'Started {workers} workers: {worker_pids}')
+
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        hub.close()
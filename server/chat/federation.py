@@ -0,0 +1,411 @@
+import hmac
+import random
+import secrets
+import socket
+import time
+from collections import OrderedDict
+from threading import Thread, Lock
+from .framing import FrameReader, encode_frame
+from .chatserver import TAG_MSG, TAG_CMD, TAG_FILE
+from .cluster import TAG_BUS
+from .presence import PRESENCE_SNAPSHOT, PRESENCE_JOIN, PRESENCE_LEAVE
+from .outbound import OutboundQueue, OVERFLOW_DISCONNECT
+from .remote import RemoteConnection
+from .history import get_conversation
+from .logger import logger
+
+DEFAULT_FEDERATION_PORT = 30023
+DEFAULT_FEDERATION_BIND = '127.0.0.1'
+DEFAULT_HELLO_TIMEOUT = 10
+DEFAULT_MAX_REMOTE_FILES = 10000
+DEFAULT_RECONNECT_DELAY = 5
+DEFAULT_LINK_BATCH_SIZE = 64 * 1024
+DEFAULT_LINK_HIGH_WATERMARK = 8 * 1024 * 1024
+DEFAULT_LINK_LOW_WATERMARK = 2 * 1024 * 1024
+
+NODE_SEPARATOR = '@'
+
+
+def qualify(username: str, node_name: str) -> str:
+    if NODE_SEPARATOR in username:
+        return username
+
+    return f'{username}{NODE_SEPARATOR}{node_name}'
+
+
+def parse_peers(peers: str) -> list:
+    addresses = []
+
+    for peer in (peers or '').split(','):
+        host, _, port = peer.strip().rpartition(':')
+
+        if host and port:
+            addresses.append((host, int(port)))
+
+    return addresses
+
+
+class FederationLink(Thread):
+    def __init__(self, federation, link_socket: socket.socket, link_address: tuple):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.federation = federation
+        self.socket = link_socket
+        self.address = ('federation', link_address)
+
+        self.node_name = None
+        self.file_transfer_port = None
+        self.users = set()
+
+        self.nonce = secrets.token_hex(16)  # the remote node signs its hello with it, so old hellos cannot be replayed
+        self.duplicate = False  # the nodes were already linked the other way round
+
+        self.reader = FrameReader()
+        self.outbound = OutboundQueue(DEFAULT_LINK_HIGH_WATERMARK, DEFAULT_LINK_LOW_WATERMARK, OVERFLOW_DISCONNECT)
+        self.writer = Thread(target=self._write_batches, daemon=True)
+
+    def run(self):
+        self.writer.start()
+        self.send(f'nonce;{self.nonce}')
+
+        try:
+            self.socket.settimeout(DEFAULT_HELLO_TIMEOUT)
+
+            while True:
+                data = self.socket.recv(64 * 1024)
+
+                if not data:
+                    raise Exception('Link closed by the remote node.')
+
+                for _, payload in self.reader.feed(data):
+                    self._handle(payload)
+
+        except BaseException as error:
+            if not self.duplicate:
+                self.log('ERROR', str(error))
+            else:
+                # Our hello still goes out, so the other node learns the link is a duplicate and stops dialing too.
+                self.outbound.close()
+                self.writer.join(DEFAULT_HELLO_TIMEOUT)
+
+        self.federation.remove_link(self)
+
+    def send(self, payload: str):
+        if not self.outbound.put(encode_frame(TAG_BUS, payload)):
+            self.log('WARN', 'Link outbound queue is full, dropping the link.')
+            self.close()
+
+    def deliver(self, username: str, tag: str, message: str):
+        self.send(f'deliver;{self.get_local_username(username)};{tag};{message}')
+
+    def link(self, username: str, peer_username: str):
+        self.send(f'link;{self.get_local_username(username)};{peer_username}')
+
+    def unlink(self, username: str, peer_username: str):
+        self.send(f'unlink;{self.get_local_username(username)};{peer_username}')
+
+    def send_to_socket(self, tag: str, message: str):
+        # Presence subscription: only users connected to this node are announced to the remote one.
+        _, _, delta = message.partition(';')
+        operation, usernames = delta[:1], delta[1:]
+
+        if operation == PRESENCE_SNAPSHOT:
+            for username in usernames.split(','):
+                if username and NODE_SEPARATOR not in username:
+                    self.send(f'join;{username}')
+
+        elif NODE_SEPARATOR not in usernames:
+            if operation == PRESENCE_JOIN:
+                self.send(f'join;{usernames}')
+            elif operation == PRESENCE_LEAVE:
+                self.send(f'leave;{usernames}')
+
+    def close(self):
+        self.outbound.close()
+
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.socket.close()
+
+    def get_local_username(self, username: str) -> str:
+        return username.rpartition(NODE_SEPARATOR)[0] or username
+
+    def _write_batches(self):
+        try:
+            while True:
+                frames = self.outbound.get_many(DEFAULT_LINK_BATCH_SIZE)
+
+                if not frames:
+                    break
+
+                self.socket.sendall(b''.join(frames))
+
+        except OSError as error:
+            if not self.outbound.closed:
+                self.log('ERROR', f'Link writer stopped: {error}')
+            self.close()
+
+    def _handle(self, payload: str):
+        operation, _, arguments = payload.partition(';')
+
+        if operation == 'nonce':
+            node_name, file_transfer_port = self.federation.node_name, self.federation.file_transfer_port
+            return self.send(f'hello;{node_name};{file_transfer_port};{self.federation.sign(arguments, node_name, file_transfer_port)}')
+
+        if operation == 'hello':
+            node_name, file_transfer_port, signature = arguments.split(';', 2)
+
+            if self.node_name is not None or not hmac.compare_digest(signature, self.federation.sign(self.nonce, node_name, file_transfer_port)):
+                raise Exception('Rejected a link that did not prove the shared secret.')
+
+            self.node_name = node_name
+            self.file_transfer_port = int(file_transfer_port)
+            self.socket.settimeout(None)
+
+            if not self.federation.add_link(self):
+                self.duplicate = True
+                self.log('INFO', f'Already linked to node {self.node_name}, keeping the existing link.')
+                raise Exception(f'Already linked to node {self.node_name}.')
+
+            return self.federation.chat_server.presence.subscribe(self)
+
+        if self.node_name is None:
+            raise Exception('Received link traffic before the hello message.')
+
+        if operation == 'join':
+            username = qualify(arguments, self.node_name)
+            self.users.add(username)
+            return self.federation.chat_server.presence.join(username)
+
+        if operation == 'leave':
+            username = qualify(arguments, self.node_name)
+            self.users.discard(username)
+            return self.federation.chat_server.presence.leave(username)
+
+        if operation == 'deliver':
+            username, tag, message = arguments.split(';', 2)
+            connection = self.federation.chat_server.connections.get_by_username(username)
+
+            if connection is None:
+                return
+
+            message = self._qualify_sender(tag, message)
+
+            if tag == TAG_FILE:
+                self.federation.add_remote_file(message.split(';')[3], self.node_name)
+
+            if tag == TAG_MSG:
+                sender, _, content = message.partition(';')
+                self.federation.chat_server.record_history(get_conversation(username, sender), sender, content)
+
+            return connection.send_to_socket(tag, message)
+
+        if operation == 'link' or operation == 'unlink':
+            username, peer_username = arguments.split(';', 1)
+            connection = self.federation.chat_server.connections.get_by_username(username)
+
+            if connection is None:
+                return
+
+            peer_username = qualify(peer_username, self.node_name)
+
+            if operation == 'link':
+                connection.peers[peer_username] = RemoteConnection(peer_username, self)
+            else:
+                connection.peers.pop(peer_username, None)
+
+    def _qualify_sender(self, tag: str, message: str) -> str:
+        if tag == TAG_MSG or tag == TAG_FILE:
+            sender, separator, content = message.partition(';')
+            return f'{qualify(sender, self.node_name)}{separator}{content}'
+
+        if tag == TAG_CMD:
+            command, _, sender = message.partition(' ')
+
+            if command == 'connect' or command == 'disconnect':
+                return f'{command} {qualify(sender, self.node_name)}'
+
+        return message
+
+    def log(self, label: str, message: str, *args):
+        logger.log(f'(FEDERATION - {self.node_name or self.address[1]})', label, message, *args)
+
+
+class Federation:
+    def __init__(self, chat_server, node_name: str, port: int, peers: list, secret: str, **kwargs):
+        if not secret:
+            raise Exception('Federation needs a shared secret.')
+
+        self.chat_server = chat_server
+        self.node_name = node_name
+        self.port = port
+        self.peers = peers
+        self.secret = secret.encode('UTF-8')
+
+        self.bind_address = kwargs.get('bind_address') or DEFAULT_FEDERATION_BIND
+        self.file_transfer_port = kwargs.get('file_transfer_port')
+        self.reconnect_delay = kwargs.get('reconnect_delay') or DEFAULT_RECONNECT_DELAY
+        self.max_remote_files = kwargs.get('max_remote_files') or DEFAULT_MAX_REMOTE_FILES
+
+        self.links = dict()  # node name -> FederationLink
+        self.links_lock = Lock()
+
+        self.remote_files = OrderedDict()  # file_id -> origin node name, oldest first
+        self.remote_files_lock = Lock()
+        self.fetch_locks = dict()  # file_id -> [Lock, waiting downloads], only while a pull is running
+        self.fetch_locks_lock = Lock()
+
+        self.socket = None
+
+    def initialize(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.bind_address, self.port))
+        self.socket.listen()
+
+        self.log('INFO', f'Federation node {self.node_name} listening on {self.bind_address}:{self.port}')
+
+    def start(self):
+        Thread(target=self.listen_for_links, daemon=True).start()
+
+        for host, port in self.peers:
+            Thread(target=self.dial, args=(host, port), daemon=True).start()
+
+    def listen_for_links(self):
+        while True:
+            try:
+                link_socket, link_address = self.socket.accept()
+            except OSError:
+                break
+
+            FederationLink(self, link_socket, link_address).start()
+
+    def dial(self, host: str, port: int):
+        node_name = None  # learned from the first hello, the peer may also have dialed this node
+
+        while True:
+            if node_name not in self.links:
+                try:
+                    link = FederationLink(self, socket.create_connection((host, port)), (host, port))
+                    link.run()
+                    node_name = link.node_name
+                except OSError as error:
+                    self.log('WARN', f'Could not link to {host}:{port}: {error}')
+
+            # Jittered, so two nodes dialing each other do not keep colliding on the same schedule.
+            time.sleep(self.reconnect_delay * random.uniform(1, 1.5))
+
+    def add_link(self, link: FederationLink) -> bool:
+        with self.links_lock:
+            if link.node_name == self.node_name or link.node_name in self.links:
+                return False
+
+            self.links[link.node_name] = link
+
+        link.log('INFO', f'Linked to node {link.node_name}')
+        return True
+
+    def remove_link(self, link: FederationLink):
+        with self.links_lock:
+            if self.links.get(link.node_name) is link:
+                del self.links[link.node_name]
+
+        self.chat_server.presence.unsubscribe(link)
+
+        for username in list(link.users):
+            self.chat_server.presence.leave(username)
+
+        link.users.clear()
+        link.close()
+
+    def sign(self, nonce: str, node_name: str, file_transfer_port) -> str:
+        return hmac.new(self.secret, f'{nonce};{node_name};{file_transfer_port}'.encode('UTF-8'), 'sha256').hexdigest()
+
+    def add_remote_file(self, file_id: str, node_name: str):
+        with self.remote_files_lock:
+            self.remote_files[file_id] = node_name
+            self.remote_files.move_to_end(file_id)
+
+            # Only the most recent announcements are kept, older files can no longer be pulled from their origin.
+            while len(self.remote_files) > self.max_remote_files:
+                self.remote_files.popitem(last=False)
+
+    def is_valid_username(self, username: str) -> bool:
+        return NODE_SEPARATOR not in username
+
+    def get_remote_connection(self, username: str):
+        link = self.links.get(username.rpartition(NODE_SEPARATOR)[2])
+
+        if link is None or username not in link.users:
+            return None
+
+        return RemoteConnection(username, link)
+
+    def fetch_file(self, file_id: str, store, chunk_size: int) -> bool:
+        with self.remote_files_lock:
+            link = self.links.get(self.remote_files.get(file_id))
+
+        if link is None:
+            return False
+
+        with self.fetch_locks_lock:
+            fetch_lock = self.fetch_locks.setdefault(file_id, [Lock(), 0])
+            fetch_lock[1] += 1
+
+        try:
+            with fetch_lock[0]:
+                if store.has(file_id):
+                    return True
+
+                try:
+                    self._pull_file(link, file_id, store, chunk_size)
+                except Exception as error:
+                    self.log('ERROR', f'Could not pull {file_id} from node {link.node_name}: {error}')
+                    return False
+
+            return True
+        finally:
+            with self.fetch_locks_lock:
+                fetch_lock[1] -= 1
+
+                if fetch_lock[1] == 0:
+                    del self.fetch_locks[file_id]
+
+    def _pull_file(self, link: FederationLink, file_id: str, store, chunk_size: int):
+        started_at = time.monotonic()
+        origin_address = (link.socket.getpeername()[0], link.file_transfer_port)
+
+        with socket.create_connection(origin_address) as origin_socket:
+            origin_socket.sendall(f'DOWN;;;{file_id};;0;\n'.encode('ASCII'))
+            origin_file = origin_socket.makefile('rb')
+
+            response = origin_file.readline().decode('ASCII').strip()
+            if not response.startswith('OK;'):
+                raise Exception(f'Origin node refused the download: {response}')
+
+            remaining = int(response.split(';')[1])
+            writer = store.open_writer()
+
+            try:
+                while remaining > 0:
+                    data = origin_file.read(min(chunk_size, remaining))
+
+                    if not data:
+                        raise Exception(f'Origin node closed the connection with {remaining} bytes left.')
+
+                    writer.write(data)
+                    remaining -= len(data)
+
+                writer.commit(file_id)
+            except BaseException:
+                writer.discard()
+                raise
+
+        self.log('DOWNLOAD', f'Pulled {file_id} from node {link.node_name} in {time.monotonic() - started_at:.3f}s')
+
+    def log(self, label: str, message: str, *args):
+        logger.log(f'(FEDERATION - {self.node_name})', label, message, *args)
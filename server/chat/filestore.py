@@ -0,0 +1,80 @@
+import hashlib
+import os
+import tempfile
+
+HASH_ALGORITHM = 'sha256'
+HASH_LENGTH = hashlib.new(HASH_ALGORITHM).digest_size * 2
+
+
+class ContentWriter:
+    def __init__(self, store):
+        self.store = store
+        self.hasher = hashlib.new(HASH_ALGORITHM)
+
+        temp_fd, self.temp_path = tempfile.mkstemp(dir=store.temp_location)
+        self.file = os.fdopen(temp_fd, 'wb')
+
+    def write(self, data) -> int:
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def commit(self, expected_key: str = '') -> str:
+        self.file.close()
+        key = self.hasher.hexdigest()
+
+        if expected_key and expected_key != key:
+            os.remove(self.temp_path)
+            raise Exception(f'Received content hashes to {key}, expected {expected_key}.')
+
+        file_path = self.store.path_for(key)
+
+        if os.path.exists(file_path):
+            os.remove(self.temp_path)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(self.temp_path, file_path)
+
+        return key
+
+    def discard(self):
+        self.file.close()
+
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class ContentStore:
+    def __init__(self, location: str):
+        self.location = location
+        self.objects_location = os.path.join(location, 'objects')
+        self.temp_location = os.path.join(location, 'tmp')
+
+        os.makedirs(self.objects_location, exist_ok=True)
+        os.makedirs(self.temp_location, exist_ok=True)
+
+    def path_for(self, key: str) -> str:
+        if not self.is_valid_key(key):
+            raise Exception(f'Invalid content key {key}.')
+
+        return os.path.join(self.objects_location, key[:2], key[2:])
+
+    def has(self, key: str) -> bool:
+        return self.is_valid_key(key) and os.path.isfile(self.path_for(key))
+
+    def size_of(self, key: str) -> int:
+        return os.path.getsize(self.path_for(key))
+
+    def open_writer(self) -> ContentWriter:
+        return ContentWriter(self)
+
+    @staticmethod
+    def is_valid_key(key: str) -> bool:
+        if len(key) != HASH_LENGTH:
+            return False
+
+        try:
+            int(key, 16)
+        except ValueError:
+            return False
+
+        return True
@@ -1,15 +1,53 @@
 import socket
 import os
-from threading import Thread
+import time
+import uuid
+from threading import Thread, Lock
 from .chatserver import ChatServer, TAG_FILE
+from .registry import ConnectionRegistry
+from .filestore import ContentStore
+from .logger import logger, ProgressReporter
+from .metrics import transfers_started, transfers_active, transfer_bytes, transfer_throughput, compression_skipped
+from .compression import CODEC_NONE, SAMPLE_SIZE, negotiate_codec, is_compressible, create_decompressor, send_compressed
+from .relay import RelayBuffer, DEFAULT_RELAY_BUFFER_SIZE, DEFAULT_RELAY_ATTACH_TIMEOUT
 
 DEFAULT_FILE_TRANSFER_PORT = 20023
 DEFAULT_BUFFER_SIZE = 1024
 DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_TRANSFER_CHUNK_SIZE = 64 * 1024
+
+TRANSFER_MODE_STORED = 'stored'
+TRANSFER_MODE_RELAY = 'relay'
 
 FILES_LOCATION = os.path.abspath(f'{os.path.realpath(os.path.dirname(__file__))}/../files')
 
 
+def format_throughput(byte_count: int, elapsed: float) -> str:
+    megabytes = byte_count / (1024 * 1024)
+    rate = megabytes / elapsed if elapsed > 0 else float('inf')
+
+    return f'Transferred {megabytes:.2f} MiB in {elapsed:.3f}s ({rate:.2f} MiB/s)'
+
+
+class TransferHeader:
+    def __init__(self, header: str):
+        fields = header.split(';')
+
+        self.operation = self._get_field(fields, 0)
+        self.source_user = self._get_field(fields, 1)
+        self.destination_user = self._get_field(fields, 2)
+        self.filename = self._get_field(fields, 3)
+        self.file_size = int(self._get_field(fields, 4) or -1)
+        self.offset = int(self._get_field(fields, 5) or 0)
+        self.length = int(self._get_field(fields, 6) or -1)
+        self.content_hash = self._get_field(fields, 7)
+        self.compression = self._get_field(fields, 8)
+
+    @staticmethod
+    def _get_field(fields: list, index: int) -> str:
+        return fields[index] if index < len(fields) else ''
+
+
 class FileTransferConnection(Thread):
     def __init__(self, file_server, client_socket: socket, client_address: tuple):
         Thread.__init__(self)
@@ -19,96 +57,219 @@ class FileTransferConnection(Thread):
         self.socket = client_socket
         self.address = client_address
 
+        self.pending = bytearray()
+
     def run(self):
-        operation, source_user, destination_user, filename, file_size = self.request_header()
+        try:
+            header = self.request_header()
 
-        if not self.is_header_valid(operation, source_user, destination_user):
-            self.send_message('ERROR')
-            self.file_server.close_connection(self)
-            return
+            if not self.is_header_valid(header):
+                self.send_message('ERROR')
+                self.file_server.close_connection(self)
+                return
+
+            transfers_started.inc(1, header.operation)
+            transfers_active.inc()
 
-        self.send_message('OK')
+            try:
+                if header.operation == 'UP':
+                    self.handle_upload(header)
+                else:
+                    self.handle_download(header.filename, header.offset, header.length, header.compression)
+            finally:
+                transfers_active.dec()
 
-        if operation == 'UP':
-            self.handle_upload(source_user, destination_user, filename, file_size)
-        else:
-            self.handle_download(filename)
+        except BaseException as error:
+            self.log('ERROR', str(error))
 
         self.file_server.close_connection(self)
 
-    def request_header(self) -> tuple:
+    def request_header(self) -> TransferHeader:
         header_received = self.receive_message()
 
         self.log('INFO', f'Received header: {header_received}')
 
-        header_split = header_received.split(';')
-        operation = header_split[0]
-        source_user = header_split[1]
-        destination_user = header_split[2]
-        filename = header_split[3]
-        file_size_str = header_split[4]
-        file_size = int(file_size_str) if file_size_str else -1
-
-        return operation, source_user, destination_user, filename, file_size
+        return TransferHeader(header_received)
 
-    def is_header_valid(self, operation: str, source_user: str, destination_user: str) -> bool:
-        if operation != 'UP' and operation != 'DOWN':
+    def is_header_valid(self, header: TransferHeader) -> bool:
+        if header.operation != 'UP' and header.operation != 'DOWN':
             return False
 
-        if operation == 'UP':
-            if self.file_server.chat_server.get_connection_by_username(source_user) is None:
+        if header.operation == 'UP':
+            if self.file_server.chat_server.get_connection_by_username(header.source_user) is None:
+                return False
+
+            if self.file_server.chat_server.get_connection_by_username(header.destination_user) is None:
+                return False
+
+            if header.file_size < 0:
                 return False
 
-            if self.file_server.chat_server.get_connection_by_username(destination_user) is None:
+        if header.operation == 'DOWN':
+            if self.file_server.get_relay(header.filename) is not None:
+                return header.offset == 0
+
+            if not self.file_server.store.has(header.filename) and not self.fetch_remote_file(header.filename):
+                return False
+
+            if header.offset < 0 or header.offset > self.file_server.store.size_of(header.filename):
                 return False
 
         return True
 
-    def handle_upload(self, source_user: str, destination_user: str, filename: str, file_size: int):
-        file_path = os.path.abspath(f'{FILES_LOCATION}/{filename}')
-        uploaded = 0
+    def fetch_remote_file(self, file_id: str) -> bool:
+        federation = self.file_server.chat_server.federation
 
-        with open(file_path, 'wb') as file:
-            while True:
-                part_content = self.receive_part()
+        if federation is None:
+            return False
 
-                if part_content is None or len(part_content) == 0:
-                    break
+        self.log('DOWNLOAD', f'{file_id} is not stored locally, pulling it from its origin node.')
+        return federation.fetch_file(file_id, self.file_server.store, self.file_server.transfer_chunk_size)
 
-                file.write(part_content)
+    def handle_upload(self, header: TransferHeader):
+        store = self.file_server.store
 
-                uploaded += self.file_server.buf_size
-                self.log('UPLOAD', f'Received {int(100 * uploaded / file_size)}')
+        if store.has(header.content_hash) and store.size_of(header.content_hash) == header.file_size:
+            self.send_message('EXISTS')
+            self.log('UPLOAD', f'Content {header.content_hash} is already stored, skipping transfer.')
+            return self.notify_destination(header, header.content_hash)
 
-        self.log('UPLOAD', f'File reception finished. Notifying {destination_user}')
+        codec = negotiate_codec(header.compression)
 
-        self.file_server.chat_server\
-            .get_connection_by_username(destination_user)\
-            .send_to_socket(TAG_FILE, f'{source_user};{filename};{file_size}')
+        if self.file_server.relay_mode:
+            return self.handle_relayed_upload(header, codec)
+
+        self.send_message(self.get_accept_message(codec))
+        writer = store.open_writer()
+
+        try:
+            self.receive_file(writer, header.file_size, codec)
+            file_id = writer.commit(header.content_hash)
+        except BaseException:
+            writer.discard()
+            raise
+
+        self.log('UPLOAD', f'File reception finished, stored as {file_id}.')
+        self.notify_destination(header, file_id)
+
+    def handle_relayed_upload(self, header: TransferHeader, codec: str):
+        relay = self.file_server.open_relay(header.file_size)
+
+        self.send_message(self.get_accept_message(codec))
+        self.notify_destination(header, relay.relay_id, TRANSFER_MODE_RELAY)
 
-    def handle_download(self, filename: str):
-        file_path = os.path.abspath(f'{FILES_LOCATION}/{filename}')
+        try:
+            self.receive_file(relay, header.file_size, codec)
+            relay.finish()
+        except BaseException:
+            relay.fail()
+            self.file_server.close_relay(relay)
+            raise
 
-        if not os.path.exists(file_path):
-            self.send_message('ERROR')
+        if not relay.wait_for_reader(self.file_server.relay_attach_timeout):
+            self.log('WARN', f'Nobody downloaded relay {relay.relay_id}, discarding it.')
+            self.file_server.close_relay(relay)
             return
 
-        file_size = os.path.getsize(file_path)
+        self.log('UPLOAD', f'File reception finished, relayed as {relay.relay_id}.')
+
+    def notify_destination(self, header: TransferHeader, file_id: str, mode: str = TRANSFER_MODE_STORED):
+        self.log('UPLOAD', f'Notifying {header.destination_user}')
+
+        self.file_server.chat_server\
+            .get_connection_by_username(header.destination_user)\
+            .send_to_socket(TAG_FILE, f'{header.source_user};{header.filename};{header.file_size};{file_id};{mode}')
+
+    def handle_relayed_download(self, relay: RelayBuffer):
+        if not relay.attach():
+            return self.send_message('ERROR')
+
+        self.send_message(f'OK;{relay.file_size}')
+
+        buffer = memoryview(bytearray(self.file_server.transfer_chunk_size))
+        started_at = time.monotonic()
         downloaded = 0
 
-        with open(file_path, 'rb') as file:
+        try:
             while True:
-                part_content = file.read(self.file_server.buf_size)
+                count = relay.read_into(buffer)
 
-                if len(part_content) == 0:
+                if count == 0:
                     break
 
-                self.send_part(part_content)
+                self.send_part(buffer[:count])
+                downloaded += count
+        finally:
+            self.file_server.close_relay(relay)
+            self.record_transfer('out', downloaded, time.monotonic() - started_at)
+
+        self.log('DOWNLOAD', f'Relay of {relay.relay_id} finished. {format_throughput(downloaded, time.monotonic() - started_at)} {"with disk spill-over" if relay.is_spilled() else "from memory"}.')
+
+    def handle_download(self, file_id: str, offset: int, length: int, requested_codec: str = CODEC_NONE):
+        relay = self.file_server.get_relay(file_id)
+
+        if relay is not None:
+            return self.handle_relayed_download(relay)
+
+        file_path = self.file_server.store.path_for(file_id)
+
+        file_size = os.path.getsize(file_path)
+        count = file_size - offset if length < 0 else min(length, file_size - offset)
+
+        with open(file_path, 'rb') as file:
+            codec = self.choose_codec(file, offset, count, requested_codec)
+            self.send_message(f'OK;{count};{codec}' if codec else f'OK;{count}')
+
+            use_sendfile = not codec and self.file_server.use_sendfile and hasattr(os, 'sendfile')
+            started_at = time.monotonic()
+
+            if codec:
+                file.seek(offset)
+                downloaded = send_compressed(file, self.send_part, count, codec, self.file_server.transfer_chunk_size)
+            elif use_sendfile:
+                downloaded = self.socket.sendfile(file, offset, count) if count > 0 else 0
+            else:
+                downloaded = self.send_file_buffered(file, offset, count)
 
-                downloaded += self.file_server.buf_size
-                self.log('DOWNLOAD', f'Transferred {int(100 * downloaded / file_size)}%')
+        self.record_transfer('out', downloaded, time.monotonic() - started_at)
+        self.log('DOWNLOAD', f'File transfer of bytes {offset}-{offset + count} finished. {format_throughput(downloaded, time.monotonic() - started_at)} using {codec or ("sendfile" if use_sendfile else "buffered copy")}.')
 
-        self.log('DOWNLOAD', f'File transfer finished.')
+    def choose_codec(self, file, offset: int, count: int, requested_codec: str) -> str:
+        codec = negotiate_codec(requested_codec)
+
+        if not codec:
+            return CODEC_NONE
+
+        file.seek(offset)
+
+        if not is_compressible(file.read(min(SAMPLE_SIZE, count))):
+            compression_skipped.inc()
+            self.log('DOWNLOAD', f'Content does not compress, sending it without {codec}.')
+            return CODEC_NONE
+
+        return codec
+
+    @staticmethod
+    def get_accept_message(codec: str) -> str:
+        return f'OK;{codec}' if codec else 'OK'
+
+    def send_file_buffered(self, file, offset: int, count: int) -> int:
+        downloaded = 0
+        progress = ProgressReporter(self.log, 'DOWNLOAD', 'Transferred %d%%', count)
+        file.seek(offset)
+
+        while downloaded < count:
+            part_content = file.read(min(self.file_server.transfer_chunk_size, count - downloaded))
+
+            if len(part_content) == 0:
+                break
+
+            self.send_part(part_content)
+
+            downloaded += len(part_content)
+            progress.update(downloaded)
+
+        return downloaded
 
     def send_part(self, part_content: bytes):
         if self.socket is None:
@@ -116,31 +277,110 @@ class FileTransferConnection(Thread):
 
         self.socket.sendall(part_content)
 
-    def receive_part(self) -> bytes:
+    def receive_file(self, file, file_size: int, codec: str = CODEC_NONE) -> int:
         if self.socket is None:
             raise Exception('No socket connection is available to this file downloader.')
 
-        return self.socket.recv(self.file_server.buf_size)
+        if codec:
+            return self.receive_compressed_file(file, file_size, codec)
+
+        chunk_size = self.file_server.transfer_chunk_size
+        buffer = memoryview(bytearray(chunk_size))
+        received = 0
+        progress = ProgressReporter(self.log, 'UPLOAD', 'Received %d%%', file_size)
+        started_at = time.monotonic()
+
+        if self.pending:
+            received = file.write(self.pending[:file_size])
+            self.pending = bytearray()
+
+        while received < file_size:
+            count = self.socket.recv_into(buffer, min(chunk_size, file_size - received))
+
+            if count == 0:
+                raise Exception(f'Connection closed after receiving {received} of {file_size} bytes.')
+
+            file.write(buffer[:count])
+
+            received += count
+            progress.update(received)
+
+        self.record_transfer('in', received, time.monotonic() - started_at)
+        return received
+
+    def receive_compressed_file(self, file, file_size: int, codec: str) -> int:
+        decompressor = create_decompressor(codec)
+        buffer = memoryview(bytearray(self.file_server.transfer_chunk_size))
+        received = 0
+        wire_received = 0
+        progress = ProgressReporter(self.log, 'UPLOAD', 'Received %d%%', file_size)
+        started_at = time.monotonic()
+
+        data = bytes(self.pending)
+        self.pending = bytearray()
+
+        while not decompressor.eof:
+            if not data:
+                count = self.socket.recv_into(buffer)
+
+                if count == 0:
+                    raise Exception(f'Connection closed after receiving {received} of {file_size} bytes.')
+
+                data = buffer[:count]
+
+            wire_received += len(data)
+            # Never inflates more than one byte past the announced size, a small upload cannot expand into gigabytes.
+            part_content = decompressor.decompress(data, file_size - received + 1)
+            data = b''
+
+            received += len(part_content)
+            if received > file_size:
+                raise Exception(f'Decompressed content is larger than the announced {file_size} bytes.')
+
+            file.write(part_content)
+            progress.update(received)
+
+        self.pending = bytearray(decompressor.unused_data)
+        wire_received -= len(self.pending)
+
+        if received != file_size:
+            raise Exception(f'Compressed stream ended after {received} of {file_size} bytes.')
+
+        self.record_transfer('in', wire_received, time.monotonic() - started_at)
+        self.log('UPLOAD', f'Received {wire_received} compressed bytes for {received} bytes of content using {codec}.')
+
+        return received
+
+    @staticmethod
+    def record_transfer(direction: str, byte_count: int, elapsed: float):
+        transfer_bytes.inc(byte_count, direction)
+
+        if elapsed > 0:
+            transfer_throughput.observe(byte_count / elapsed)
 
     def send_message(self, message: str):
         if self.socket is None:
             raise Exception('No socket connection is available to this file uploader.')
 
-        self.socket.sendall(message.encode('ASCII'))
+        self.socket.sendall(f'{message}\n'.encode('ASCII'))
 
     def receive_message(self) -> str:
         if self.socket is None:
             raise Exception('No socket connection is available to this file uploader.')
 
-        data = self.socket.recv(self.file_server.buf_size)
+        while b'\n' not in self.pending:
+            data = self.socket.recv(self.file_server.buf_size)
 
-        if not data:
-            raise Exception('No data received on socket. Was the connection interrupted?')
+            if not data:
+                raise Exception('No data received on socket. Was the connection interrupted?')
 
-        return data.decode('ASCII')
+            self.pending += data
 
-    def log(self, label: str, message: str):
-        print(f'(FILE SERVER - {self.address}) : [{label}] - {message}')
+        message, _, self.pending = self.pending.partition(b'\n')
+        return message.decode('ASCII')
+
+    def log(self, label: str, message: str, *args):
+        logger.log(f'(FILE SERVER - {self.address}) ', label, message, *args)
 
 
 class FileTransferServer(Thread):
@@ -152,8 +392,18 @@ class FileTransferServer(Thread):
         self.port = port
         self.buf_size = kwargs.get('buffer_size') or DEFAULT_BUFFER_SIZE
         self.max_connections = kwargs.get('max_connections') or DEFAULT_MAX_CONNECTIONS
-
-        self.connections = dict()
+        self.transfer_chunk_size = kwargs.get('transfer_chunk_size') or DEFAULT_TRANSFER_CHUNK_SIZE
+        self.use_sendfile = kwargs.get('use_sendfile', True)
+
+        self.reuse_port = kwargs.get('reuse_port', False)
+        self.relay_mode = kwargs.get('relay_mode', False)
+        self.relay_buffer_size = kwargs.get('relay_buffer_size') or DEFAULT_RELAY_BUFFER_SIZE
+        self.relay_attach_timeout = kwargs.get('relay_attach_timeout') or DEFAULT_RELAY_ATTACH_TIMEOUT
+
+        self.store = ContentStore(kwargs.get('files_location') or FILES_LOCATION)
+        self.relays = dict()  # relay_id -> RelayBuffer
+        self.relays_lock = Lock()
+        self.connections = ConnectionRegistry()
         self.socket = None
 
     def run(self):
@@ -162,6 +412,10 @@ class FileTransferServer(Thread):
     def initialize(self):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         self.socket.bind(('', self.port))
         self.socket.listen(self.max_connections)
 
@@ -176,7 +430,7 @@ class FileTransferServer(Thread):
                 client_socket, client_address = self.socket.accept()
 
                 connection = FileTransferConnection(self, client_socket, client_address)
-                self.connections[client_address] = connection
+                self.connections.add(connection)
                 connection.log('INFO', 'Initializing file transfer.')
                 connection.start()
 
@@ -186,23 +440,39 @@ class FileTransferServer(Thread):
         self.log('INFO', 'Closing file server...')
         self.close_server()
 
+    def open_relay(self, file_size: int) -> RelayBuffer:
+        relay = RelayBuffer(uuid.uuid4().hex, file_size, self.relay_buffer_size, self.store.temp_location)
+
+        with self.relays_lock:
+            self.relays[relay.relay_id] = relay
+
+        return relay
+
+    def get_relay(self, relay_id: str):
+        return self.relays.get(relay_id)
+
+    def close_relay(self, relay: RelayBuffer):
+        with self.relays_lock:
+            if self.relays.get(relay.relay_id) is relay:
+                del self.relays[relay.relay_id]
+
+        relay.release()
+
     def close_connection(self, connection: FileTransferConnection):
-        if self.connections.get(connection.address) is None:
+        if not self.connections.remove(connection):
             return
 
         connection.socket.close()
         connection.log('INFO', 'Closed file transfer connection.')
 
-        del self.connections[connection.address]
-
     def close_server(self):
         if self.socket is None:
             raise Exception('No socket connection is available to this file server.')
 
         self.socket.close()
-        for connection in self.connections.values():
+        for connection in self.connections.snapshot():
             connection.socket.close()
 
     @staticmethod
-    def log(label: str, message: str):
-        print(f'(FILE SERVER): [{label}] - {message}')
+    def log(label: str, message: str, *args):
+        logger.log('(FILE SERVER)', label, message, *args)
@@ -0,0 +1,61 @@
+import time
+from .timerwheel import TimerWheel
+from .metrics import metrics, connections_reaped
+
+DEFAULT_IDLE_TIMEOUT = 60  # seconds without traffic before a connection is pinged, 0 disables heartbeats
+DEFAULT_PONG_TIMEOUT = 15  # seconds a pinged connection has to answer
+DEFAULT_HEARTBEAT_TICK = 1
+
+PING = 'ping'
+PONG = 'pong'
+
+
+class HeartbeatMonitor:
+    def __init__(self, chat_server, tag: str, idle_timeout: float, pong_timeout: float, **kwargs):
+        self.chat_server = chat_server
+        self.tag = tag
+        self.idle_timeout = idle_timeout
+        self.pong_timeout = pong_timeout
+        self.tick = kwargs.get('tick') or DEFAULT_HEARTBEAT_TICK
+
+        self.wheel = TimerWheel(self.tick, max(idle_timeout, pong_timeout))
+
+        metrics.gauge('chat_heartbeat_timers', 'Connections with a pending heartbeat deadline.', lambda: len(self.wheel))
+
+    def watch(self, connection):
+        self.wheel.schedule(connection, self.idle_timeout)
+
+    def forget(self, connection):
+        self.wheel.cancel(connection)
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            self.check(time.monotonic())
+
+    def check(self, now: float):
+        for connection in self.wheel.advance(now):
+            try:
+                self._check_connection(connection, now)
+            except Exception as error:
+                connection.log('ERROR', f'Heartbeat check failed: {error}')
+
+    def _check_connection(self, connection, now: float):
+        idle = now - connection.last_activity
+
+        # Traffic only stamps last_activity, the deadline is pushed back lazily when it comes up.
+        if idle < self.idle_timeout:
+            return self.wheel.schedule(connection, self.idle_timeout - idle)
+
+        if connection.ping_sent_at is None or connection.ping_sent_at < connection.last_activity:
+            # One blocked send would stop reaping for every connection, a peer whose queue is full is as good as dead.
+            if connection.try_send_to_socket(self.tag, PING):
+                connection.ping_sent_at = now
+                return self.wheel.schedule(connection, self.pong_timeout)
+
+            connection.log('WARN', f'No traffic for {idle:.0f}s and no room to queue a ping, closing.')
+        else:
+            connection.log('WARN', f'No traffic for {idle:.0f}s and no answer to ping, closing.')
+
+        connections_reaped.inc()
+        self.chat_server.close_connection(connection)
@@ -0,0 +1,261 @@
+import hashlib
+import mmap
+import os
+import struct
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from threading import RLock
+from .logger import logger
+from .metrics import history_messages_recorded, history_pages_served
+
+HISTORY_LOCATION = os.path.abspath(f'{os.path.realpath(os.path.dirname(__file__))}/../history')
+
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_OPEN_CONVERSATIONS = 128
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+RECORD_HEADER = struct.Struct('!QQI')  # sequence, timestamp in ms, payload length
+INDEX_ENTRY = struct.Struct('!QQQI')  # sequence, timestamp in ms, record offset, payload length
+
+SEGMENT_PREFIX = 'segment-'
+DATA_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+
+
+def close_map(file_map):
+    # Empty files cannot be mapped and stand in as empty bytes.
+    if isinstance(file_map, mmap.mmap):
+        file_map.close()
+
+
+def get_conversation(username: str, peer_username: str) -> str:
+    # Both sides of a private chat share one history, whoever asks for it.
+    return '\0'.join(sorted((username, peer_username)))
+
+
+class Conversation:
+    def __init__(self, location: str):
+        self.location = location
+
+        self.segments = []  # first sequence of each segment, oldest first
+        self.next_sequence = 1
+
+        self.data_fd = None
+        self.index_fd = None
+        self.data_size = 0
+
+        self.maps = dict()  # segment -> (index mmap, data mmap)
+
+    def close(self):
+        for index_map, data_map in self.maps.values():
+            close_map(index_map)
+            close_map(data_map)
+        self.maps.clear()
+
+        for fd in (self.data_fd, self.index_fd):
+            if fd is not None:
+                os.close(fd)
+
+        self.data_fd = None
+        self.index_fd = None
+
+
+class HistoryStore:
+    def __init__(self, location: str = HISTORY_LOCATION, **kwargs):
+        self.location = location
+        self.segment_size = kwargs.get('segment_size') or DEFAULT_SEGMENT_SIZE
+        self.open_conversations = kwargs.get('open_conversations') or DEFAULT_OPEN_CONVERSATIONS
+
+        self.lock = RLock()
+        self.conversations = OrderedDict()  # conversation -> Conversation, least recently used first
+
+    def initialize(self):
+        os.makedirs(self.location, exist_ok=True)
+        self.log('INFO', f'Keeping chat history in {self.location}')
+
+    def append(self, conversation: str, sender: str, message: str) -> int:
+        payload = f'{sender};{message}'.encode('UTF-8')
+        timestamp = int(time.time() * 1000)
+
+        with self.lock:
+            state = self._get_conversation(conversation)
+
+            if state.data_fd is None or state.data_size >= self.segment_size:
+                self._open_segment(state, state.next_sequence)
+
+            sequence = state.next_sequence
+            record_offset = state.data_size
+
+            # The record goes first, an index entry only ever points at data that is already on disk.
+            os.write(state.data_fd, RECORD_HEADER.pack(sequence, timestamp, len(payload)) + payload)
+            os.write(state.index_fd, INDEX_ENTRY.pack(sequence, timestamp, record_offset, len(payload)))
+
+            state.data_size += RECORD_HEADER.size + len(payload)
+            state.next_sequence += 1
+
+        history_messages_recorded.inc()
+        return sequence
+
+    def page(self, conversation: str, before: int, count: int) -> tuple:
+        # Up to count records older than before (0 for the newest), oldest first, and the before of the next older page (0 at the start).
+        count = max(1, min(count or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+        records = []
+
+        with self.lock:
+            state = self._get_conversation(conversation)
+
+            end = state.next_sequence if before <= 0 else min(before, state.next_sequence)
+            position = bisect_right(state.segments, end - 1) - 1
+
+            while position >= 0 and len(records) < count:
+                segment = state.segments[position]
+                index_map, data_map = self._map_segment(state, segment)
+
+                # Sequences are dense inside a segment, so the index entry of a sequence is found by arithmetic.
+                last = min(end, segment + len(index_map) // INDEX_ENTRY.size)
+                first = max(segment, last - (count - len(records)))
+
+                segment_records = []
+                for sequence, timestamp, record_offset, length in INDEX_ENTRY.iter_unpack(index_map[(first - segment) * INDEX_ENTRY.size:(last - segment) * INDEX_ENTRY.size]):
+                    payload_offset = record_offset + RECORD_HEADER.size
+                    sender, _, message = data_map[payload_offset:payload_offset + length].decode('UTF-8').partition(';')
+                    segment_records.append((sequence, timestamp, sender, message))
+
+                records[:0] = segment_records
+                end = first
+                position -= 1
+
+        history_pages_served.inc()
+
+        next_before = records[0][0] if records and records[0][0] > 1 else 0
+        return records, next_before
+
+    def close(self):
+        with self.lock:
+            for state in self.conversations.values():
+                state.close()
+            self.conversations.clear()
+
+    def _get_conversation(self, conversation: str) -> Conversation:
+        state = self.conversations.get(conversation)
+
+        if state is not None:
+            self.conversations.move_to_end(conversation)
+            return state
+
+        state = Conversation(os.path.join(self.location, hashlib.sha1(conversation.encode('UTF-8')).hexdigest()))
+        self._load_conversation(state)
+
+        self.conversations[conversation] = state
+        while len(self.conversations) > self.open_conversations:
+            _, evicted = self.conversations.popitem(last=False)
+            evicted.close()
+
+        return state
+
+    def _load_conversation(self, state: Conversation):
+        if not os.path.isdir(state.location):
+            return
+
+        state.segments = sorted(
+            int(name[len(SEGMENT_PREFIX):-len(DATA_SUFFIX)])
+            for name in os.listdir(state.location)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(DATA_SUFFIX)
+        )
+
+        if state.segments:
+            self._recover_segment(state, state.segments[-1])
+
+    def _recover_segment(self, state: Conversation, segment: int):
+        data_path, index_path = self._get_segment_paths(state, segment)
+
+        with open(data_path, 'r+b') as data_file, open(index_path, 'a+b') as index_file:
+            index_file.seek(0)
+            index = index_file.read()
+            data = data_file.read()
+
+            # Drop a torn index entry, then re-index whatever records made it to disk after the last good one.
+            entries = len(index) // INDEX_ENTRY.size
+            index_file.truncate(entries * INDEX_ENTRY.size)
+
+            offset = 0
+            if entries:
+                _, _, record_offset, length = INDEX_ENTRY.unpack_from(index, (entries - 1) * INDEX_ENTRY.size)
+                offset = record_offset + RECORD_HEADER.size + length
+
+            sequence = segment + entries
+            rebuilt = 0
+
+            while offset + RECORD_HEADER.size <= len(data):
+                record_sequence, timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+
+                if record_sequence != sequence or offset + RECORD_HEADER.size + length > len(data):
+                    break
+
+                index_file.write(INDEX_ENTRY.pack(sequence, timestamp, offset, length))
+                offset += RECORD_HEADER.size + length
+                sequence += 1
+                rebuilt += 1
+
+            if offset < len(data):
+                self.log('WARN', f'Discarding {len(data) - offset} bytes of torn records at the end of {data_path}')
+                data_file.truncate(offset)
+
+            if rebuilt:
+                self.log('WARN', f'Rebuilt {rebuilt} index entries for {data_path}')
+
+        state.next_sequence = sequence
+        self._open_writers(state, segment)
+
+    def _open_segment(self, state: Conversation, segment: int):
+        os.makedirs(state.location, exist_ok=True)
+
+        if state.data_fd is not None:
+            os.close(state.data_fd)
+            os.close(state.index_fd)
+
+        state.segments.append(segment)
+        self._open_writers(state, segment)
+
+    def _open_writers(self, state: Conversation, segment: int):
+        data_path, index_path = self._get_segment_paths(state, segment)
+
+        state.data_fd = os.open(data_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        state.index_fd = os.open(index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        state.data_size = os.fstat(state.data_fd).st_size
+
+    def _map_segment(self, state: Conversation, segment: int) -> tuple:
+        maps = state.maps.get(segment)
+        data_path, index_path = self._get_segment_paths(state, segment)
+
+        # The active segment keeps growing, its maps are only replaced once they no longer cover the file.
+        if maps is not None and len(maps[0]) == os.path.getsize(index_path):
+            return maps
+
+        if maps is not None:
+            close_map(maps[0])
+            close_map(maps[1])
+
+        maps = (self._map_file(index_path), self._map_file(data_path))
+        state.maps[segment] = maps
+
+        return maps
+
+    @staticmethod
+    def _map_file(path: str):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b''
+
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def _get_segment_paths(state: Conversation, segment: int) -> tuple:
+        name = os.path.join(state.location, f'{SEGMENT_PREFIX}{segment:012d}')
+        return f'{name}{DATA_SUFFIX}', f'{name}{INDEX_SUFFIX}'
+
+    @staticmethod
+    def log(label: str, message: str, *args):
+        logger.log('(HISTORY)', label, message, *args)
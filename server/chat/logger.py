@@ -0,0 +1,118 @@
+import atexit
+import os
+import sys
+import time
+from queue import SimpleQueue
+from threading import Thread, Lock
+
+LOG_LEVELS = {
+    'DEBUG': 10,
+    'INFO': 20,
+    'UPLOAD': 20,
+    'DOWNLOAD': 20,
+    'WARN': 30,
+    'ERROR': 40
+}
+
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_PROGRESS_INTERVAL = 1
+
+
+class LogWriter(Thread):
+    def __init__(self, stream):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.stream = stream
+        self.records = SimpleQueue()
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            lines = []
+
+            while record is not None:
+                lines.append(record)
+
+                if self.records.empty():
+                    break
+
+                record = self.records.get()
+
+            if lines:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+
+            if record is None:
+                break
+
+
+class Logger:
+    def __init__(self, level: str = DEFAULT_LOG_LEVEL, stream=sys.stdout):
+        self.threshold = LOG_LEVELS.get(level, LOG_LEVELS.get(DEFAULT_LOG_LEVEL))
+        self.stream = stream
+
+        self.writer = None
+        self.writer_pid = None
+        self.writer_lock = Lock()
+
+    def set_level(self, level: str):
+        if level not in LOG_LEVELS:
+            raise Exception(f'Unknown log level {level}.')
+
+        self.threshold = LOG_LEVELS.get(level)
+
+    def is_enabled(self, label: str) -> bool:
+        return LOG_LEVELS.get(label, 20) >= self.threshold
+
+    def log(self, source: str, label: str, message: str, *args):
+        if LOG_LEVELS.get(label, 20) < self.threshold:
+            return
+
+        if args:
+            message = message % args
+
+        self._get_writer().records.put(f'{source}: [{label}] - {message}')
+
+    def close(self):
+        if self.writer is None or self.writer_pid != os.getpid():
+            return
+
+        self.writer.records.put(None)
+        self.writer.join(1)
+
+    def _get_writer(self) -> LogWriter:
+        # A forked worker inherits the writer object but not its thread, so it starts its own.
+        if self.writer is None or self.writer_pid != os.getpid():
+            with self.writer_lock:
+                if self.writer is None or self.writer_pid != os.getpid():
+                    writer = LogWriter(self.stream)
+                    writer.start()
+                    self.writer = writer
+                    self.writer_pid = os.getpid()
+
+        return self.writer
+
+
+class ProgressReporter:
+    def __init__(self, log, label: str, message: str, total: int, interval: float = DEFAULT_PROGRESS_INTERVAL):
+        self.log = log
+        self.label = label
+        self.message = message
+        self.total = total
+        self.interval = interval
+
+        self.last_report = time.monotonic()
+
+    def update(self, done: int):
+        now = time.monotonic()
+
+        if now - self.last_report < self.interval and done < self.total:
+            return
+
+        self.last_report = now
+        self.log(self.label, self.message, int(100 * done / self.total) if self.total > 0 else 100)
+
+
+logger = Logger()
+atexit.register(logger.close)
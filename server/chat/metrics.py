@@ -0,0 +1,177 @@
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Lock
+
+DEFAULT_STATS_PORT = 0  # disabled
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+THROUGHPUT_BUCKETS = (1024 ** 2, 10 * 1024 ** 2, 50 * 1024 ** 2, 100 * 1024 ** 2, 500 * 1024 ** 2, 1024 ** 3)
+
+
+def format_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names:
+        return ''
+
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(label_names, label_values))
+    return f'{{{pairs}}}'
+
+
+class Counter:
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+
+        self.lock = Lock()
+        self.values = dict()
+
+    def inc(self, amount: float = 1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+
+        with self.lock:
+            values = list(self.values.items())
+
+        for label_values, value in sorted(values):
+            lines.append(f'{self.name}{format_labels(self.label_names, label_values)} {value}')
+
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, description: str, fn=None):
+        self.name = name
+        self.description = description
+        self.fn = fn
+
+        self.lock = Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def render(self) -> list:
+        value = self.fn() if self.fn is not None else self.value
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge', f'{self.name} {value}']
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+
+        self.lock = Lock()
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+
+        with self.lock:
+            counts = list(self.counts)
+            total_sum = self.sum
+            total_count = self.count
+
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total_count}')
+        lines.append(f'{self.name}_sum {total_sum}')
+        lines.append(f'{self.name}_count {total_count}')
+
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = dict()  # name -> metric
+
+    def counter(self, name: str, description: str, label_names: tuple = ()) -> Counter:
+        return self._register(Counter(name, description, label_names))
+
+    def gauge(self, name: str, description: str, fn=None) -> Gauge:
+        return self._register(Gauge(name, description, fn))
+
+    def histogram(self, name: str, description: str, buckets: tuple) -> Histogram:
+        return self._register(Histogram(name, description, buckets))
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render().encode('UTF-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(Thread):
+    def __init__(self, registry: MetricsRegistry, port: int):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.http_server = ThreadingHTTPServer(('127.0.0.1', port), MetricsRequestHandler)
+        self.http_server.registry = registry
+        self.port = port
+
+    def run(self):
+        self.http_server.serve_forever()
+
+
+metrics = MetricsRegistry()
+
+connections_accepted = metrics.counter('chat_connections_total', 'Chat connections accepted.')
+connections_reaped = metrics.counter('chat_connections_reaped_total', 'Chat connections closed for not answering heartbeats.')
+messages_received = metrics.counter('chat_messages_received_total', 'Chat frames received, by tag.', ('tag',))
+messages_sent = metrics.counter('chat_messages_sent_total', 'Chat frames queued for sending, by tag.', ('tag',))
+bytes_received = metrics.counter('chat_bytes_received_total', 'Bytes read from chat sockets.')
+bytes_sent = metrics.counter('chat_bytes_sent_total', 'Bytes written to chat sockets.')
+socket_writes = metrics.counter('chat_socket_writes_total', 'Write calls made on chat sockets after coalescing.')
+routing_latency = metrics.histogram('chat_routing_latency_seconds', 'Time spent handling a received frame.', LATENCY_BUCKETS)
+
+offline_messages_queued = metrics.counter('chat_offline_messages_queued_total', 'Messages stored for offline recipients.')
+offline_commits = metrics.counter('chat_offline_commits_total', 'Group commits (fsyncs) of the offline message log.')
+history_messages_recorded = metrics.counter('chat_history_messages_recorded_total', 'Messages appended to the chat history.')
+history_pages_served = metrics.counter('chat_history_pages_served_total', 'History pages read for clients.')
+
+transfers_started = metrics.counter('file_transfers_total', 'File transfers started, by operation.', ('operation',))
+transfers_active = metrics.gauge('file_transfers_active', 'File transfers in progress.')
+transfer_bytes = metrics.counter('file_transfer_bytes_total', 'File bytes moved, by direction.', ('direction',))
+compression_skipped = metrics.counter('file_transfer_compression_skipped_total', 'Compressed downloads sent raw because the content sampled as incompressible.')
+transfer_throughput = metrics.histogram('file_transfer_throughput_bytes_per_second', 'Throughput of finished file transfers.', THROUGHPUT_BUCKETS)
@@ -0,0 +1,292 @@
+import os
+import struct
+import time
+import zlib
+from threading import Thread, Condition
+from .logger import logger
+from .metrics import metrics, offline_messages_queued, offline_commits
+
+OFFLINE_LOCATION = os.path.abspath(f'{os.path.realpath(os.path.dirname(__file__))}/../offline')
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_COMMIT_INTERVAL = 0.01  # seconds between group commits
+DEFAULT_MAX_PENDING_PER_USER = 1000
+
+RECORD_MESSAGE = 1
+RECORD_ACK = 2
+RECORD_HEADER = struct.Struct('!BIHI')  # record type, body length, recipient length, crc32 of recipient and body
+ACK_BODY = struct.Struct('!IQ')  # segment, record offset of the last delivered message
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+USERS_FILE = 'users'
+
+
+class OfflineQueue(Thread):
+    def __init__(self, location: str = OFFLINE_LOCATION, **kwargs):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.location = location
+        self.segment_size = kwargs.get('segment_size') or DEFAULT_SEGMENT_SIZE
+        self.commit_interval = kwargs.get('commit_interval') or DEFAULT_COMMIT_INTERVAL
+        self.max_pending_per_user = kwargs.get('max_pending_per_user') or DEFAULT_MAX_PENDING_PER_USER
+
+        self.condition = Condition()
+
+        self.index = dict()  # recipient -> [(segment, record offset, body offset, body length)]
+        self.users = set()  # everybody who ever logged in, messages are only kept for them
+        self.users_file = None
+        self.segments = []  # segment numbers on disk, oldest first
+        self.segment_refs = dict()  # segment -> undelivered messages stored in it
+        self.read_fds = dict()  # segment -> file descriptor
+        self.pending = 0
+
+        self.active_segment = 0
+        self.active_file = None
+        self.active_size = 0
+
+        self.dirty = False
+        self.commit_callbacks = []
+
+        metrics.gauge('chat_offline_messages_pending', 'Messages waiting for an offline recipient.', lambda: self.pending)
+
+    def initialize(self):
+        os.makedirs(self.location, exist_ok=True)
+
+        users_path = os.path.join(self.location, USERS_FILE)
+        if os.path.exists(users_path):
+            with open(users_path, 'r', encoding='UTF-8') as users_file:
+                self.users.update(username for username in users_file.read().split('\n') if username)
+
+        self.users_file = open(users_path, 'a', encoding='UTF-8')
+
+        for segment in sorted(self._list_segments()):
+            self.segments.append(segment)
+            self.segment_refs[segment] = 0
+            self._recover_segment(segment)
+
+        self.active_segment = self.segments[-1] if self.segments else 1
+        self._open_active_segment()
+        self._collect_segments()
+
+        self.log('INFO', f'Recovered {self.pending} offline messages for {len(self.index)} users from {len(self.segments)} segments')
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.dirty:
+                    self.condition.wait()
+
+                self.active_file.flush()
+                commit_fd = os.dup(self.active_file.fileno())
+
+                callbacks = self.commit_callbacks
+                self.commit_callbacks = []
+                self.dirty = False
+
+            # One fsync covers every record appended since the previous commit.
+            try:
+                os.fsync(commit_fd)
+            finally:
+                os.close(commit_fd)
+
+            offline_commits.inc()
+
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as error:
+                    self.log('ERROR', f'Commit callback failed: {error}')
+
+            time.sleep(self.commit_interval)
+
+    def add_user(self, username: str):
+        if username in self.users or '\n' in username:
+            return
+
+        with self.condition:
+            self.users.add(username)
+            self.users_file.write(f'{username}\n')
+            self.users_file.flush()
+
+    def is_known_user(self, username: str) -> bool:
+        # Users recovered from older queues without a users file still get their pending messages.
+        return username in self.users or username in self.index
+
+    def append(self, recipient: str, message: str, on_commit=None) -> bool:
+        body = message.encode('UTF-8')
+
+        with self.condition:
+            entries = self.index.get(recipient)
+
+            if entries is not None and len(entries) >= self.max_pending_per_user:
+                return False
+
+            record_offset, body_offset = self._write_record(RECORD_MESSAGE, recipient, body)
+
+            self.index.setdefault(recipient, []).append((self.active_segment, record_offset, body_offset, len(body)))
+            self.segment_refs[self.active_segment] += 1
+            self.pending += 1
+
+            if on_commit is not None:
+                self.commit_callbacks.append(on_commit)
+
+        offline_messages_queued.inc()
+        return True
+
+    def take(self, recipient: str) -> list:
+        with self.condition:
+            entries = list(self.index.get(recipient, ()))
+
+            if entries:
+                self.active_file.flush()
+
+            read_fds = [self._get_read_fd(segment) for segment, _, _, _ in entries]
+
+        return [
+            ((segment, record_offset), os.pread(read_fd, body_length, body_offset).decode('UTF-8'))
+            for (segment, record_offset, body_offset, body_length), read_fd in zip(entries, read_fds)
+        ]
+
+    def acknowledge(self, recipient: str, position: tuple):
+        with self.condition:
+            entries = self.index.get(recipient)
+
+            if not entries:
+                return
+
+            self._write_record(RECORD_ACK, recipient, ACK_BODY.pack(*position))
+            self._remove_delivered(recipient, position)
+            self._collect_segments()
+
+    def close(self):
+        with self.condition:
+            self.active_file.flush()
+            os.fsync(self.active_file.fileno())
+            self.active_file.close()
+            self.users_file.close()
+
+            for read_fd in self.read_fds.values():
+                os.close(read_fd)
+            self.read_fds.clear()
+
+    def _write_record(self, record_type: int, recipient: str, body: bytes) -> tuple:
+        if self.active_size >= self.segment_size:
+            self._roll_segment()
+
+        recipient_bytes = recipient.encode('UTF-8')
+        checksum = zlib.crc32(body, zlib.crc32(recipient_bytes))
+
+        record_offset = self.active_size
+        body_offset = record_offset + RECORD_HEADER.size + len(recipient_bytes)
+
+        self.active_file.write(RECORD_HEADER.pack(record_type, len(body), len(recipient_bytes), checksum) + recipient_bytes + body)
+        self.active_size = body_offset + len(body)
+
+        self.dirty = True
+        self.condition.notify_all()
+
+        return record_offset, body_offset
+
+    def _remove_delivered(self, recipient: str, position: tuple):
+        remaining = []
+
+        for entry in self.index.get(recipient, ()):
+            if (entry[0], entry[1]) <= tuple(position):
+                self.segment_refs[entry[0]] -= 1
+                self.pending -= 1
+            else:
+                remaining.append(entry)
+
+        if remaining:
+            self.index[recipient] = remaining
+        else:
+            self.index.pop(recipient, None)
+
+    def _roll_segment(self):
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+        self.active_file.close()
+
+        self.active_segment += 1
+        self._open_active_segment()
+        self._collect_segments()
+
+    def _open_active_segment(self):
+        self.active_file = open(self._get_segment_path(self.active_segment), 'ab')
+        self.active_size = self.active_file.tell()
+
+        if not self.segments or self.segments[-1] != self.active_segment:
+            self.segments.append(self.active_segment)
+            self.segment_refs[self.active_segment] = 0
+
+    def _collect_segments(self):
+        # Only the oldest segments go, so an acknowledgement is never deleted before the messages it covers.
+        while len(self.segments) > 1 and self.segment_refs.get(self.segments[0]) == 0:
+            segment = self.segments.pop(0)
+            del self.segment_refs[segment]
+
+            read_fd = self.read_fds.pop(segment, None)
+            if read_fd is not None:
+                os.close(read_fd)
+
+            os.remove(self._get_segment_path(segment))
+
+    def _recover_segment(self, segment: int):
+        segment_path = self._get_segment_path(segment)
+
+        with open(segment_path, 'rb') as segment_file:
+            data = segment_file.read()
+
+        offset = 0
+
+        while offset + RECORD_HEADER.size <= len(data):
+            record_type, body_length, recipient_length, checksum = RECORD_HEADER.unpack_from(data, offset)
+
+            recipient_offset = offset + RECORD_HEADER.size
+            body_offset = recipient_offset + recipient_length
+            end = body_offset + body_length
+
+            if end > len(data) or zlib.crc32(data[body_offset:end], zlib.crc32(data[recipient_offset:body_offset])) != checksum:
+                break
+
+            recipient = data[recipient_offset:body_offset].decode('UTF-8')
+
+            if record_type == RECORD_MESSAGE:
+                self.index.setdefault(recipient, []).append((segment, offset, body_offset, body_length))
+                self.segment_refs[segment] += 1
+                self.pending += 1
+            elif record_type == RECORD_ACK:
+                self._remove_delivered(recipient, ACK_BODY.unpack_from(data, body_offset))
+
+            offset = end
+
+        if offset < len(data):
+            self.log('WARN', f'Discarding {len(data) - offset} bytes of torn records at the end of {segment_path}')
+
+            with open(segment_path, 'r+b') as segment_file:
+                segment_file.truncate(offset)
+
+    def _get_read_fd(self, segment: int) -> int:
+        read_fd = self.read_fds.get(segment)
+
+        if read_fd is None:
+            read_fd = os.open(self._get_segment_path(segment), os.O_RDONLY)
+            self.read_fds[segment] = read_fd
+
+        return read_fd
+
+    def _list_segments(self) -> list:
+        return [
+            int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.location)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        ]
+
+    def _get_segment_path(self, segment: int) -> str:
+        return os.path.join(self.location, f'{SEGMENT_PREFIX}{segment:08d}{SEGMENT_SUFFIX}')
+
+    @staticmethod
+    def log(label: str, message: str, *args):
+        logger.log('(OFFLINE QUEUE)', label, message, *args)
@@ -0,0 +1,156 @@
+import time
+from collections import deque
+from threading import Condition, Thread
+from typing import Optional
+from .metrics import bytes_sent, socket_writes
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_DISCONNECT, OVERFLOW_BLOCK)
+
+DEFAULT_HIGH_WATERMARK = 1024 * 1024
+DEFAULT_LOW_WATERMARK = 256 * 1024
+DEFAULT_OVERFLOW_POLICY = OVERFLOW_DROP
+
+DEFAULT_COALESCE_SIZE = 16 * 1024
+DEFAULT_COALESCE_DELAY = 0  # seconds, 0 flushes whatever is queued without waiting
+
+
+class OutboundQueue:
+    def __init__(self, high_watermark: int, low_watermark: int, policy: str):
+        if policy not in OVERFLOW_POLICIES:
+            raise Exception(f'Unknown outbound overflow policy {policy}.')
+
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.policy = policy
+
+        self.condition = Condition()
+        self.frames = deque()
+        self.size = 0
+        self.closed = False
+        self.throttled = False
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_size = 0
+
+    def put(self, frame: bytes, block: bool = True) -> bool:
+        with self.condition:
+            if self.closed:
+                return False
+
+            # An empty queue takes any frame, otherwise one larger than the watermark would silence the connection for good.
+            if self.frames and (self.throttled or self.size + len(frame) > self.high_watermark):
+                self.throttled = True
+
+                if self.policy != OVERFLOW_BLOCK or not block:
+                    self.dropped += 1
+                    return False
+
+                while self.throttled and not self.closed:
+                    self.condition.wait()
+
+                if self.closed:
+                    return False
+
+            self.frames.append(frame)
+            self.size += len(frame)
+            self.enqueued += 1
+            self.max_size = max(self.max_size, self.size)
+
+            self.condition.notify_all()
+            return True
+
+    def get(self) -> Optional[bytes]:
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+
+            if not self.frames:
+                return None
+
+            frame = self.frames.popleft()
+            self.size -= len(frame)
+
+            if self.throttled and self.size <= self.low_watermark:
+                self.throttled = False
+                self.condition.notify_all()
+
+            return frame
+
+    def get_many(self, max_bytes: int, linger: float = 0) -> list:
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+
+            if linger > 0:
+                deadline = time.monotonic() + linger
+
+                while self.size < max_bytes and not self.closed:
+                    remaining = deadline - time.monotonic()
+
+                    if remaining <= 0:
+                        break
+
+                    self.condition.wait(remaining)
+
+            frames = []
+            batch_size = 0
+
+            while self.frames and (not frames or batch_size + len(self.frames[0]) <= max_bytes):
+                frame = self.frames.popleft()
+                frames.append(frame)
+                batch_size += len(frame)
+
+            self.size -= batch_size
+
+            if self.throttled and self.size <= self.low_watermark:
+                self.throttled = False
+                self.condition.notify_all()
+
+            return frames
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def get_stats(self) -> dict:
+        return {
+            'depth_frames': len(self.frames),
+            'depth_bytes': self.size,
+            'max_depth_bytes': self.max_size,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped
+        }
+
+
+class OutboundWriter(Thread):
+    def __init__(self, connection):
+        Thread.__init__(self)
+        self.daemon = True
+
+        self.connection = connection
+
+    def run(self):
+        coalesce_size = self.connection.server.coalesce_size
+        coalesce_delay = self.connection.server.coalesce_delay
+
+        try:
+            while True:
+                frames = self.connection.outbound.get_many(coalesce_size, coalesce_delay)
+
+                if not frames:
+                    break
+
+                data = frames[0] if len(frames) == 1 else b''.join(frames)
+
+                self.connection.socket.sendall(data)
+                bytes_sent.inc(len(data))
+                socket_writes.inc()
+
+        except BaseException as error:
+            self.connection.log('ERROR', f'Outbound writer stopped: {error}')
+            self.connection.server.close_connection(self.connection)
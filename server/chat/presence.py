@@ -0,0 +1,78 @@
+from bisect import bisect_left
+from threading import RLock
+
+PRESENCE_SNAPSHOT = '='
+PRESENCE_JOIN = '+'
+PRESENCE_LEAVE = '-'
+
+
+class Presence:
+    def __init__(self, tag: str):
+        self.tag = tag
+        self.lock = RLock()
+
+        self.users = []
+        self.version = 0
+        self.online_list = ''
+
+        self.subscribers = dict()  # address -> connection
+
+    def join(self, username: str):
+        with self.lock:
+            index = bisect_left(self.users, username)
+
+            if index < len(self.users) and self.users[index] == username:
+                return
+
+            self.users.insert(index, username)
+            subscribers, delta = self._publish(PRESENCE_JOIN, username)
+
+        self._send(subscribers, delta)
+
+    def leave(self, username: str):
+        with self.lock:
+            index = bisect_left(self.users, username)
+
+            if index >= len(self.users) or self.users[index] != username:
+                return
+
+            del self.users[index]
+            subscribers, delta = self._publish(PRESENCE_LEAVE, username)
+
+        self._send(subscribers, delta)
+
+    def subscribe(self, connection):
+        with self.lock:
+            self.subscribers[connection.address] = connection
+            snapshot = f'{self.version};{PRESENCE_SNAPSHOT}{",".join(self.users)}'
+
+        connection.send_to_socket(self.tag, snapshot)
+
+    def unsubscribe(self, connection):
+        with self.lock:
+            if self.subscribers.get(connection.address) is connection:
+                del self.subscribers[connection.address]
+
+    def get_online_list(self) -> str:
+        online_list = self.online_list
+
+        if online_list is None:
+            with self.lock:
+                online_list = self.online_list = ', '.join(self.users)
+
+        return online_list
+
+    def _publish(self, operation: str, username: str) -> tuple:
+        self.version += 1
+        self.online_list = None
+
+        return list(self.subscribers.values()), f'{self.version};{operation}{username}'
+
+    def _send(self, subscribers: list, delta: str):
+        # Sent outside the lock: a blocked subscriber must not hold up logins and logouts.
+        # Deltas may then arrive out of order, subscribers spot the version gap and ask for a new snapshot.
+        for subscriber in subscribers:
+            try:
+                subscriber.send_to_socket(self.tag, delta)
+            except Exception as error:
+                subscriber.log('ERROR', f'Could not deliver presence update: {error}')
@@ -0,0 +1,59 @@
+from threading import RLock
+
+
+class ConnectionRegistry:
+    def __init__(self):
+        self.lock = RLock()
+
+        self.by_address = dict()
+        self.by_username = dict()
+
+    def add(self, connection):
+        with self.lock:
+            self.by_address[connection.address] = connection
+
+    def remove(self, connection) -> bool:
+        with self.lock:
+            if self.by_address.get(connection.address) is not connection:
+                return False
+
+            del self.by_address[connection.address]
+            self._release_username(connection)
+
+            return True
+
+    def claim_username(self, connection, username: str) -> bool:
+        with self.lock:
+            owner = self.by_username.get(username)
+
+            if owner is not None:
+                return owner is connection
+
+            self._release_username(connection)
+            self.by_username[username] = connection
+            connection.username = username
+
+            return True
+
+    def get_by_username(self, username: str):
+        return self.by_username.get(username)
+
+    def get_by_address(self, address: tuple):
+        return self.by_address.get(address)
+
+    def snapshot(self) -> list:
+        with self.lock:
+            return list(self.by_address.values())
+
+    def usernames(self) -> list:
+        with self.lock:
+            return list(self.by_username.keys())
+
+    def _release_username(self, connection):
+        username = getattr(connection, 'username', None)
+
+        if username is not None and self.by_username.get(username) is connection:
+            del self.by_username[username]
+
+    def __len__(self) -> int:
+        return len(self.by_address)
@@ -0,0 +1,132 @@
+import os
+import tempfile
+from threading import Condition
+
+DEFAULT_RELAY_BUFFER_SIZE = 4 * 1024 * 1024
+DEFAULT_RELAY_ATTACH_TIMEOUT = 60
+
+
+class RelayBuffer:
+    def __init__(self, relay_id: str, file_size: int, capacity: int, spill_location: str):
+        self.relay_id = relay_id
+        self.file_size = file_size
+        self.spill_location = spill_location
+
+        self.condition = Condition()
+        self.ring = bytearray(capacity)
+        self.capacity = capacity
+        self.read_position = 0
+        self.write_position = 0
+
+        self.spill_fd = None
+        self.spill_path = None
+        self.spill_written = 0
+        self.spill_read = 0
+        self.spilled = False
+
+        self.attached = False
+        self.finished = False
+        self.failed = False
+        self.released = False
+
+    def write(self, data) -> int:
+        size = len(data)
+
+        with self.condition:
+            if self.spill_fd is None and self.write_position - self.read_position + size <= self.capacity:
+                self._write_to_ring(data)
+            else:
+                self._write_to_spill(data)
+
+            self.condition.notify_all()
+
+        return size
+
+    def read_into(self, buffer: memoryview) -> int:
+        with self.condition:
+            while True:
+                if self.write_position > self.read_position:
+                    return self._read_from_ring(buffer)
+
+                if self.spill_written > self.spill_read:
+                    data = os.pread(self.spill_fd, min(len(buffer), self.spill_written - self.spill_read), self.spill_read)
+                    buffer[:len(data)] = data
+                    self.spill_read += len(data)
+                    return len(data)
+
+                if self.failed:
+                    raise Exception('The upload feeding this relay was interrupted.')
+
+                if self.finished:
+                    return 0
+
+                self.condition.wait()
+
+    def attach(self) -> bool:
+        with self.condition:
+            if self.attached or self.released:
+                return False
+
+            self.attached = True
+            self.condition.notify_all()
+            return True
+
+    def wait_for_reader(self, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.attached or self.released, timeout)
+
+    def finish(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def fail(self):
+        with self.condition:
+            self.failed = True
+            self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.released = True
+
+            if self.spill_fd is not None:
+                os.close(self.spill_fd)
+                os.remove(self.spill_path)
+                self.spill_fd = None
+
+            self.condition.notify_all()
+
+    def is_spilled(self) -> bool:
+        return self.spilled
+
+    def _write_to_ring(self, data):
+        size = len(data)
+        start = self.write_position % self.capacity
+        first = min(size, self.capacity - start)
+
+        self.ring[start:start + first] = data[:first]
+        self.ring[:size - first] = data[first:]
+        self.write_position += size
+
+    def _read_from_ring(self, buffer: memoryview) -> int:
+        size = min(len(buffer), self.write_position - self.read_position)
+        start = self.read_position % self.capacity
+        first = min(size, self.capacity - start)
+
+        buffer[:first] = self.ring[start:start + first]
+        buffer[first:size] = self.ring[:size - first]
+        self.read_position += size
+
+        return size
+
+    def _write_to_spill(self, data):
+        # Once spilled, every later byte goes to disk so the reader sees them in order.
+        if self.spill_fd is None:
+            self.spill_fd, self.spill_path = tempfile.mkstemp(dir=self.spill_location, prefix='relay-')
+            self.spilled = True
+
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(self.spill_fd, view, self.spill_written)
+            self.spill_written += written
+            view = view[written:]
@@ -0,0 +1,39 @@
+from .logger import logger
+
+
+class RemotePeers:
+    def __init__(self, remote_connection):
+        self.remote_connection = remote_connection
+
+    def __setitem__(self, username: str, connection):
+        self.remote_connection.router.link(self.remote_connection.username, username)
+
+    def __delitem__(self, username: str):
+        self.remote_connection.router.unlink(self.remote_connection.username, username)
+
+    def get(self, username: str):
+        return None
+
+    def keys(self) -> list:
+        return []
+
+
+class RemoteConnection:
+    def __init__(self, username: str, router):
+        self.username = username
+        self.router = router
+        self.address = ('remote', username)
+
+        self.peers = RemotePeers(self)
+
+    def send_to_socket(self, tag: str, message: str):
+        self.router.deliver(self.username, tag, message)
+
+    def log(self, label: str, message: str, *args):
+        logger.log(f'(REMOTE - {self.username})', label, message, *args)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, RemoteConnection) and other.username == self.username
+
+    def __hash__(self) -> int:
+        return hash(self.address)
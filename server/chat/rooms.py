@@ -0,0 +1,65 @@
+from threading import RLock
+
+ROOM_PREFIX = '#'
+
+
+def is_room_name(name: str) -> bool:
+    return name.startswith(ROOM_PREFIX)
+
+
+def normalize_room_name(name: str) -> str:
+    name = name.strip()
+    return name if is_room_name(name) else f'{ROOM_PREFIX}{name}'
+
+
+class RoomRegistry:
+    def __init__(self):
+        self.lock = RLock()
+
+        self.rooms = dict()  # room name -> {address -> connection}
+        self.memberships = dict()  # connection address -> set of room names
+
+    def join(self, room: str, connection) -> bool:
+        with self.lock:
+            members = self.rooms.setdefault(room, dict())
+
+            if connection.address in members:
+                return False
+
+            members[connection.address] = connection
+            self.memberships.setdefault(connection.address, set()).add(room)
+
+            return True
+
+    def leave(self, room: str, connection) -> bool:
+        with self.lock:
+            members = self.rooms.get(room)
+
+            if members is None or members.get(connection.address) is not connection:
+                return False
+
+            del members[connection.address]
+            if not members:
+                del self.rooms[room]
+
+            rooms = self.memberships.get(connection.address)
+            rooms.discard(room)
+            if not rooms:
+                del self.memberships[connection.address]
+
+            return True
+
+    def leave_all(self, connection):
+        with self.lock:
+            for room in list(self.memberships.get(connection.address, ())):
+                self.leave(room, connection)
+
+    def is_member(self, room: str, connection) -> bool:
+        return connection.address in self.rooms.get(room, ())
+
+    def members(self, room: str) -> list:
+        with self.lock:
+            return list(self.rooms.get(room, {}).values())
+
+    def __len__(self) -> int:
+        return len(self.rooms)
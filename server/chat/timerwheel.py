@@ -0,0 +1,62 @@
+import math
+import time
+from threading import Lock
+
+
+class TimerWheel:
+    # Hashed timing wheel: scheduling and cancelling are O(1), and a tick only looks at the timers in its own slot.
+    # Sized so that the longest delay fits in one turn, every timer found in a slot is due and a tick costs O(expired).
+    def __init__(self, tick: float, max_delay: float):
+        self.tick = tick
+        self.slots = [dict() for _ in range(math.ceil(max_delay / tick) + 1)]  # item -> full turns left
+        self.positions = dict()  # item -> slot index
+
+        self.current = 0
+        self.next_tick_at = time.monotonic() + tick
+
+        self.lock = Lock()
+
+    def schedule(self, item, delay: float):
+        ticks = max(1, math.ceil(delay / self.tick))
+
+        with self.lock:
+            self._remove(item)
+
+            slot = (self.current + ticks) % len(self.slots)
+            self.slots[slot][item] = (ticks - 1) // len(self.slots)
+            self.positions[item] = slot
+
+    def cancel(self, item):
+        with self.lock:
+            self._remove(item)
+
+    def advance(self, now: float) -> list:
+        expired = []
+
+        with self.lock:
+            # Catches up on every tick that went by, a late caller never skips a slot.
+            while self.next_tick_at <= now:
+                self.current = (self.current + 1) % len(self.slots)
+                self.next_tick_at += self.tick
+
+                slot = self.slots[self.current]
+
+                for item, turns in list(slot.items()):
+                    if turns > 0:
+                        slot[item] = turns - 1
+                        continue
+
+                    del slot[item]
+                    del self.positions[item]
+                    expired.append(item)
+
+        return expired
+
+    def _remove(self, item):
+        slot = self.positions.pop(item, None)
+
+        if slot is not None:
+            del self.slots[slot][item]
+
+    def __len__(self) -> int:
+        return len(self.positions)
@@ -1,20 +1,157 @@
 import os
 from chat.chatserver import ChatServer, DEFAULT_CHAT_PORT, DEFAULT_BUFFER_SIZE, DEFAULT_MAX_CONNECTIONS
-from chat.filetransfer import FileTransferServer, DEFAULT_FILE_TRANSFER_PORT
+from chat.heartbeat import DEFAULT_IDLE_TIMEOUT, DEFAULT_PONG_TIMEOUT
+from chat.asyncserver import AsyncChatServer
+from chat.filetransfer import FileTransferServer, DEFAULT_FILE_TRANSFER_PORT, DEFAULT_TRANSFER_CHUNK_SIZE, FILES_LOCATION
+from chat.metrics import metrics, MetricsServer, DEFAULT_STATS_PORT
+from chat.logger import logger, DEFAULT_LOG_LEVEL
+from chat.relay import DEFAULT_RELAY_BUFFER_SIZE
+from chat.outbound import DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, DEFAULT_OVERFLOW_POLICY, DEFAULT_COALESCE_SIZE, DEFAULT_COALESCE_DELAY
+from chat.cluster import ClusterBus, run_cluster, get_default_cluster_path, DEFAULT_WORKERS
+from chat.federation import Federation, parse_peers, DEFAULT_FEDERATION_PORT, DEFAULT_FEDERATION_BIND
+from chat.offline import OfflineQueue, OFFLINE_LOCATION, DEFAULT_COMMIT_INTERVAL
+from chat.history import HistoryStore, HISTORY_LOCATION, DEFAULT_SEGMENT_SIZE as DEFAULT_HISTORY_SEGMENT_SIZE
+
+SERVER_MODE_THREADED = 'threaded'
+SERVER_MODE_ASYNC = 'async'
 
 
 def main():
-    print('Starting server...')
+    logger.set_level(os.getenv('LOG_LEVEL') or DEFAULT_LOG_LEVEL)
+    logger.log('(SERVER)', 'INFO', 'Starting server...')
 
     options = {
         'chat_port': int(os.getenv('CHAT_PORT') or DEFAULT_CHAT_PORT),
         'file_transfer_port': int(os.getenv('FILE_TRANSFER_PORT') or DEFAULT_FILE_TRANSFER_PORT),
         'buffer_size': int(os.getenv('BUFFER_SIZE') or DEFAULT_BUFFER_SIZE),
-        'max_connections': int(os.getenv('MAX_CONNECTIONS') or DEFAULT_MAX_CONNECTIONS)
+        'max_connections': int(os.getenv('MAX_CONNECTIONS') or DEFAULT_MAX_CONNECTIONS),
+        'server_mode': os.getenv('SERVER_MODE') or SERVER_MODE_THREADED,
+        'stats_port': int(os.getenv('STATS_PORT') or DEFAULT_STATS_PORT),
+        'admin_users': [username.strip() for username in (os.getenv('ADMIN_USERS') or '').split(',') if username.strip()],
+        'outbound_high_watermark': int(os.getenv('OUTBOUND_HIGH_WATERMARK') or DEFAULT_HIGH_WATERMARK),
+        'outbound_low_watermark': int(os.getenv('OUTBOUND_LOW_WATERMARK') or DEFAULT_LOW_WATERMARK),
+        'outbound_policy': os.getenv('OUTBOUND_POLICY') or DEFAULT_OVERFLOW_POLICY,
+        'tcp_nodelay': os.getenv('TCP_NODELAY', '1') != '0',
+        'chat_compression': os.getenv('CHAT_COMPRESSION', '1') != '0',
+        'send_buffer_size': int(os.getenv('SOCKET_SEND_BUFFER') or 0),
+        'receive_buffer_size': int(os.getenv('SOCKET_RECEIVE_BUFFER') or 0),
+        'coalesce_size': int(os.getenv('COALESCE_SIZE') or DEFAULT_COALESCE_SIZE),
+        'coalesce_delay': float(os.getenv('COALESCE_DELAY') or DEFAULT_COALESCE_DELAY),
+        'idle_timeout': float(os.getenv('IDLE_TIMEOUT') or DEFAULT_IDLE_TIMEOUT),
+        'pong_timeout': float(os.getenv('PONG_TIMEOUT') or DEFAULT_PONG_TIMEOUT),
+        'transfer_chunk_size': int(os.getenv('TRANSFER_CHUNK_SIZE') or DEFAULT_TRANSFER_CHUNK_SIZE),
+        'use_sendfile': os.getenv('USE_SENDFILE', '1') != '0',
+        'files_location': os.getenv('FILES_LOCATION') or FILES_LOCATION,
+        'relay_mode': os.getenv('RELAY_MODE', '0') == '1',
+        'relay_buffer_size': int(os.getenv('RELAY_BUFFER_SIZE') or DEFAULT_RELAY_BUFFER_SIZE),
+        'offline_queue': os.getenv('OFFLINE_QUEUE', '1') != '0',
+        'offline_location': os.getenv('OFFLINE_LOCATION') or OFFLINE_LOCATION,
+        'offline_commit_interval': float(os.getenv('OFFLINE_COMMIT_INTERVAL') or DEFAULT_COMMIT_INTERVAL),
+        'history': os.getenv('HISTORY', '1') != '0',
+        'history_location': os.getenv('HISTORY_LOCATION') or HISTORY_LOCATION,
+        'history_segment_size': int(os.getenv('HISTORY_SEGMENT_SIZE') or DEFAULT_HISTORY_SEGMENT_SIZE),
+        'workers': int(os.getenv('WORKERS') or DEFAULT_WORKERS),
+        'cluster_socket': os.getenv('CLUSTER_SOCKET'),
+        'node_name': os.getenv('NODE_NAME'),
+        'federation_port': int(os.getenv('FEDERATION_PORT') or DEFAULT_FEDERATION_PORT),
+        'federation_bind': os.getenv('FEDERATION_BIND') or DEFAULT_FEDERATION_BIND,
+        'federation_secret': os.getenv('FEDERATION_SECRET'),
+        'federation_peers': parse_peers(os.getenv('FEDERATION_PEERS'))
     }
 
-    server = ChatServer(options.get('chat_port'), buffer_size=options.get('buffer_size'), max_connections=options.get('max_connections'))
-    file_transfer_server = FileTransferServer(server, options.get('file_transfer_port'), buffer_size=options.get('buffer_size'), max_connections=options.get('max_connections'))
+    if options.get('node_name') and not options.get('federation_secret'):
+        logger.log('(SERVER)', 'WARN', 'Federation links must be authenticated, set FEDERATION_SECRET. Ignoring NODE_NAME.')
+        options['node_name'] = None
+
+    if options.get('workers') > 1:
+        if options.get('node_name'):
+            logger.log('(SERVER)', 'WARN', 'Federation is not available with multiple workers, ignoring NODE_NAME.')
+            options['node_name'] = None
+
+        if options.get('offline_queue'):
+            logger.log('(SERVER)', 'WARN', 'The offline queue is not shared between workers, disabling it.')
+            options['offline_queue'] = False
+
+        if options.get('history'):
+            logger.log('(SERVER)', 'WARN', 'The chat history is not shared between workers, disabling it.')
+            options['history'] = False
+
+        cluster_path = options.get('cluster_socket') or get_default_cluster_path(options.get('chat_port'))
+        return run_cluster(options.get('workers'), cluster_path, lambda path, worker_index: start_server(options, path, worker_index))
+
+    start_server(options)
+
+
+def start_server(options: dict, cluster_path: str = None, worker_index: int = 0):
+    server_class = AsyncChatServer if options.get('server_mode') == SERVER_MODE_ASYNC else ChatServer
+
+    server = server_class(
+        options.get('chat_port'),
+        buffer_size=options.get('buffer_size'),
+        max_connections=options.get('max_connections'),
+        outbound_high_watermark=options.get('outbound_high_watermark'),
+        outbound_low_watermark=options.get('outbound_low_watermark'),
+        outbound_policy=options.get('outbound_policy'),
+        tcp_nodelay=options.get('tcp_nodelay'),
+        chat_compression=options.get('chat_compression'),
+        send_buffer_size=options.get('send_buffer_size'),
+        receive_buffer_size=options.get('receive_buffer_size'),
+        coalesce_size=options.get('coalesce_size'),
+        coalesce_delay=options.get('coalesce_delay'),
+        idle_timeout=options.get('idle_timeout'),
+        pong_timeout=options.get('pong_timeout'),
+        admin_users=options.get('admin_users'),
+        reuse_port=cluster_path is not None
+    )
+    file_transfer_server = FileTransferServer(
+        server,
+        options.get('file_transfer_port'),
+        buffer_size=options.get('buffer_size'),
+        max_connections=options.get('max_connections'),
+        transfer_chunk_size=options.get('transfer_chunk_size'),
+        use_sendfile=options.get('use_sendfile'),
+        files_location=options.get('files_location'),
+        # Relays live in one process's memory, so clusters and federated nodes always go through the store.
+        relay_mode=options.get('relay_mode') and cluster_path is None and not options.get('node_name'),
+        relay_buffer_size=options.get('relay_buffer_size'),
+        reuse_port=cluster_path is not None
+    )
+
+    if cluster_path is not None:
+        cluster_bus = ClusterBus(server, cluster_path)
+        cluster_bus.connect()
+        server.set_cluster(cluster_bus)
+        cluster_bus.start()
+
+    if options.get('offline_queue'):
+        offline_messages = OfflineQueue(options.get('offline_location'), commit_interval=options.get('offline_commit_interval'))
+        offline_messages.initialize()
+        server.set_offline_queue(offline_messages)
+        offline_messages.start()
+
+    if options.get('history'):
+        history = HistoryStore(options.get('history_location'), segment_size=options.get('history_segment_size'))
+        history.initialize()
+        server.set_history(history)
+
+    if options.get('node_name'):
+        federation = Federation(
+            server,
+            options.get('node_name'),
+            options.get('federation_port'),
+            options.get('federation_peers'),
+            options.get('federation_secret'),
+            bind_address=options.get('federation_bind'),
+            file_transfer_port=options.get('file_transfer_port')
+        )
+        federation.initialize()
+        server.set_federation(federation)
+        federation.start()
+
+    if options.get('stats_port') > 0:
+        stats_port = options.get('stats_port') + worker_index
+        MetricsServer(metrics, stats_port).start()
+        logger.log('(SERVER)', 'INFO', f'Serving metrics on port {stats_port}')
 
     file_transfer_server.initialize()
     file_transfer_server.start()